@@ -0,0 +1,131 @@
+"""
+最小的 astrbot.api 替身，只提供插件用到的接口，让基准测试不依赖 AstrBot
+"""
+
+import logging
+import sys
+import types
+
+
+class _Filter:
+    """@filter.xxx(...) 装饰器全部原样返回被装饰的函数"""
+
+    class PermissionType:
+        ADMIN = "admin"
+        MEMBER = "member"
+
+    def __getattr__(self, name):
+        def decorator_factory(*args, **kwargs):
+            def decorator(func):
+                return func
+            return decorator
+        return decorator_factory
+
+
+class AstrMessageEvent:
+    """模拟消息事件；回复结果以元组返回，便于统计"""
+
+    def __init__(self, message_str: str, sender_id: str, sender_name: str = "用户", group_id: str = ""):
+        self.message_str = message_str
+        self.unified_msg_origin = f"bench:{group_id or 'private'}:{sender_id}"
+        self._sender_id = sender_id
+        self._sender_name = sender_name
+        self._group_id = group_id
+
+    def get_sender_id(self):
+        return self._sender_id
+
+    def get_sender_name(self):
+        return self._sender_name
+
+    def get_group_id(self):
+        return self._group_id
+
+    def is_admin(self):
+        return True
+
+    def plain_result(self, text):
+        return ("plain", text)
+
+    def image_result(self, path):
+        return ("image", path)
+
+    def chain_result(self, chain):
+        return ("chain", chain)
+
+
+class MessageChain:
+    def __init__(self):
+        self.chain = []
+
+    def message(self, text):
+        self.chain.append(text)
+        return self
+
+
+class Image:
+    def __init__(self, file=None):
+        self.file = file
+
+    @classmethod
+    def fromBase64(cls, data):
+        return cls(f"base64://{data}")
+
+
+class ProviderRequest:
+    def __init__(self, prompt: str = "", system_prompt: str = ""):
+        self.prompt = prompt
+        self.system_prompt = system_prompt
+
+
+class Context:
+    pass
+
+
+class Star:
+    def __init__(self, context):
+        self.context = context
+
+
+def register(*args, **kwargs):
+    def decorator(cls):
+        return cls
+    return decorator
+
+
+def install():
+    """把替身模块注册到 sys.modules，已安装真实 AstrBot 时也会被覆盖"""
+    astrbot = types.ModuleType("astrbot")
+    api = types.ModuleType("astrbot.api")
+    event = types.ModuleType("astrbot.api.event")
+    star = types.ModuleType("astrbot.api.star")
+    provider = types.ModuleType("astrbot.api.provider")
+    components = types.ModuleType("astrbot.api.message_components")
+
+    logger = logging.getLogger("astrbot")
+    if not logger.handlers:
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+    api.logger = logger
+    event.filter = _Filter()
+    event.AstrMessageEvent = AstrMessageEvent
+    event.MessageChain = MessageChain
+    star.Context = Context
+    star.Star = Star
+    star.register = register
+    provider.ProviderRequest = ProviderRequest
+    components.Image = Image
+
+    astrbot.api = api
+    api.event = event
+    api.star = star
+    api.provider = provider
+    api.message_components = components
+    sys.modules.update({
+        "astrbot": astrbot,
+        "astrbot.api": api,
+        "astrbot.api.event": event,
+        "astrbot.api.star": star,
+        "astrbot.api.provider": provider,
+        "astrbot.api.message_components": components,
+    })
@@ -0,0 +1,323 @@
+"""
+个人记忆插件基准测试，不需要安装 AstrBot
+
+生成指定规模的合成用户和记忆，并发调用各个指令处理函数，统计：
+各指令 p50/p95/p99 延迟、吞吐量、峰值 RSS、保存写入字节数、图片渲染耗时。
+文本回复和 Pillow 图片回复两条路径分别测量，每个场景在独立子进程中运行，峰值 RSS 互不影响。
+
+    python benchmarks/bench.py
+    python benchmarks/bench.py --users 1000 --memories 50 --ops 5000 --concurrency 32 --modes json,sqlite
+    python benchmarks/bench.py --save-baseline benchmarks/baseline.json
+    python benchmarks/bench.py --compare benchmarks/baseline.json
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_DIR = os.path.dirname(BENCH_DIR)
+PACKAGE_NAME = "astrbot_plugin_memory"
+
+# 指令 -> (处理函数名, 权重)
+COMMANDS = {
+    "回忆": ("get_memory_command", 50),
+    "搜索记忆": ("search_memory_command", 20),
+    "记住": ("add_memory_command", 15),
+    "我的记忆": ("list_memories_command", 10),
+    "删除记忆": ("delete_memory_command", 5),
+}
+
+CHARS = "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处队南给色光门即保治北造百规热领七海口东导器压志世金增争济阶油思术极交受联什认六共权收证改清己美再采转更单风切打白教速花带安场身车例真务具万每目至达走积示议声报斗完类八离华名确才科张信马节话米整空元况今集温传土许步群广石记需段研界拉林律叫且究观越织装影算低持音众书布复容儿须际商非验连断深难近矿千周委素技备半办青省列习响约支般史感劳便团往酸历市克何除消构府称太准精值号率族维划选标写存候毛亲快效斯院查江型眼王按格养易置派层片始却专状育厂京识适属圆包火住调满县局照参红细引听该铁价严"
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """最近秩百分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def latency_summary(values: List[float]) -> Dict:
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 50), 3),
+        "p95": round(percentile(values, 95), 3),
+        "p99": round(percentile(values, 99), 3),
+    }
+
+
+def random_text(rng: random.Random, low: int, high: int) -> str:
+    return ''.join(rng.choice(CHARS) for _ in range(rng.randint(low, high)))
+
+
+def thread_write_bytes() -> Optional[int]:
+    """当前线程累计写出的字节数（Linux），不可用时返回 None"""
+    try:
+        with open("/proc/thread-self/io", "r") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def load_plugin(workdir: str):
+    """把插件源码复制到临时目录后按包导入，数据目录随之位于临时目录"""
+    sys.path.insert(0, BENCH_DIR)
+    import astrbot_stub
+    astrbot_stub.install()
+
+    package_dir = os.path.join(workdir, PACKAGE_NAME)
+    shutil.copytree(PLUGIN_DIR, package_dir,
+                    ignore=shutil.ignore_patterns(".git", "data", "__pycache__", "benchmarks", "*.png"))
+    sys.path.insert(0, workdir)
+    return importlib.import_module(f"{PACKAGE_NAME}.main"), astrbot_stub
+
+
+async def run_scenario(scenario: Dict) -> Dict:
+    workdir = tempfile.mkdtemp(prefix="memory_bench_")
+    try:
+        main, stub = load_plugin(workdir)
+        render = importlib.import_module(f"{PACKAGE_NAME}.render")
+        records = importlib.import_module(f"{PACKAGE_NAME}.records")
+        if scenario["path"] == "image" and not render.HAS_PILLOW:
+            return {"skipped": "Pillow 未安装"}
+        if scenario["path"] == "text":
+            main.HAS_PILLOW = False
+
+        plugin = main.PersonalMemoryPlugin(stub.Context())
+        await plugin._wait_ready()
+        # 合成负载远超真实用户的指令频率，关闭限流以测量指令本身的开销
+        plugin._admission = None
+        plugin.storage_mode = scenario["mode"]
+        plugin._store = plugin._create_store()
+        plugin.max_memory_per_user = max(plugin.max_memory_per_user, scenario["memories"])
+
+        # 合成数据
+        rng = random.Random(scenario["seed"])
+        user_keys = {}
+        for u in range(scenario["users"]):
+            user_id = f"user{u}"
+            keys = []
+            for _ in range(scenario["memories"]):
+                key = random_text(rng, 2, 6)
+                tags = [random_text(rng, 1, 3) for _ in range(rng.randint(0, 2))]
+                plugin._put_record(user_id, key, records.MemoryRecord(random_text(rng, 10, 80), tags), touched=False)
+                keys.append(key)
+            user_keys[user_id] = keys
+        await plugin._write_pending()
+
+        # 统计保存写入字节数和渲染耗时
+        save_stats = {"saves": 0, "bytes": 0, "measured": True}
+        commit = plugin._store.commit
+
+        def measured_commit(payload):
+            before = thread_write_bytes()
+            try:
+                return commit(payload)
+            finally:
+                after = thread_write_bytes()
+                save_stats["saves"] += 1
+                if before is None or after is None:
+                    save_stats["measured"] = False
+                else:
+                    save_stats["bytes"] += after - before
+
+        plugin._store.commit = measured_commit
+
+        render_times = []
+        render_uncached = plugin._render_image_uncached
+
+        async def measured_render(*args):
+            # 只统计成功出图的渲染，排队已满退回文本的请求计入 replies 中的 plain
+            started = time.perf_counter()
+            image = await render_uncached(*args)
+            if image is not None:
+                render_times.append((time.perf_counter() - started) * 1000)
+            return image
+
+        plugin._render_image_uncached = measured_render
+
+        # 生成负载
+        names = list(COMMANDS)
+        weights = [COMMANDS[name][1] for name in names]
+        user_ids = list(user_keys)
+        ops = []
+        for i in range(scenario["ops"]):
+            command = rng.choices(names, weights)[0]
+            user_id = rng.choice(user_ids)
+            keys = user_keys[user_id]
+            if command == "记住":
+                key = random_text(rng, 2, 6)
+                keys.append(key)
+                message = f"记住 {key} {random_text(rng, 10, 80)}"
+            elif command == "我的记忆":
+                message = f"我的记忆 {rng.randint(1, 3)}" if rng.random() < 0.3 else "我的记忆"
+            elif command == "搜索记忆":
+                message = f"搜索记忆 {random_text(rng, 1, 2) if rng.random() < 0.5 else rng.choice(keys)}"
+            else:
+                # 约 10% 的回忆和删除针对不存在的记忆
+                key = rng.choice(keys) if keys and rng.random() < 0.9 else random_text(rng, 2, 6)
+                message = f"{command} {key}"
+            ops.append((command, message, user_id))
+
+        latencies: Dict[str, List[float]] = {name: [] for name in names}
+        replies: Dict[str, int] = {}
+        semaphore = asyncio.Semaphore(scenario["concurrency"])
+
+        async def run_op(command: str, message: str, user_id: str):
+            async with semaphore:
+                handler = getattr(plugin, COMMANDS[command][0])
+                event = stub.AstrMessageEvent(message, user_id, "测试用户")
+                started = time.perf_counter()
+                async for result in handler(event):
+                    replies[result[0]] = replies.get(result[0], 0) + 1
+                latencies[command].append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(run_op(*op) for op in ops))
+        await plugin._write_pending()
+        wall = time.perf_counter() - started
+        await plugin.terminate()
+
+        all_latencies = [value for values in latencies.values() for value in values]
+        return {
+            "ops": len(ops),
+            "wall_s": round(wall, 3),
+            "throughput": round(len(ops) / wall, 1),
+            "latency_ms": dict(
+                {"all": latency_summary(all_latencies)},
+                **{name: latency_summary(values) for name, values in latencies.items()}
+            ),
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "saves": save_stats["saves"],
+            "save_io_bytes": save_stats["bytes"] if save_stats["measured"] else None,
+            "render_ms": latency_summary(render_times),
+            "replies": replies,
+            "threads": threading.active_count(),
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_in_subprocess(scenario: Dict) -> Dict:
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--worker", json.dumps(scenario)],
+        capture_output=True, text=True, check=False
+    )
+    if output.returncode != 0:
+        return {"error": output.stderr.strip().splitlines()[-1] if output.stderr.strip() else "未知错误"}
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def scenario_name(scenario: Dict) -> str:
+    return f"{scenario['mode']}/{scenario['path']}"
+
+
+def print_result(name: str, result: Dict):
+    if "skipped" in result or "error" in result:
+        print(f"{name:<16} {result.get('skipped') or result.get('error')}")
+        return
+    overall = result["latency_ms"]["all"]
+    io_text = "n/a" if result["save_io_bytes"] is None else f"{result['save_io_bytes'] / 1024:.1f}KB"
+    print(f"{name:<16} p50 {overall['p50']:>7.2f}ms  p95 {overall['p95']:>7.2f}ms  p99 {overall['p99']:>7.2f}ms  "
+          f"{result['throughput']:>8.1f} ops/s  RSS {result['peak_rss_mb']:>6.1f}MB  "
+          f"保存 {result['saves']} 次 {io_text}  渲染 p50 {result['render_ms']['p50']:.2f}ms "
+          f"({result['render_ms']['count']} 次)  回复 {result['replies']}")
+    for command, summary in result["latency_ms"].items():
+        if command != "all" and summary["count"]:
+            print(f"    {command:<6} n={summary['count']:<6} p50 {summary['p50']:>7.2f}ms  "
+                  f"p95 {summary['p95']:>7.2f}ms  p99 {summary['p99']:>7.2f}ms")
+
+
+def compare(results: Dict[str, Dict], baseline: Dict[str, Dict]):
+    """与基线对比：延迟、RSS、写入字节越低越好，吞吐量越高越好"""
+    metrics = (
+        ("p50", lambda r: r["latency_ms"]["all"]["p50"]),
+        ("p95", lambda r: r["latency_ms"]["all"]["p95"]),
+        ("p99", lambda r: r["latency_ms"]["all"]["p99"]),
+        ("吞吐", lambda r: r["throughput"]),
+        ("RSS", lambda r: r["peak_rss_mb"]),
+        ("写入", lambda r: r["save_io_bytes"]),
+        ("渲染", lambda r: r["render_ms"]["p50"]),
+    )
+    print("\n与基线对比（正数表示增加）：")
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base or "latency_ms" not in base or "latency_ms" not in result:
+            print(f"{name:<16} 无可比较的基线")
+            continue
+        parts = []
+        for label, getter in metrics:
+            old, new = getter(base), getter(result)
+            if old in (None, 0) or new is None:
+                continue
+            parts.append(f"{label} {(new - old) / old * 100:+.1f}%")
+        print(f"{name:<16} " + "  ".join(parts))
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="个人记忆插件基准测试")
+    parser.add_argument("--users", type=int, default=200, help="合成用户数")
+    parser.add_argument("--memories", type=int, default=30, help="每个用户的记忆条数")
+    parser.add_argument("--ops", type=int, default=2000, help="指令调用次数")
+    parser.add_argument("--concurrency", type=int, default=8, help="同时处理的指令数；超过 render_max_pending 时部分图片回复会退回文本")
+    parser.add_argument("--modes", default="json", help="存储模式，逗号分隔：json,journal,sharded,sqlite")
+    parser.add_argument("--paths", default="text,image", help="回复路径，逗号分隔：text,image")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--save-baseline", metavar="FILE", help="把本次结果保存为基线")
+    parser.add_argument("--compare", metavar="FILE", help="与基线文件对比")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        print(json.dumps(asyncio.run(run_scenario(json.loads(args.worker))), ensure_ascii=False))
+        return 0
+
+    results = {}
+    for mode in args.modes.split(","):
+        for path in args.paths.split(","):
+            scenario = {"mode": mode, "path": path, "users": args.users, "memories": args.memories,
+                        "ops": args.ops, "concurrency": args.concurrency, "seed": args.seed}
+            name = scenario_name(scenario)
+            results[name] = run_in_subprocess(scenario)
+            print_result(name, results[name])
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(results, json.load(f)["results"])
+
+    if args.save_baseline:
+        baseline = {
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+            },
+            "args": {key: getattr(args, key) for key in ("users", "memories", "ops", "concurrency", "seed")},
+            "results": results,
+        }
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2)
+        print(f"\n基线已保存到 {args.save_baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+"""
+记忆淘汰队列
+
+每个用户一个最小堆，堆顶是下一条应被淘汰的记忆。
+更新优先级时直接压入新条目，旧条目在弹出时按序号识别并丢弃（惰性删除），
+因此新增、更新、淘汰都是 O(log n)。
+"""
+
+import heapq
+import itertools
+from typing import Dict, Hashable, Iterable, Optional, Tuple
+
+
+class EvictionQueue:
+    """按优先级从小到大淘汰的队列，优先级相同时先加入的先淘汰"""
+
+    def __init__(self, items: Iterable[Tuple[str, Hashable]] = ()):
+        self._counter = itertools.count()
+        self._live: Dict[str, int] = {}
+        self._heap = []
+        for key, priority in items:
+            seq = next(self._counter)
+            self._live[key] = seq
+            self._heap.append((priority, seq, key))
+        heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self._live)
+
+    def __contains__(self, key: str):
+        return key in self._live
+
+    def push(self, key: str, priority):
+        """加入一条记忆或更新它的优先级"""
+        seq = next(self._counter)
+        self._live[key] = seq
+        heapq.heappush(self._heap, (priority, seq, key))
+        self._maybe_compact()
+
+    def remove(self, key: str):
+        """移除一条记忆，堆中的旧条目留到弹出或压缩时清理"""
+        self._live.pop(key, None)
+        self._maybe_compact()
+
+    def pop(self) -> Optional[str]:
+        """弹出下一条应淘汰的记忆，队列为空时返回 None"""
+        while self._heap:
+            _, seq, key = heapq.heappop(self._heap)
+            if self._live.get(key) == seq:
+                del self._live[key]
+                return key
+        return None
+
+    def _maybe_compact(self):
+        # 失效条目过多时重建堆，保证堆大小与存活条目数同阶
+        if len(self._heap) > 2 * len(self._live) + 16:
+            self._heap = [entry for entry in self._heap if self._live.get(entry[2]) == entry[1]]
+            heapq.heapify(self._heap)
@@ -0,0 +1,135 @@
+"""
+临时图片目录管理
+
+渲染出的图片以内容哈希命名，缓存命中时会刷新文件的修改时间，
+因此修改时间即最近一次使用时间。清理时先删除超过 ttl 秒未使用的文件，
+总大小仍超过 max_bytes 时再从最久未使用的文件开始删除。
+
+每个进程使用 temp/<进程号> 子目录。进程崩溃或被强杀时来不及删除自己的目录，
+清理时会一并删除同级目录中进程已退出或超过 ttl 秒未更新的目录，
+其余进程的目录大小也计入 max_bytes。
+"""
+
+import os
+import shutil
+import time
+from typing import Tuple
+
+
+def _pid_alive(pid: int) -> bool:
+    """进程是否仍在运行；Windows 下无法安全探测，一律视为运行中，只按 ttl 清理"""
+    if os.name == "nt":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+def _dir_usage(directory: str) -> Tuple[int, float]:
+    """目录内文件的总字节数和最近修改时间"""
+    total = 0
+    newest = 0.0
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return 0, 0.0
+    for entry in entries:
+        try:
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+        except OSError:
+            continue
+        total += stat.st_size
+        newest = max(newest, stat.st_mtime)
+    return total, newest
+
+
+class TempImageStore:
+    """带过期时间和容量上限的临时图片目录"""
+
+    def __init__(self, directory: str, ttl: float = 600, max_bytes: int = 64 * 1024 * 1024):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+    def _siblings(self):
+        """同级的其他进程目录"""
+        parent, name = os.path.split(os.path.normpath(self.directory))
+        try:
+            entries = list(os.scandir(parent))
+        except OSError:
+            return []
+        siblings = []
+        for entry in entries:
+            try:
+                if entry.name != name and entry.name.isdigit() and entry.is_dir():
+                    siblings.append(entry)
+            except OSError:
+                continue
+        return siblings
+
+    def total_bytes(self) -> int:
+        """本进程目录和同级进程目录内文件的总字节数"""
+        total = _dir_usage(self.directory)[0]
+        for entry in self._siblings():
+            total += _dir_usage(entry.path)[0]
+        return total
+
+    def sweep_orphans(self) -> Tuple[int, int, int]:
+        """删除进程已退出或超过 ttl 秒未更新的同级目录，
+        返回删除的目录数、字节数和其余同级目录的总字节数"""
+        expire_before = time.time() - self.ttl
+        removed_dirs = removed_bytes = others_bytes = 0
+        for entry in self._siblings():
+            size, newest = _dir_usage(entry.path)
+            if _pid_alive(int(entry.name)) and newest >= expire_before:
+                others_bytes += size
+                continue
+            try:
+                shutil.rmtree(entry.path)
+            except OSError:
+                others_bytes += size
+                continue
+            removed_dirs += 1
+            removed_bytes += size
+        return removed_dirs, removed_bytes, others_bytes
+
+    def sweep(self) -> Tuple[int, int]:
+        """清理残留目录、过期和超出容量的文件，返回删除的文件数和字节数；
+        同级目录的大小计入容量，超出时只删除本进程的文件"""
+        removed_dirs, removed_bytes, others_bytes = self.sweep_orphans()
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return removed_dirs, removed_bytes
+
+        files = []
+        for entry in entries:
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+
+        expire_before = time.time() - self.ttl
+        total_bytes = others_bytes + sum(size for _, size, _ in files)
+        removed_files = removed_dirs
+        for mtime, size, path in files:
+            if mtime >= expire_before and total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_bytes -= size
+            removed_files += 1
+            removed_bytes += size
+        return removed_files, removed_bytes
@@ -4,24 +4,46 @@ AstrBot 个人记忆插件（精美图片回复版）
 支持精美图片回复的个人记忆管理插件
 """
 
-from astrbot.api.event import filter, AstrMessageEvent
+from astrbot.api.event import filter, AstrMessageEvent, MessageChain
 from astrbot.api.star import Context, Star, register
+from astrbot.api.provider import ProviderRequest
 from astrbot.api import logger
-import json
+import astrbot.api.message_components as Comp
+import asyncio
+import itertools
 import os
 import time
+import weakref
+from collections import OrderedDict
 from datetime import datetime
 from typing import Dict, List, Optional, Tuple
 import io
 import base64
 
-try:
-    from PIL import Image, ImageDraw, ImageFont
-    HAS_PILLOW = True
-except ImportError:
-    HAS_PILLOW = False
+from .eviction import EvictionQueue
+from .image_store import TempImageStore
+from .metrics import Metrics, instrument_handler
+from .namespaces import (GROUP_MARKER, SCOPE_GROUP, SCOPE_PERSONAL, is_group_namespace, memory_limit,
+                         namespace_id, split_scope)
+from .records import CONTENTS, MemoryRecord, clean_user_memories, format_minutes, now_minutes, split_tags
+from .render import (HAS_PILLOW, NO_IMAGE, EncodeInfo, RenderCache, RenderPool, RenderSaturated, RenderTheme,
+                     choose_encoding, render_key, render_memory_card, render_memory_list)
+from .search_index import MemorySearchIndex
+from .similarity import HAS_NUMPY, MemoryVectorIndex
+from .throttle import Admission, admission_controlled
+from .timers import TIMER_EXPIRE, TIMER_REMIND, TimerQueue, split_timer_tags
+from .usage import UsageCounter
+from .transfer import ImportStats, clean_import, export_store, read_batch, read_ndjson, user_line
+from .storage import (CHANGE_DEL, CHANGE_PUT, CHANGE_USE, JournalMemoryStore, JsonMemoryStore,
+                      ShardedMemoryStore, SqliteMemoryStore, StoreLock, write_file_replace)
+
+if NO_IMAGE:
+    logger.info("已设置 MEMORY_NO_IMAGE，将使用文本回复")
+elif not HAS_PILLOW:
     logger.warning("Pillow未安装，将使用文本回复")
 
+GROUP_ONLY_MESSAGE = f"❌ 群共享记忆（{GROUP_MARKER}）只能在群聊中使用"
+
 @register(
     name="personal_memory",
     author="AstrBot团队",
@@ -36,16 +58,121 @@ class PersonalMemoryPlugin(Star):
         super().__init__(context)
         self.data_dir = os.path.join(os.path.dirname(__file__), "data")
         self.memories_file = os.path.join(self.data_dir, "memories.json")
-        self.memories = {}
+        self.journal_file = os.path.join(self.data_dir, "memories.journal")
+        self.shard_dir = os.path.join(self.data_dir, "users")
+        self.db_file = os.path.join(self.data_dir, "memories.db")
+        self.lock_file = os.path.join(self.data_dir, "memories.lock")
+        self.memories = OrderedDict()
+        
+        # 存储模式：json 每次整体重写文件；journal 只追加变更日志，定期合并为快照；
+        # sharded 每个用户一个文件，用户首次使用时加载，空闲用户按 LRU 淘汰；
+        # sqlite 使用 SQLite 数据库（WAL），同样按用户懒加载，搜索走 FTS5 索引
+        self.storage_mode = "json"
+        self.journal_compact_threshold = 1000
+        self.max_resident_bytes = 16 * 1024 * 1024
+        self._resident_bytes = {}
+        self._resident_total = 0
+        
+        # 多进程共享数据目录：每次提交持有 memories.lock 进程间锁，合并其他进程的修改；
+        # 每 reload_check_interval 秒最多检查一次存储是否被其他进程改过，改过则重新加载（0 为不检查）
+        self.reload_check_interval = 2.0
+        self._next_reload_check = 0
+        # 每个用户的修改锁，只在有指令持有或等待时存在
+        self._user_locks = weakref.WeakValueDictionary()
+        
+        # 每个用户的搜索倒排索引，首次搜索时建立，随增删增量维护
+        self._search_indexes = {}
+        # 每个用户的相似度向量索引（search_mode 为 similarity 时使用），同样首次搜索时建立
+        self._vector_indexes = {}
+        
+        # 搜索模式：ranked 按相关度排序，只选出前 search_result_limit 条（翻页时选到所需页为止），
+        # 支持 key 的错字容忍；substring 保持按添加顺序返回全部子串匹配结果；
+        # similarity 按字符 n-gram 向量的余弦相似度排序，能匹配不含完整关键词的记忆（需要 numpy）
+        self.search_mode = "ranked"
+        if self.search_mode == "similarity" and not HAS_NUMPY:
+            logger.warning("numpy未安装，搜索模式退回 ranked")
+            self.search_mode = "ranked"
+        self.search_result_limit = 10
+        self.search_fuzzy = True
+        self.search_cache_size = 32
+        self._search_cache = {}
+        # 每个用户的记忆版本号，任何修改都会递增，用于判断缓存是否失效
+        self._user_versions = {}
+        
+        # 记忆列表和搜索结果每页条数
+        self.page_size = 10
+        
+        # 对话注入：调用大模型前把与消息相关的记忆（最多 llm_inject_limit 条、llm_inject_max_chars 字）
+        # 加在提示词前面；每次查找最多等待 llm_inject_timeout 秒（含启动加载和读取用户记忆），
+        # 超时则本次不注入。结果按用户和消息缓存，记忆变化后自动失效
+        self.llm_inject_enabled = True
+        self.llm_inject_limit = 5
+        self.llm_inject_max_chars = 500
+        self.llm_inject_timeout = 0.05
+        self.llm_inject_query_chars = 200
+        self.llm_inject_cache_size = 32
+        self._context_cache = {}
+        
         self.last_save_time = 0
         self.save_interval = 5
         
+        # 后台写回配置：合并窗口内的多次修改只写一次文件，
+        # 脏数据最长停留 max_save_delay 秒后必定落盘
+        self.max_save_delay = 30
+        self._dirty = False
+        self._dirty_since = 0
+        self._last_mutation = 0
+        self._dirty_event = None
+        self._flush_task = None
+        # 插件卸载时置位，后台循环看到后自行退出；停止后台任务最多等待 stop_timeout 秒
+        self._stopping = False
+        self.stop_timeout = 10
+        self._changes = {}
+        self._writing_changes = {}
+        # 保证快照按生成顺序提交
+        self._write_lock = asyncio.Lock()
+        # 使用次数：回忆只改内存，每 usage_flush_interval 秒把累计的变化合并保存一次
+        self.usage_flush_interval = 300
+        self._usage = UsageCounter()
+        self._usage_task = None
+        
+        # 批量导入导出：文件放在 export_dir 下，导入每 import_batch_size 个用户保存一次
+        self.export_dir = os.path.join(self.data_dir, "exports")
+        self.import_batch_size = 50
+        self._transfer_running = False
+        
+        # 限流：每个用户、每个群各一个令牌桶，*_rate 为每秒补充的指令数，*_burst 为允许的连续指令数，
+        # rate 为 0 时不限；rate_limit_enabled 为 False 时连重复请求合并也一并关闭（管理员指令不受限）
+        self.rate_limit_enabled = True
+        self.user_rate = 0.5
+        self.user_burst = 5
+        self.group_rate = 2.0
+        self.group_burst = 20
+        self._admission = (Admission(self.user_rate, self.user_burst, self.group_rate, self.group_burst)
+                           if self.rate_limit_enabled else None)
+        
         # 限制配置
+        # 达到 max_memory_per_user 时的淘汰策略：oldest 最早创建、lru 最久未回忆、lfu 使用次数最少
+        self.eviction_policy = "oldest"
+        self._eviction_queues = {}
+        self._touch_counter = itertools.count()
         self.max_memory_per_user = 100
         self.max_key_length = 50
         self.max_content_length = 500
         self.max_file_size = 1024 * 1024
         
+        # 记忆命名空间：群聊中的指令默认使用 group_default_scope（personal 为与私聊共用的个人记忆，
+        # member 为只属于该群的个人记忆）；参数以 @群 开头时读写群共享记忆，条数上限为 max_memory_per_group
+        self.group_default_scope = SCOPE_PERSONAL
+        self.max_memory_per_group = 200
+        
+        # 记忆过期和提醒：/记住 的内容后加 #ttl=1d 设置过期时间、#remind=2h 或 #remind=15:00 设置提醒。
+        # 到期时间放在最小堆中，启动时从存储重建；后台任务睡到堆顶到期，最长 timer_check_interval 秒醒一次
+        self.timer_check_interval = 60
+        self._timers = TimerQueue()
+        self._timer_task = None
+        self._timer_event = None
+        
         # 图片配置
         self.card_width = 800
         self.card_height = 400
@@ -53,72 +180,579 @@ class PersonalMemoryPlugin(Star):
         self.primary_color = (59, 130, 246)
         self.text_color = (30, 41, 59)
         self.muted_color = (100, 116, 139)
+        # 字体文件路径，多个用 os.pathsep 分隔；为空时自动搜索系统中文字体
+        self.font_path = ""
+        # 每个进程使用自己的临时目录，卸载时删除不会影响共用数据目录的其他进程正在发送的图片
+        self.temp_dir = os.path.join(self.data_dir, "temp", str(os.getpid()))
+        
+        # 渲染执行器：render_mode 为 thread 或 process，排队超过 render_max_pending 时退回文本回复
+        self.render_mode = "thread"
+        self.render_workers = 2
+        self.render_max_pending = 8
+        self.render_timeout = 5.0
+        self._render_pool = RenderPool(self.render_mode, self.render_workers,
+                                       self.render_max_pending, self.render_timeout)
+        # 全局负载分级降级：渲染队列达到 render_degrade_pending 时不再新渲染，只用缓存中的图片；
+        # 队列已满（render_max_pending）时连缓存图片也不发，直接回复文本
+        self.render_degrade_pending = 4
+        
+        # 渲染缓存：相同输入的图片直接复用；render_cache_dir 非空时缓存图片跨重启保留
+        self.render_cache_size = 256
+        self.render_cache_dir = ""
+        self.render_cache_disk_size = 2048
+        self._render_cache = RenderCache(self.temp_dir, self.render_cache_size,
+                                         self.render_cache_dir or None, self.render_cache_disk_size)
+        self._render_inflight: Dict[str, asyncio.Future] = {}
+        
+        # 临时图片：超过 temp_ttl 秒未使用或目录超过 temp_max_bytes 时由后台任务清理
+        self.temp_ttl = 600
+        self.temp_max_bytes = 64 * 1024 * 1024
+        self.temp_sweep_interval = 60
+        self._temp_store = TempImageStore(self.temp_dir, self.temp_ttl, self.temp_max_bytes)
+        self._sweep_task = None
+        # 图片发送方式：file 发送文件路径；base64 直接发送内存中的图片，不写临时文件（需适配器支持）
+        self.image_delivery = "file"
+        # 图片编码预算：speed 优先 CPU，balanced 兼顾，size 优先体积
+        self.image_encode_budget = "balanced"
+        
+        # 运行指标：metrics_enabled 为 False 时不做任何统计；metrics_dump_path 非空时
+        # 每 metrics_dump_interval 秒以 Prometheus 文本格式写出指标（可配合 node_exporter textfile collector）
+        self.metrics_enabled = True
+        self.metrics_dump_path = ""
+        self.metrics_dump_interval = 60
+        self._metrics = Metrics() if self.metrics_enabled else None
+        self._metrics_task = None
+        
+        # 启动加载：有运行中的事件循环时在线程池中打开存储（含 SQLite 建表和迁移）并加载，
+        # 注册立即返回，加载完成前到达的指令等待 _ready；懒加载存储只需迁移旧文件，用户在首次使用时加载
+        self._ready = None
+        self._store = None
         
         self._ensure_data_dir()
-        self._load_memories()
+        if not self._start_loading():
+            self._load_memories()
+        self._ensure_flush_task()
+        self._ensure_timer_task()
+    
+    def _start_loading(self) -> bool:
+        """在线程池中加载记忆；没有运行中的事件循环时返回 False，由调用方同步加载"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        self._ready = loop.create_task(asyncio.to_thread(self._load_memories))
+        return True
+    
+    async def _wait_ready(self):
+        """等待启动加载完成"""
+        ready = self._ready
+        if ready is not None and not ready.done():
+            await asyncio.shield(ready)
+    
+    async def initialize(self):
+        """AstrBot 加载插件后调用，启动后台任务"""
+        self._ensure_flush_task()
+        self._ensure_metrics_task()
+        self._ensure_timer_task()
+        self._ensure_sweep_task()
     
     def _ensure_data_dir(self):
         """确保数据目录存在"""
-        if not os.path.exists(self.data_dir):
-            os.makedirs(self.data_dir)
+        os.makedirs(self.data_dir, exist_ok=True)
+    
+    def _create_store(self):
+        """根据存储模式创建持久化后端"""
+        lock = StoreLock(self.lock_file)
+        if self.storage_mode == "journal":
+            return JournalMemoryStore(self.memories_file, self.journal_file,
+                                      compact_threshold=self.journal_compact_threshold, lock=lock)
+        if self.storage_mode == "sharded":
+            return ShardedMemoryStore(self.shard_dir, lock=lock)
+        if self.storage_mode == "sqlite":
+            return SqliteMemoryStore(self.db_file, lock=lock)
+        return JsonMemoryStore(self.memories_file, lock=lock)
+    
+    def _clean_user_memories(self, user_id: str, user_memories) -> Dict[str, MemoryRecord]:
+        """校验并清洗单个用户（命名空间）的记忆数据"""
+        return clean_user_memories(user_memories, self.max_content_length, self._memory_limit(user_id),
+                                   self._eviction_priority)
+    
+    @staticmethod
+    def _share_contents(user_memories: Dict[str, MemoryRecord]):
+        """记忆进入常驻缓存：登记内容，相同内容共用一个字符串"""
+        for memory in user_memories.values():
+            memory.content = CONTENTS.acquire(memory.content)
+    
+    @staticmethod
+    def _release_contents(user_memories: Dict[str, MemoryRecord]):
+        """记忆离开常驻缓存：释放内容的引用"""
+        for memory in user_memories.values():
+            CONTENTS.release(memory.content)
+    
+    def _memory_limit(self, user_id: str) -> int:
+        """命名空间的记忆条数上限"""
+        return memory_limit(user_id, self.max_memory_per_user, self.max_memory_per_group)
     
     def _load_memories(self):
-        """从文件加载记忆"""
+        """打开存储并从中加载记忆"""
+        started = time.perf_counter()
         try:
-            if os.path.exists(self.memories_file):
-                if os.path.getsize(self.memories_file) > self.max_file_size:
-                    logger.warning("记忆文件过大，跳过加载")
-                    return
-                
-                with open(self.memories_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    
-                    if len(data) > 100:
-                        data = dict(list(data.items())[:100])
-                    
-                    for user_id, user_memories in data.items():
-                        if isinstance(user_memories, dict):
-                            if len(user_memories) > self.max_memory_per_user:
-                                sorted_memories = sorted(
-                                    user_memories.items(),
-                                    key=lambda x: x[1].get('created', '')
-                                )
-                                user_memories = dict(sorted_memories[-self.max_memory_per_user:])
-                            
-                            cleaned_memories = {}
-                            for key, memory in user_memories.items():
-                                if isinstance(memory, dict):
-                                    cleaned_memories[key] = {
-                                        'content': str(memory.get('content', ''))[:self.max_content_length],
-                                        'tags': memory.get('tags', []),
-                                        'created': str(memory.get('created', datetime.now().isoformat()[:16])),
-                                        'usage_count': memory.get('usage_count', 0)
-                                    }
-                            self.memories[user_id] = cleaned_memories
-                        else:
-                            self.memories[user_id] = {}
-                    
+            self._store = self._create_store()
+        except Exception as e:
+            logger.error(f"打开记忆存储失败: {e}")
+            raise
+        try:
+            self._load_memories_from_store()
+        finally:
+            if self._metrics is not None:
+                self._metrics.observe("load", time.perf_counter() - started, "startup")
+    
+    def _load_memories_from_store(self):
+        if self._store.lazy:
+            self._migrate_legacy_file()
+            # 启动时还没有常驻用户，内存与存储一致
+            try:
+                self._store.generation = self._store.current_generation()
+            except Exception as e:
+                logger.error(f"读取存储修改代号失败: {e}")
+            self._schedule_stored_timers()
+            return
+        
+        try:
+            users = self._read_store_users()
+            if users is None:
+                logger.warning("记忆文件过大，跳过加载")
+            else:
+                self.memories = users
+                for user_id, user_memories in users.items():
+                    self._share_contents(user_memories)
+                    self._schedule_user(user_id, user_memories)
         except Exception as e:
             logger.error(f"加载记忆文件失败: {e}")
-            self.memories = {}
+            self.memories = OrderedDict()
+    
+    def _schedule_stored_timers(self):
+        """懒加载存储启动时只读取设置了过期或提醒的记忆，重建定时器"""
+        try:
+            for user_id, key, raw_memory in self._store.iter_timers():
+                self._schedule(user_id, key, MemoryRecord.from_dict(raw_memory))
+        except Exception as e:
+            logger.error(f"读取定时记忆失败: {e}")
+    
+    def _read_store_users(self) -> Optional[OrderedDict]:
+        """读取整体存储中的全部用户并清洗，文件过大时返回 None（可在线程池中执行）"""
+        if os.path.exists(self.memories_file):
+            if os.path.getsize(self.memories_file) > self.max_file_size:
+                return None
+        
+        data = self._store.load()
+        
+        # 只常驻前 100 个用户；存储标记为部分加载，保存和压缩时合并到完整数据上，其余用户不会丢失
+        self._store.partial = len(data) > 100
+        if self._store.partial:
+            logger.warning(f"记忆文件中有 {len(data)} 个用户，只加载前 100 个")
+            data = dict(list(data.items())[:100])
+        
+        return OrderedDict(
+            (user_id, self._clean_user_memories(user_id, user_memories)) for user_id, user_memories in data.items()
+        )
     
-    def _save_memories(self):
-        """保存记忆到文件"""
+    def _migrate_legacy_file(self):
+        """首次启用懒加载存储时，把旧的 memories.json 一次性迁移过去"""
         try:
-            current_time = time.time()
-            if current_time - self.last_save_time < self.save_interval:
+            count = self._store.migrate_from_json(self.memories_file)
+            if count:
+                logger.info(f"已将 {count} 个用户的记忆迁移到 {self.storage_mode} 存储")
+        except Exception as e:
+            logger.error(f"迁移记忆到 {self.storage_mode} 存储失败: {e}")
+    
+    @staticmethod
+    def _estimate_memory_bytes(key: str, memory: MemoryRecord) -> int:
+        """粗略估算一条记忆在内存中的占用（标签为共享的驻留字符串，不计入）"""
+        return 250 + 2 * (len(key) + len(memory.content)) + 8 * len(memory.tags)
+    
+    @staticmethod
+    def _estimate_user_bytes(user_id: str) -> int:
+        """粗略估算常驻用户本身的占用（缓存中的字典及各级索引的表项），没有记忆的用户也计入"""
+        return 400 + 2 * len(user_id)
+    
+    def _ensure_user_loaded(self, user_id: str):
+        """分片存储下按需加载用户记忆，并维护 LRU 顺序"""
+        if not self._store.lazy:
+            return
+        
+        if user_id in self.memories:
+            self.memories.move_to_end(user_id)
+            return
+        
+        try:
+            raw_memories = self._store.load_user(user_id)
+        except Exception as e:
+            logger.error(f"加载用户记忆失败: {e}")
+            raw_memories = {}
+        self._install_user(user_id, raw_memories)
+    
+    async def _preload_user(self, user_id: str):
+        """在线程池中预先加载用户记忆，避免磁盘或数据库读取阻塞事件循环"""
+        await self._wait_ready()
+        await self._reload_if_changed()
+        if not self._store.lazy:
+            return
+        
+        if user_id in self.memories:
+            self.memories.move_to_end(user_id)
+            return
+        
+        started = time.perf_counter()
+        try:
+            raw_memories = await asyncio.to_thread(self._store.load_user, user_id)
+        except Exception as e:
+            logger.error(f"加载用户记忆失败: {e}")
+            raw_memories = {}
+        if self._metrics is not None:
+            self._metrics.observe("load", time.perf_counter() - started, "user")
+        
+        # 等待期间可能已被其他指令加载
+        if user_id in self.memories:
+            self.memories.move_to_end(user_id)
+            return
+        self._install_user(user_id, raw_memories)
+    
+    def _install_user(self, user_id: str, raw_memories: Dict):
+        """把从存储读取的用户记忆放入常驻缓存"""
+        user_memories = self._clean_user_memories(user_id, raw_memories)
+        self._share_contents(user_memories)
+        self.memories[user_id] = user_memories
+        self._drop_user_caches(user_id)
+        # 其他进程可能新设置了定时，已登记的不会重复登记
+        self._schedule_user(user_id, user_memories)
+        self._resident_bytes[user_id] = self._estimate_user_bytes(user_id) + sum(
+            self._estimate_memory_bytes(k, m) for k, m in user_memories.items()
+        )
+        self._resident_total += self._resident_bytes[user_id]
+        self._evict_idle_users()
+    
+    def _drop_user_caches(self, user_id: str):
+        """丢弃由用户记忆派生的索引和缓存，下次使用时重建"""
+        self._search_indexes.pop(user_id, None)
+        self._vector_indexes.pop(user_id, None)
+        self._search_cache.pop(user_id, None)
+        self._context_cache.pop(user_id, None)
+        self._eviction_queues.pop(user_id, None)
+    
+    def _track_resident_bytes(self, user_id: str, delta: int):
+        """记录常驻用户的内存估算变化"""
+        if self._store.lazy and user_id in self._resident_bytes:
+            self._resident_bytes[user_id] += delta
+            self._resident_total += delta
+    
+    def _evict_idle_users(self):
+        """超出内存预算时按最近最少使用顺序卸载用户，尚未落盘或正在修改的用户跳过"""
+        if self._resident_total <= self.max_resident_bytes:
+            return
+        
+        busy_users = self._busy_users()
+        busy_users.update(self._usage.users())
+        for user_id in list(self.memories.keys())[:-1]:
+            if self._resident_total <= self.max_resident_bytes:
+                break
+            if user_id in busy_users:
+                continue
+            self._unload_user(user_id)
+            if self._metrics is not None:
+                self._metrics.inc("evictions", "user")
+    
+    def _unload_user(self, user_id: str):
+        """把用户移出常驻缓存，下次使用时从存储重新读取"""
+        self._release_contents(self.memories.pop(user_id))
+        self._drop_user_caches(user_id)
+        self._resident_total -= self._resident_bytes.pop(user_id, 0)
+    
+    def _busy_users(self) -> set:
+        """有未落盘变更或正被指令修改的用户"""
+        busy_users = {user_id for user_id, _ in self._changes}
+        busy_users.update(user_id for user_id, _ in self._writing_changes)
+        busy_users.update(user_id for user_id, lock in self._user_locks.items() if lock.locked())
+        return busy_users
+    
+    def _user_lock(self, user_id: str) -> asyncio.Lock:
+        """获取用户的修改锁：加载、检查和修改同一用户记忆的步骤之间有 await 时保持串行"""
+        lock = self._user_locks.get(user_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._user_locks[user_id] = lock
+        return lock
+    
+    async def _reload_if_changed(self):
+        """其他进程写过存储时重新加载，每 reload_check_interval 秒最多检查一次
+
+        先把本进程的修改合并写入存储，再以存储为准：整体存储重新读取全部用户，
+        懒加载存储卸载常驻用户，下次使用时重新读取。正在修改或又有新变更的用户保留内存中的版本，
+        此时不更新修改代号，之后的提交继续按合并处理，下个周期再重新加载。
+        """
+        if self.reload_check_interval <= 0:
+            return
+        now = time.monotonic()
+        if now < self._next_reload_check:
+            return
+        self._next_reload_check = now + self.reload_check_interval
+        
+        try:
+            if await asyncio.to_thread(self._store.current_generation) == self._store.generation:
                 return
             
-            with open(self.memories_file, 'w', encoding='utf-8') as f:
-                json.dump(self.memories, f, separators=(',', ':'), ensure_ascii=False)
+            self._flush_usage()
+            await self._write_pending()
+            async with self._write_lock:
+                generation = await asyncio.to_thread(self._store.current_generation)
+                if generation == self._store.generation:
+                    return
+                if self._store.lazy:
+                    synced = self._unload_clean_users()
+                    if synced:
+                        self._store.generation = generation
+                else:
+                    users = await asyncio.to_thread(self._read_store_users)
+                    if users is None:
+                        return
+                    if not self._install_reloaded(users):
+                        self._store.generation = None
+            if self._metrics is not None:
+                self._metrics.inc("reloads")
+        except Exception as e:
+            logger.error(f"重新加载记忆失败: {e}")
+    
+    def _unload_clean_users(self) -> bool:
+        """卸载没有未落盘变更的常驻用户，返回是否全部卸载"""
+        busy_users = self._busy_users()
+        busy_users.update(self._usage.users())
+        synced = True
+        for user_id in list(self.memories.keys()):
+            if user_id in busy_users:
+                synced = False
+                continue
+            self._unload_user(user_id)
+            self._user_versions[user_id] = self._user_versions.get(user_id, 0) + 1
+            self._render_cache.invalidate(user_id)
+        return synced
+    
+    def _install_reloaded(self, users: OrderedDict) -> bool:
+        """用重新读取的全部用户替换内存中的记忆，返回是否全部替换"""
+        busy_users = self._busy_users()
+        synced = True
+        for user_id in busy_users:
+            if user_id in self.memories:
+                users[user_id] = self.memories[user_id]
+                synced = False
+        
+        # 读取期间累计的回忆次数只在旧对象上，补到新读取的记忆上
+        for (user_id, key), hits in self._usage.peek().items():
+            if user_id not in busy_users and key in users.get(user_id, {}):
+                users[user_id][key].usage_count += hits
+        
+        for user_id in set(self.memories) | set(users):
+            if user_id in busy_users:
+                continue
+            self._drop_user_caches(user_id)
+            self._user_versions[user_id] = self._user_versions.get(user_id, 0) + 1
+            self._render_cache.invalidate(user_id)
+            self._release_contents(self.memories.get(user_id, {}))
+            self._share_contents(users.get(user_id, {}))
+            self._schedule_user(user_id, users.get(user_id, {}))
+        self.memories = users
+        return synced
+    
+    def _save_memories(self, user_id: str = None, key: str = None, change: str = CHANGE_PUT):
+        """记录一条记忆的变更，由后台任务合并写入文件"""
+        if user_id is not None:
+            self._user_versions[user_id] = self._user_versions.get(user_id, 0) + 1
+            self._render_cache.invalidate(user_id)
+        if user_id is not None and key is not None:
+            # 同一条记忆在一个保存窗口内的多次修改只保留最终状态，
+            # 仅在之前只记录了使用次数变化时才升级为更完整的变更类型
+            if self._changes.get((user_id, key)) in (None, CHANGE_USE):
+                self._changes[(user_id, key)] = change
+        
+        now = time.time()
+        if not self._dirty:
+            self._dirty = True
+            self._dirty_since = now
+        elif self._metrics is not None:
+            # 合并进已在等待的那次保存，不单独写文件
+            self._metrics.inc("saves_coalesced")
+        self._last_mutation = now
+        
+        if self._ensure_flush_task():
+            self._dirty_event.set()
+        else:
+            # 没有运行中的事件循环（如脚本直接调用），退回同步写入
+            self._flush_memories()
+    
+    def _ensure_flush_task(self) -> bool:
+        """确保后台写回任务正在运行"""
+        if self._flush_task is not None and not self._flush_task.done():
+            return True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        if self._dirty_event is None:
+            self._dirty_event = asyncio.Event()
+        self._flush_task = loop.create_task(self._flush_loop())
+        return True
+    
+    async def _flush_loop(self):
+        """后台写回循环：静默 save_interval 秒或脏数据超过 max_save_delay 秒后落盘"""
+        await self._wait_ready()
+        while True:
+            try:
+                await self._dirty_event.wait()
+                
+                while True:
+                    now = time.time()
+                    quiet_deadline = self._last_mutation + self.save_interval
+                    stale_deadline = self._dirty_since + self.max_save_delay
+                    delay = min(quiet_deadline, stale_deadline) - now
+                    if delay <= 0:
+                        break
+                    await asyncio.sleep(delay)
+                
+                self._dirty_event.clear()
+                if not await self._write_pending():
+                    await asyncio.sleep(self.save_interval)
+                    self._dirty_event.set()
+                
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"后台保存记忆失败: {e}")
+                await asyncio.sleep(self.save_interval)
+                if self._dirty:
+                    self._dirty_event.set()
+    
+    def _ensure_usage_task(self) -> bool:
+        """确保使用次数定期保存任务正在运行"""
+        if self._usage_task is not None and not self._usage_task.done():
+            return True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        self._usage_task = loop.create_task(self._usage_flush_loop())
+        return True
+    
+    async def _usage_flush_loop(self):
+        """每 usage_flush_interval 秒把累计的使用次数变化交给后台写回"""
+        while True:
+            await asyncio.sleep(self.usage_flush_interval)
+            try:
+                self._flush_usage()
+            except Exception as e:
+                logger.error(f"保存使用次数失败: {e}")
+    
+    def _flush_usage(self):
+        """把累计的使用次数变化合并为一批 use 变更"""
+        for user_id, key in self._usage.drain():
+            if key in self.memories.get(user_id, {}):
+                self._save_memories(user_id, key, CHANGE_USE)
+    
+    async def _write_pending(self) -> bool:
+        """立即把未保存的修改写入存储，文件 IO 在线程池中执行；与后台写回串行，保证写入顺序"""
+        async with self._write_lock:
+            snapshot = self._snapshot_memories()
+            if snapshot is None:
+                return True
+            data, changes = snapshot
+            self._writing_changes = changes
+            started = time.perf_counter()
+            try:
+                written = await asyncio.to_thread(self._write_memories, data)
+            finally:
+                self._writing_changes = {}
+            if self._metrics is not None:
+                self._metrics.observe("save", time.perf_counter() - started)
+                self._metrics.inc("saves", "ok" if written else "failed")
+            if not written:
+                self._requeue_changes(changes)
+                return False
+            self._evict_idle_users()
+            return True
+    
+    def _snapshot_memories(self):
+        """在事件循环内生成待写入数据并清除脏标记，写入期间的新修改会重新标记"""
+        if not self._dirty:
+            return None
+        self._dirty = False
+        changes, self._changes = self._changes, {}
+        try:
+            return self._store.prepare(self.memories, changes), changes
+        except Exception:
+            self._requeue_changes(changes)
+            raise
+    
+    def _requeue_changes(self, changes: Dict):
+        """写入失败时把变更放回队列，等待下次保存重试"""
+        for change_key, change in changes.items():
+            if self._changes.get(change_key) in (None, CHANGE_USE):
+                self._changes[change_key] = change
+        if not self._dirty:
+            self._dirty = True
+            self._dirty_since = time.time()
+    
+    def _write_memories(self, data) -> bool:
+        """将待写入数据提交到存储后端（可在线程池中执行）"""
+        try:
+            self._store.commit(data)
             
-            self.last_save_time = current_time
+            self.last_save_time = time.time()
+            return True
             
         except Exception as e:
             logger.error(f"保存记忆失败: {e}")
+            return False
     
-    def _add_memory(self, user_id: str, key: str, content: str, tags: List[str] = None) -> bool:
-        """添加记忆"""
+    def _flush_memories(self) -> bool:
+        """立即同步写入未保存的修改"""
+        try:
+            snapshot = self._snapshot_memories()
+        except Exception as e:
+            logger.error(f"保存记忆失败: {e}")
+            return False
+        if snapshot is None:
+            return True
+        data, changes = snapshot
+        if not self._write_memories(data):
+            self._requeue_changes(changes)
+            return False
+        return True
+    
+    def _eviction_priority(self, memory: MemoryRecord, touched: bool = False):
+        """淘汰优先级，越小越先淘汰
+
+        lru 策略下，本次运行中新增或回忆过的记忆按访问顺序排列，
+        其余记忆按创建时间排在它们之前。
+        """
+        if self.eviction_policy == "lfu":
+            return (memory.usage_count, memory.created)
+        if self.eviction_policy == "lru":
+            if touched:
+                return (1, next(self._touch_counter))
+            return (0, memory.created)
+        return (memory.created,)
+    
+    def _get_eviction_queue(self, user_id: str) -> EvictionQueue:
+        """获取用户的淘汰队列，不存在时根据当前记忆建立"""
+        queue = self._eviction_queues.get(user_id)
+        if queue is None:
+            queue = EvictionQueue(
+                (key, self._eviction_priority(memory)) for key, memory in self.memories[user_id].items()
+            )
+            self._eviction_queues[user_id] = queue
+        return queue
+    
+    def _add_memory(self, user_id: str, key: str, content: str, tags: List[str] = None,
+                    expires: int = None, remind: Tuple[int, str] = None) -> bool:
+        """添加记忆；expires 为过期时间，remind 为 (提醒时间, 推送的会话)，均为分钟时间戳"""
         try:
             key = str(key)[:self.max_key_length]
             content = str(content)[:self.max_content_length]
@@ -126,64 +760,196 @@ class PersonalMemoryPlugin(Star):
             if not key or not content:
                 return False
             
-            if user_id not in self.memories:
-                self.memories[user_id] = {}
-            
-            if len(self.memories[user_id]) >= self.max_memory_per_user:
-                oldest_key = min(self.memories[user_id].keys(), 
-                               key=lambda k: self.memories[user_id][k].get('created', ''))
-                del self.memories[user_id][oldest_key]
-            
-            self.memories[user_id][key] = {
-                'content': content,
-                'tags': tags or [],
-                'created': datetime.now().isoformat()[:16],
-                'usage_count': 0
-            }
-            
-            self._save_memories()
+            self._put_record(user_id, key, MemoryRecord(content, tags or (), expires=expires, remind=remind))
             return True
             
         except Exception as e:
             logger.error(f"添加记忆失败: {e}")
             return False
     
-    def _get_memory(self, user_id: str, key: str) -> Optional[Dict]:
+    def _put_record(self, user_id: str, key: str, record: MemoryRecord, touched: bool = True):
+        """写入一条记忆，超出条数上限时先淘汰；touched 为 False 时不视为本次运行中访问过"""
+        self._ensure_user_loaded(user_id)
+        if user_id not in self.memories:
+            self.memories[user_id] = {}
+        
+        queue = self._get_eviction_queue(user_id)
+        limit = self._memory_limit(user_id)
+        while key not in self.memories[user_id] and len(self.memories[user_id]) >= limit:
+            victim_key = queue.pop()
+            if victim_key is None:
+                break
+            self._track_resident_bytes(
+                user_id, -self._estimate_memory_bytes(victim_key, self.memories[user_id][victim_key])
+            )
+            CONTENTS.release(self.memories[user_id].pop(victim_key).content)
+            self._unindex_memory(user_id, victim_key)
+            self._save_memories(user_id, victim_key, CHANGE_DEL)
+            if self._metrics is not None:
+                self._metrics.inc("evictions", "memory")
+        
+        if key in self.memories[user_id]:
+            self._track_resident_bytes(
+                user_id, -self._estimate_memory_bytes(key, self.memories[user_id][key])
+            )
+            CONTENTS.release(self.memories[user_id][key].content)
+        
+        record.content = CONTENTS.acquire(record.content)
+        self.memories[user_id][key] = record
+        self._track_resident_bytes(user_id, self._estimate_memory_bytes(key, record))
+        self._index_memory(user_id, key)
+        queue.push(key, self._eviction_priority(record, touched=touched))
+        self._schedule(user_id, key, record)
+        
+        self._save_memories(user_id, key, CHANGE_PUT)
+    
+    def _get_memory(self, user_id: str, key: str) -> Optional[MemoryRecord]:
         """获取记忆"""
         try:
+            self._ensure_user_loaded(user_id)
             if user_id in self.memories and key in self.memories[user_id]:
                 memory = self.memories[user_id][key]
-                memory['usage_count'] = memory.get('usage_count', 0) + 1
-                self._save_memories()
+                memory.usage_count += 1
+                if self.eviction_policy != "oldest" and user_id in self._eviction_queues:
+                    self._eviction_queues[user_id].push(key, self._eviction_priority(memory, touched=True))
+                if self._ensure_usage_task():
+                    self._usage.hit(user_id, key)
+                else:
+                    # 没有运行中的事件循环时直接记录变更
+                    self._save_memories(user_id, key, CHANGE_USE)
                 return memory
             return None
         except Exception as e:
             logger.error(f"获取记忆失败: {e}")
             return None
     
-    def _search_memories(self, user_id: str, keyword: str) -> List[Tuple[str, Dict]]:
+    def _get_search_index(self, user_id: str) -> MemorySearchIndex:
+        """获取用户的搜索索引，不存在时根据当前记忆建立"""
+        index = self._search_indexes.get(user_id)
+        if index is None:
+            index = MemorySearchIndex(self.memories.get(user_id, {}))
+            self._search_indexes[user_id] = index
+        return index
+    
+    def _get_vector_index(self, user_id: str) -> MemoryVectorIndex:
+        """获取用户的相似度向量索引，不存在时根据当前记忆建立"""
+        vectors = self._vector_indexes.get(user_id)
+        if vectors is None:
+            vectors = MemoryVectorIndex(self.memories.get(user_id, {}))
+            self._vector_indexes[user_id] = vectors
+        return vectors
+    
+    def _index_memory(self, user_id: str, key: str):
+        """记忆新增或修改后更新已建立的索引"""
+        index = self._search_indexes.get(user_id)
+        if index is not None:
+            index.add(key, self.memories[user_id][key])
+        vectors = self._vector_indexes.get(user_id)
+        if vectors is not None:
+            vectors.add(key, self.memories[user_id][key])
+    
+    def _unindex_memory(self, user_id: str, key: str):
+        """记忆删除后更新已建立的索引"""
+        index = self._search_indexes.get(user_id)
+        if index is not None:
+            index.remove(key)
+        vectors = self._vector_indexes.get(user_id)
+        if vectors is not None:
+            vectors.remove(key)
+    
+    def _search_memories(self, user_id: str, keyword: str) -> List[Tuple[str, MemoryRecord]]:
         """搜索记忆"""
         try:
+            self._ensure_user_loaded(user_id)
             if user_id not in self.memories:
                 return []
             
-            keyword = str(keyword).lower()
-            results = []
-            
-            for key, memory in self.memories[user_id].items():
-                content = memory.get('content', '').lower()
-                tags = ' '.join(memory.get('tags', [])).lower()
-                if keyword in key.lower() or keyword in content or keyword in tags:
-                    results.append((key, memory))
-            
-            return results
+            user_memories = self.memories[user_id]
+            return [(key, user_memories[key]) for key in self._get_search_index(user_id).search(keyword)]
         except Exception as e:
             logger.error(f"搜索记忆失败: {e}")
             return []
     
-    def _get_user_memories(self, user_id: str) -> List[Tuple[str, Dict]]:
+    async def _find_memories(self, user_id: str, keyword: str,
+                             limit: int = None) -> Tuple[List[Tuple[str, MemoryRecord]], int]:
+        """搜索记忆，返回要展示的结果和命中总数
+
+        排序模式下只返回得分最高的 max(limit, search_result_limit) 条，结果按用户缓存，
+        直到该用户的记忆发生变化。存储后端提供索引时在线程池中走后端索引。
+        """
+        await self._preload_user(user_id)
+        limit = max(limit or 0, self.search_result_limit)
+        
+        version = self._user_versions.get(user_id, 0)
+        user_cache = self._search_cache.setdefault(user_id, OrderedDict())
+        cached = user_cache.get(keyword)
+        # 缓存的结果不少于所需条数（或已是全部命中）时直接复用
+        if cached is not None and cached[0] == version and (len(cached[1]) >= limit or len(cached[1]) == cached[2]):
+            user_cache.move_to_end(keyword)
+            if self._metrics is not None:
+                self._metrics.inc("search_cache", "hit")
+            return cached[1], cached[2]
+        
+        started = time.perf_counter()
+        
+        hit_keys = None
+        if self._store.searchable and self.search_mode != "similarity":
+            hit_keys = await self._search_store(user_id, keyword)
+            # 等待期间记忆可能已经变化，本次结果不再缓存
+            if self._user_versions.get(user_id, 0) != version:
+                version = None
+        
+        user_memories = self.memories.get(user_id, {})
+        if self.search_mode == "ranked":
+            keys, total = self._get_search_index(user_id).rank(
+                keyword, user_memories, limit, hits=hit_keys, fuzzy=self.search_fuzzy
+            )
+            results = [(key, user_memories[key]) for key in keys]
+        elif self.search_mode == "similarity":
+            keys, total = self._get_vector_index(user_id).rank(keyword, limit)
+            results = [(key, user_memories[key]) for key in keys]
+        elif hit_keys is not None:
+            results = [(key, user_memories[key]) for key in hit_keys]
+            total = len(results)
+        else:
+            results = self._search_memories(user_id, keyword)
+            total = len(results)
+        
+        if version is not None:
+            user_cache[keyword] = (version, results, total)
+            while len(user_cache) > self.search_cache_size:
+                user_cache.popitem(last=False)
+        if self._metrics is not None:
+            self._metrics.inc("search_cache", "miss")
+            self._metrics.observe("search", time.perf_counter() - started, self.search_mode)
+        return results, total
+    
+    async def _search_store(self, user_id: str, keyword: str) -> List[str]:
+        """通过存储后端的索引搜索，返回按字典顺序排列的命中 key"""
+        try:
+            hit_keys = set(await asyncio.to_thread(self._store.search, user_id, keyword))
+        except Exception as e:
+            logger.error(f"搜索记忆失败: {e}")
+            return [key for key, _ in self._search_memories(user_id, keyword)]
+        
+        # 尚未落盘或正在写入的变更不一定在索引中，这些记忆直接在内存里判断
+        pending_keys = {key for uid, key in self._changes if uid == user_id}
+        pending_keys.update(key for uid, key in self._writing_changes if uid == user_id)
+        keyword = str(keyword).lower()
+        results = []
+        for key, memory in self.memories.get(user_id, {}).items():
+            if key in pending_keys:
+                tags = ' '.join(memory.tags).lower()
+                if keyword in key.lower() or keyword in memory.content.lower() or keyword in tags:
+                    results.append(key)
+            elif key in hit_keys:
+                results.append(key)
+        return results
+    
+    def _get_user_memories(self, user_id: str) -> List[Tuple[str, MemoryRecord]]:
         """获取用户的所有记忆"""
         try:
+            self._ensure_user_loaded(user_id)
             if user_id not in self.memories:
                 return []
             
@@ -192,73 +958,234 @@ class PersonalMemoryPlugin(Star):
             logger.error(f"获取用户记忆失败: {e}")
             return []
     
+    def _get_memory_page(self, user_id: str, page: int) -> Tuple[List[Tuple[str, MemoryRecord]], int]:
+        """按添加顺序取出第 page 页的记忆，返回该页记忆和记忆总数；只遍历到所需页为止"""
+        try:
+            self._ensure_user_loaded(user_id)
+            user_memories = self.memories.get(user_id, {})
+            start = (page - 1) * self.page_size
+            items = list(itertools.islice(user_memories.items(), start, start + self.page_size))
+            return items, len(user_memories)
+        except Exception as e:
+            logger.error(f"获取用户记忆失败: {e}")
+            return [], 0
+    
+    def _page_count(self, total: int) -> int:
+        return max(1, -(-total // self.page_size))
+    
+    def _event_namespace(self, event: AstrMessageEvent, args: str) -> Tuple[Optional[str], bool, str]:
+        """指令使用的命名空间、是否为群共享记忆，以及去掉 @群 标记后的参数
+
+        私聊中指定 @群 时命名空间为 None。
+        """
+        shared, args = split_scope(args)
+        user_id = str(event.get_sender_id())
+        group_id = str(event.get_group_id() or "")
+        if shared:
+            return (namespace_id(SCOPE_GROUP, user_id, group_id) if group_id else None), True, args
+        return namespace_id(self.group_default_scope, user_id, group_id), False, args
+    
+    def _event_namespaces(self, event: AstrMessageEvent) -> List[str]:
+        """消息可以读取的命名空间：默认命名空间，群聊中再加上群共享记忆"""
+        user_id = str(event.get_sender_id())
+        group_id = str(event.get_group_id() or "")
+        namespaces = [namespace_id(self.group_default_scope, user_id, group_id)]
+        if group_id:
+            namespaces.append(namespace_id(SCOPE_GROUP, user_id, group_id))
+        return namespaces
+    
+    @staticmethod
+    def _split_page(text: str) -> Tuple[str, Optional[int]]:
+        """拆出末尾以空格分隔的页码，如 "密码 p2" / "密码 第2页" -> ("密码", 2)；没有页码时返回 (text, None)
+
+        页码必须写成 p2 或 第2页，单独的数字算作关键词的一部分（如 "房间 301"）。
+        """
+        parts = text.rsplit(maxsplit=1)
+        if len(parts) != 2:
+            return text, None
+        token = parts[1]
+        if token[:1] in ("p", "P"):
+            number = token[1:]
+        elif token.startswith("第") and token.endswith("页"):
+            number = token[1:-1]
+        else:
+            return text, None
+        if number.isdigit() and int(number) > 0:
+            return parts[0], int(number)
+        return text, None
+    
     def _delete_memory(self, user_id: str, key: str) -> bool:
         """删除记忆"""
         try:
+            self._ensure_user_loaded(user_id)
             if user_id in self.memories and key in self.memories[user_id]:
-                del self.memories[user_id][key]
-                self._save_memories()
+                self._track_resident_bytes(
+                    user_id, -self._estimate_memory_bytes(key, self.memories[user_id][key])
+                )
+                CONTENTS.release(self.memories[user_id].pop(key).content)
+                self._unindex_memory(user_id, key)
+                self._usage.discard(user_id, key)
+                if user_id in self._eviction_queues:
+                    self._eviction_queues[user_id].remove(key)
+                self._save_memories(user_id, key, CHANGE_DEL)
                 return True
             return False
         except Exception as e:
             logger.error(f"删除记忆失败: {e}")
             return False
     
+    def _schedule(self, user_id: str, key: str, memory: MemoryRecord):
+        """登记记忆的过期和提醒时间，比当前最早的定时更早时唤醒后台任务"""
+        earliest = False
+        if memory.expires is not None:
+            earliest |= self._timers.push(memory.expires, TIMER_EXPIRE, user_id, key)
+        if memory.remind is not None:
+            earliest |= self._timers.push(memory.remind[0], TIMER_REMIND, user_id, key)
+        if earliest and self._timer_event is not None:
+            self._timer_event.set()
+    
+    def _schedule_user(self, user_id: str, user_memories: Dict[str, MemoryRecord]):
+        for key, memory in user_memories.items():
+            if memory.expires is not None or memory.remind is not None:
+                self._schedule(user_id, key, memory)
+    
+    def _ensure_timer_task(self) -> bool:
+        """确保定时任务正在运行"""
+        if self._timer_task is not None and not self._timer_task.done():
+            return True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        if self._timer_event is None:
+            self._timer_event = asyncio.Event()
+        self._timer_task = loop.create_task(self._timer_loop())
+        return True
+    
+    async def _timer_loop(self):
+        """睡到最早的定时到期（或登记了更早的定时），再处理所有已到期的定时"""
+        await self._wait_ready()
+        while not self._stopping:
+            try:
+                self._timer_event.clear()
+                delay = self.timer_check_interval
+                next_due = self._timers.next_due()
+                if next_due is not None:
+                    delay = min(delay, max(next_due * 60 - time.time(), 0))
+                # 不用 wait_for：Python 3.11 及以前，内层等待恰好完成时到达的取消会被它吞掉
+                waiter = asyncio.ensure_future(self._timer_event.wait())
+                try:
+                    await asyncio.wait({waiter}, timeout=delay)
+                finally:
+                    waiter.cancel()
+                if self._stopping:
+                    break
+                await self._fire_timers()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"处理定时记忆失败: {e}")
+    
+    async def _fire_timers(self):
+        """删除到期的记忆、发送到期的提醒；条目与记忆当前的时间不一致时说明已改期或删除，直接丢弃"""
+        reminders = []
+        fired = False
+        for due, kind, user_id, key in self._timers.pop_due(now_minutes()):
+            async with self._user_lock(user_id):
+                await self._preload_user(user_id)
+                memory = self.memories.get(user_id, {}).get(key)
+                if memory is None:
+                    continue
+                if kind == TIMER_EXPIRE and memory.expires == due:
+                    self._delete_memory(user_id, key)
+                elif kind == TIMER_REMIND and memory.remind is not None and memory.remind[0] == due:
+                    reminders.append((memory.remind[1], key, memory.content))
+                    memory.remind = None
+                    self._save_memories(user_id, key, CHANGE_PUT)
+                else:
+                    continue
+                fired = True
+                if self._metrics is not None:
+                    self._metrics.inc("timers", kind)
+        
+        if fired:
+            # 尽快落盘，共用数据目录的其他进程重新加载后就不会再处理同一个定时
+            await self._write_pending()
+        for origin, key, content in reminders:
+            try:
+                await self.context.send_message(origin, MessageChain().message(f"⏰ 提醒 {key}: {content}"))
+            except Exception as e:
+                logger.error(f"发送提醒失败: {e}")
+    
     @filter.command("记住")
+    @admission_controlled
+    @instrument_handler("记住")
     async def add_memory_command(self, event: AstrMessageEvent):
         """添加记忆指令
-        用法: /记住 关键词 内容
-        示例: /记住 生日 2024年12月25日
+        用法: /记住 关键词 内容 [#标签] [#ttl=时长] [#remind=时间]
+        示例: /记住 生日 2024年12月25日 #重要
+        示例: /记住 会议 明天3点 #ttl=1d #remind=15:00
         """
         try:
             message = event.message_str.strip()
             if not message.startswith("记住"):
                 return
             
-            content = message[2:].strip()
+            user_id, shared, content = self._event_namespace(event, message[2:].strip())
+            if user_id is None:
+                yield await self._card_result(event, GROUP_ONLY_MESSAGE,
+                                              "错误", GROUP_ONLY_MESSAGE[2:], action="添加失败")
+                return
             if not content:
-                if HAS_PILLOW:
-                    img_path = self._create_memory_card("错误", "格式错误！用法: /记住 关键词 内容", action="添加失败")
-                    yield event.image_result(img_path)
-                else:
-                    yield event.plain_result("❌ 格式错误！用法: /记住 关键词 内容")
+                yield await self._card_result(event, "❌ 格式错误！用法: /记住 关键词 内容",
+                                              "错误", "格式错误！用法: /记住 关键词 内容", action="添加失败")
                 return
 
             parts = content.split(None, 1)
             if len(parts) < 2:
-                if HAS_PILLOW:
-                    img_path = self._create_memory_card("错误", "格式错误！用法: /记住 关键词 内容", action="添加失败")
-                    yield event.image_result(img_path)
-                else:
-                    yield event.plain_result("❌ 格式错误！用法: /记住 关键词 内容")
+                yield await self._card_result(event, "❌ 格式错误！用法: /记住 关键词 内容",
+                                              "错误", "格式错误！用法: /记住 关键词 内容", action="添加失败")
                 return
 
             key, value = parts[0], parts[1]
-            user_id = event.get_sender_id()
+            value, tags = split_tags(value)
+            try:
+                tags, expires, remind_at = split_timer_tags(tags, datetime.now())
+            except ValueError as e:
+                yield await self._card_result(event, f"❌ {e}", "错误", str(e), action="添加失败")
+                return
+            if not value:
+                yield await self._card_result(event, "❌ 格式错误！用法: /记住 关键词 内容",
+                                              "错误", "格式错误！用法: /记住 关键词 内容", action="添加失败")
+                return
+            remind = (remind_at, event.unified_msg_origin) if remind_at is not None else None
+
             user_name = event.get_sender_name() or "用户"
+            async with self._user_lock(user_id):
+                await self._preload_user(user_id)
+                added = self._add_memory(user_id, key, value, tags, expires, remind)
 
-            if self._add_memory(user_id, key, value):
-                if HAS_PILLOW:
-                    img_path = self._create_memory_card(key, value, action="记住", user_name=user_name)
-                    yield event.image_result(img_path)
-                else:
-                    yield event.plain_result(f"✅ 已记住: {key}")
+            if added:
+                notes = []
+                if expires is not None:
+                    notes.append(f"⏳ {format_minutes(expires).replace('T', ' ')} 过期")
+                if remind_at is not None:
+                    notes.append(f"⏰ {format_minutes(remind_at).replace('T', ' ')} 提醒")
+                text = f"✅ 已记住: {key}" + (f"（{'，'.join(notes)}）" if notes else "")
+                yield await self._card_result(event, text, key, "\n".join([value] + notes),
+                                              tags=tags, action="记住", user_name=user_name)
             else:
-                if HAS_PILLOW:
-                    img_path = self._create_memory_card("错误", "添加失败，请重试", action="添加失败")
-                    yield event.image_result(img_path)
-                else:
-                    yield event.plain_result("❌ 添加失败，请重试")
+                yield await self._card_result(event, "❌ 添加失败，请重试",
+                                              "错误", "添加失败，请重试", action="添加失败")
 
         except Exception as e:
             logger.error(f"添加记忆指令错误: {e}")
-            if HAS_PILLOW:
-                img_path = self._create_memory_card("错误", "系统错误，请稍后重试", action="添加失败")
-                yield event.image_result(img_path)
-            else:
-                yield event.plain_result("❌ 系统错误，请稍后重试")
+            yield await self._card_result(event, "❌ 系统错误，请稍后重试",
+                                          "错误", "系统错误，请稍后重试", action="添加失败")
 
     @filter.command("回忆")
+    @admission_controlled
+    @instrument_handler("回忆")
     async def get_memory_command(self, event: AstrMessageEvent):
         """获取记忆指令
         用法: /回忆 关键词
@@ -269,44 +1196,43 @@ class PersonalMemoryPlugin(Star):
             if not message.startswith("回忆"):
                 return
 
-            key = message[2:].strip()
+            user_id, shared, key = self._event_namespace(event, message[2:].strip())
+            if user_id is None:
+                yield await self._card_result(event, GROUP_ONLY_MESSAGE,
+                                              "错误", GROUP_ONLY_MESSAGE[2:], action="回忆失败")
+                return
             if not key:
-                if HAS_PILLOW:
-                    img_path = self._create_memory_card("错误", "格式错误！用法: /回忆 关键词", action="回忆失败")
-                    yield event.image_result(img_path)
-                else:
-                    yield event.plain_result("❌ 格式错误！用法: /回忆 关键词")
+                yield await self._card_result(event, "❌ 格式错误！用法: /回忆 关键词",
+                                              "错误", "格式错误！用法: /回忆 关键词", action="回忆失败")
                 return
 
-            user_id = event.get_sender_id()
             user_name = event.get_sender_name() or "用户"
+            await self._preload_user(user_id)
             memory = self._get_memory(user_id, key)
+            if memory is None and not shared:
+                # 自己没有时在群聊中再查群共享记忆
+                for namespace in self._event_namespaces(event)[1:]:
+                    await self._preload_user(namespace)
+                    memory = self._get_memory(namespace, key)
 
             if memory:
-                if HAS_PILLOW:
-                    img_path = self._create_memory_card(key, memory['content'], action="回忆", user_name=user_name)
-                    yield event.image_result(img_path)
-                else:
-                    yield event.plain_result(f"📋 {key}: {memory['content']}")
+                yield await self._card_result(event, f"📋 {key}: {memory.content}",
+                                              key, memory.content, action="回忆", user_name=user_name)
             else:
-                if HAS_PILLOW:
-                    img_path = self._create_memory_card("未找到", f"没有找到关于 '{key}' 的记忆", action="回忆失败")
-                    yield event.image_result(img_path)
-                else:
-                    yield event.plain_result("❌ 没有找到相关记忆")
+                yield await self._card_result(event, "❌ 没有找到相关记忆",
+                                              "未找到", f"没有找到关于 '{key}' 的记忆", action="回忆失败")
 
         except Exception as e:
             logger.error(f"获取记忆指令错误: {e}")
-            if HAS_PILLOW:
-                img_path = self._create_memory_card("错误", "系统错误，请稍后重试", action="回忆失败")
-                yield event.image_result(img_path)
-            else:
-                yield event.plain_result("❌ 系统错误，请稍后重试")
+            yield await self._card_result(event, "❌ 系统错误，请稍后重试",
+                                          "错误", "系统错误，请稍后重试", action="回忆失败")
 
     @filter.command("搜索记忆")
+    @admission_controlled
+    @instrument_handler("搜索记忆")
     async def search_memory_command(self, event: AstrMessageEvent):
         """搜索记忆指令
-        用法: /搜索记忆 关键词
+        用法: /搜索记忆 关键词 [p页码]
         示例: /搜索记忆 密码
         """
         try:
@@ -314,88 +1240,111 @@ class PersonalMemoryPlugin(Star):
             if not message.startswith("搜索记忆"):
                 return
 
-            keyword = message[4:].strip()
+            user_id, shared, keyword = self._event_namespace(event, message[4:].strip())
+            if user_id is None:
+                yield await self._card_result(event, GROUP_ONLY_MESSAGE,
+                                              "错误", GROUP_ONLY_MESSAGE[2:], action="搜索失败")
+                return
             if not keyword:
-                if HAS_PILLOW:
-                    img_path = self._create_memory_card("错误", "格式错误！用法: /搜索记忆 关键词", action="搜索失败")
-                    yield event.image_result(img_path)
-                else:
-                    yield event.plain_result("❌ 格式错误！用法: /搜索记忆 关键词")
+                yield await self._card_result(event, "❌ 格式错误！用法: /搜索记忆 关键词",
+                                              "错误", "格式错误！用法: /搜索记忆 关键词", action="搜索失败")
                 return
 
-            user_id = event.get_sender_id()
+            keyword, page = self._split_page(keyword)
+            page = page or 1
+
             user_name = event.get_sender_name() or "用户"
-            results = self._search_memories(user_id, keyword)
+            await self._preload_user(user_id)
+            results, total = await self._find_memories(user_id, keyword, page * self.page_size)
 
             if not results:
-                if HAS_PILLOW:
-                    img_path = self._create_memory_card("未找到", f"没有找到关于 '{keyword}' 的记忆", action="搜索失败")
-                    yield event.image_result(img_path)
-                else:
-                    yield event.plain_result("❌ 没有找到相关记忆")
+                yield await self._card_result(event, "❌ 没有找到相关记忆",
+                                              "未找到", f"没有找到关于 '{keyword}' 的记忆", action="搜索失败")
                 return
 
-            if HAS_PILLOW:
-                img_path = self._create_memory_list_image(results, user_name)
-                yield event.image_result(img_path)
-            else:
-                response = f"🔍 找到 {len(results)} 条相关记忆:\n"
-                for key, memory in results[:10]:
-                    response += f"- {key}: {memory['content']}\n"
+            page_count = self._page_count(total)
+            start = (page - 1) * self.page_size
+            page_results = results[start:start + self.page_size]
+            if not page_results:
+                yield await self._card_result(event, f"❌ 页码超出范围，共 {page_count} 页",
+                                              "错误", f"页码超出范围，共 {page_count} 页", action="搜索失败")
+                return
 
-                if len(results) > 10:
-                    response += f"... 还有 {len(results) - 10} 条"
+            scope_arg = f"{GROUP_MARKER} " if shared else ""
+            response = f"🔍 找到 {total} 条相关{'群共享' if shared else ''}记忆:\n"
+            for key, memory in page_results:
+                response += f"- {key}: {memory.content}\n"
 
-                yield event.plain_result(response.strip())
+            if page < page_count:
+                response += f"... 还有 {total - start - len(page_results)} 条，发送 /搜索记忆 {scope_arg}{keyword} p{page + 1} 查看下一页"
+
+            yield await self._list_result(event, response.strip(), page_results, user_name, total=total,
+                                          user_id=user_id, page=page, page_count=page_count)
 
         except Exception as e:
             logger.error(f"搜索记忆指令错误: {e}")
-            if HAS_PILLOW:
-                img_path = self._create_memory_card("错误", "系统错误，请稍后重试", action="搜索失败")
-                yield event.image_result(img_path)
-            else:
-                yield event.plain_result("❌ 系统错误，请稍后重试")
+            yield await self._card_result(event, "❌ 系统错误，请稍后重试",
+                                          "错误", "系统错误，请稍后重试", action="搜索失败")
 
     @filter.command("我的记忆")
+    @admission_controlled
+    @instrument_handler("我的记忆")
     async def list_memories_command(self, event: AstrMessageEvent):
         """列出所有记忆指令
-        用法: /我的记忆
+        用法: /我的记忆 [页码]
         """
         try:
-            user_id = event.get_sender_id()
+            message = event.message_str.strip()
+            args = message[4:].strip() if message.startswith("我的记忆") else ""
+            user_id, shared, arg = self._event_namespace(event, args)
+            if user_id is None:
+                yield await self._card_result(event, GROUP_ONLY_MESSAGE,
+                                              "错误", GROUP_ONLY_MESSAGE[2:], action="我的记忆")
+                return
+            page = 1
+            if arg:
+                page = int(arg) if arg.isdigit() else 0
+                if page < 1:
+                    yield await self._card_result(event, "❌ 格式错误！用法: /我的记忆 页码",
+                                                  "错误", "格式错误！用法: /我的记忆 页码", action="我的记忆")
+                    return
+
             user_name = event.get_sender_name() or "用户"
-            memories = self._get_user_memories(user_id)
+            await self._preload_user(user_id)
+            memories, total = self._get_memory_page(user_id, page)
+            owner = "本群" if shared else "你"
 
+            if not total:
+                yield await self._card_result(event, f"📭 {owner}还没有任何{'共享' if shared else ''}记忆",
+                                              "提示", f"{owner}还没有任何{'共享' if shared else ''}记忆",
+                                              action="我的记忆")
+                return
+
+            page_count = self._page_count(total)
             if not memories:
-                if HAS_PILLOW:
-                    img_path = self._create_memory_card("提示", "你还没有任何记忆", action="我的记忆")
-                    yield event.image_result(img_path)
-                else:
-                    yield event.plain_result("📭 你还没有任何记忆")
+                yield await self._card_result(event, f"❌ 页码超出范围，共 {page_count} 页",
+                                              "错误", f"页码超出范围，共 {page_count} 页", action="我的记忆")
                 return
 
-            if HAS_PILLOW:
-                img_path = self._create_memory_list_image(memories, user_name)
-                yield event.image_result(img_path)
-            else:
-                response = f"📚 你共有 {len(memories)} 条记忆:\n"
-                for key, memory in memories[:10]:
-                    response += f"- {key}: {memory['content']}\n"
+            response = f"📚 {owner}共有 {total} 条{'共享' if shared else ''}记忆:\n"
+            for key, memory in memories:
+                response += f"- {key}: {memory.content}\n"
 
-                if len(memories) > 10:
-                    response += f"... 还有 {len(memories) - 10} 条"
+            if page < page_count:
+                shown = (page - 1) * self.page_size + len(memories)
+                response += f"... 还有 {total - shown} 条，发送 /我的记忆 {GROUP_MARKER + ' ' if shared else ''}{page + 1} 查看下一页"
 
-                yield event.plain_result(response.strip())
+            yield await self._list_result(event, response.strip(), memories, user_name, total=total,
+                                          user_id=user_id, page=page, page_count=page_count)
 
         except Exception as e:
             logger.error(f"列出记忆指令错误: {e}")
-            if HAS_PILLOW:
-                img_path = self._create_memory_card("错误", "系统错误，请稍后重试", action="我的记忆")
-                yield event.image_result(img_path)
-            else:
-                yield event.plain_result("❌ 系统错误，请稍后重试")
+            yield await self._card_result(event, "❌ 系统错误，请稍后重试",
+                                          "错误", "系统错误，请稍后重试", action="我的记忆")
 
     @filter.command("删除记忆")
+    @admission_controlled
+    @instrument_handler("删除记忆")
     async def delete_memory_command(self, event: AstrMessageEvent):
         """删除记忆指令
         用法: /删除记忆 关键词
@@ -406,182 +1355,440 @@ class PersonalMemoryPlugin(Star):
             if not message.startswith("删除记忆"):
                 return
 
-            key = message[4:].strip()
+            user_id, shared, key = self._event_namespace(event, message[4:].strip())
+            if user_id is None:
+                yield await self._card_result(event, GROUP_ONLY_MESSAGE,
+                                              "错误", GROUP_ONLY_MESSAGE[2:], action="删除失败")
+                return
             if not key:
-                if HAS_PILLOW:
-                    img_path = self._create_memory_card("错误", "格式错误！用法: /删除记忆 关键词", action="删除失败")
-                    yield event.image_result(img_path)
-                else:
-                    yield event.plain_result("❌ 格式错误！用法: /删除记忆 关键词")
+                yield await self._card_result(event, "❌ 格式错误！用法: /删除记忆 关键词",
+                                              "错误", "格式错误！用法: /删除记忆 关键词", action="删除失败")
                 return
 
-            user_id = event.get_sender_id()
-            user_name = event.get_sender_name() or "用户"
+            async with self._user_lock(user_id):
+                await self._preload_user(user_id)
+                deleted = self._delete_memory(user_id, key)
 
-            if self._delete_memory(user_id, key):
-                if HAS_PILLOW:
-                    img_path = self._create_memory_card("成功", f"已删除记忆: {key}", action="删除成功")
-                    yield event.image_result(img_path)
-                else:
-                    yield event.plain_result(f"✅ 已删除记忆: {key}")
+            if deleted:
+                yield await self._card_result(event, f"✅ 已删除记忆: {key}",
+                                              "成功", f"已删除记忆: {key}", action="删除成功")
             else:
-                if HAS_PILLOW:
-                    img_path = self._create_memory_card("未找到", f"没有找到关于 '{key}' 的记忆", action="删除失败")
-                    yield event.image_result(img_path)
-                else:
-                    yield event.plain_result("❌ 没有找到相关记忆")
+                yield await self._card_result(event, "❌ 没有找到相关记忆",
+                                              "未找到", f"没有找到关于 '{key}' 的记忆", action="删除失败")
 
         except Exception as e:
             logger.error(f"删除记忆指令错误: {e}")
-            if HAS_PILLOW:
-                img_path = self._create_memory_card("错误", "系统错误，请稍后重试", action="删除失败")
-                yield event.image_result(img_path)
+            yield await self._card_result(event, "❌ 系统错误，请稍后重试",
+                                          "错误", "系统错误，请稍后重试", action="删除失败")
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("导出记忆")
+    @instrument_handler("导出记忆")
+    async def export_memories_command(self, event: AstrMessageEvent):
+        """导出全部记忆为 NDJSON（管理员）
+        用法: /导出记忆
+        """
+        if self._transfer_running:
+            yield event.plain_result("❌ 已有导入或导出任务在进行")
+            return
+        self._transfer_running = True
+        try:
+            os.makedirs(self.export_dir, exist_ok=True)
+            filename = f"memories_{datetime.now().strftime('%Y%m%d_%H%M%S')}.ndjson"
+            count = await self._export_memories(os.path.join(self.export_dir, filename))
+            yield event.plain_result(f"✅ 已导出 {count} 个用户的记忆: {filename}")
+        except Exception as e:
+            logger.error(f"导出记忆失败: {e}")
+            yield event.plain_result("❌ 导出失败，请查看日志")
+        finally:
+            self._transfer_running = False
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("导入记忆")
+    @instrument_handler("导入记忆")
+    async def import_memories_command(self, event: AstrMessageEvent):
+        """从 NDJSON 导入记忆（管理员），同名记忆会被覆盖
+        用法: /导入记忆 文件名（文件需放在插件 data/exports 目录下）
+        """
+        message = event.message_str.strip()
+        filename = os.path.basename(message[4:].strip()) if message.startswith("导入记忆") else ""
+        path = os.path.join(self.export_dir, filename)
+        if not filename or not os.path.isfile(path):
+            yield event.plain_result("❌ 用法: /导入记忆 文件名（文件需放在插件 data/exports 目录下）")
+            return
+        if self._transfer_running:
+            yield event.plain_result("❌ 已有导入或导出任务在进行")
+            return
+        self._transfer_running = True
+        try:
+            stats = await self._import_memories(path)
+            yield event.plain_result(f"✅ 已导入 {stats}")
+        except Exception as e:
+            logger.error(f"导入记忆失败: {e}")
+            yield event.plain_result("❌ 导入失败，请查看日志")
+        finally:
+            self._transfer_running = False
+
+    async def _export_memories(self, path: str) -> int:
+        """导出全部用户，返回导出的用户数"""
+        await self._wait_ready()
+        self._flush_usage()
+        await self._write_pending()
+        if self._store.lazy:
+            # 懒加载存储逐个用户从存储读取，全部在线程池中执行
+            return await asyncio.to_thread(export_store, self._store, path)
+        
+        # 整体存储的记忆全部常驻内存：在事件循环内逐批序列化，写文件放到线程池
+        tmp_path = f"{path}.tmp"
+        count = 0
+        user_ids = list(self.memories.keys())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for start in range(0, len(user_ids), self.import_batch_size):
+                lines = [
+                    user_line(user_id, self.memories[user_id])
+                    for user_id in user_ids[start:start + self.import_batch_size]
+                    if self.memories.get(user_id)
+                ]
+                await asyncio.to_thread(f.writelines, lines)
+                count += len(lines)
+        os.replace(tmp_path, path)
+        return count
+    
+    async def _import_memories(self, path: str) -> ImportStats:
+        """逐批导入 NDJSON，记忆按加载时的规则校验，每批只保存一次"""
+        stats = ImportStats()
+        reader = read_ndjson(path, stats)
+        while True:
+            batch = await asyncio.to_thread(read_batch, reader, self.import_batch_size)
+            if not batch:
+                break
+            for user_id, raw_memories in batch:
+                imported = clean_import(raw_memories, self.max_key_length, self.max_content_length)
+                if not imported:
+                    continue
+                async with self._user_lock(user_id):
+                    await self._preload_user(user_id)
+                    for key, record in imported.items():
+                        self._put_record(user_id, key, record, touched=False)
+                stats.users += 1
+                stats.memories += len(imported)
+            await self._write_pending()
+        return stats
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("记忆状态")
+    @instrument_handler("记忆状态")
+    async def status_command(self, event: AstrMessageEvent):
+        """查看插件运行状态和指标（管理员）
+        用法: /记忆状态
+        """
+        try:
+            gauges = await self._metric_gauges()
+            lines = ["📈 记忆插件状态"]
+            if self._metrics is None:
+                lines += [f"{name}: {value:g}" for name, value in gauges.items()]
+                lines.append("运行指标未开启（metrics_enabled）")
             else:
-                yield event.plain_result("❌ 系统错误，请稍后重试")
+                lines += self._metrics.summary(gauges)
+            yield event.plain_result("\n".join(lines))
+        except Exception as e:
+            logger.error(f"记忆状态指令错误: {e}")
+            yield event.plain_result("❌ 系统错误，请稍后重试")
 
+    async def _metric_gauges(self) -> Dict[str, float]:
+        """瞬时指标；临时目录大小在线程池中统计，其余在事件循环内直接读取"""
+        await self._wait_ready()
+        if self._store.lazy:
+            heap_bytes = self._resident_total
+        else:
+            heap_bytes = sum(
+                self._estimate_memory_bytes(key, memory)
+                for user_memories in self.memories.values()
+                for key, memory in user_memories.items()
+            )
+        gauges = {
+            "users_resident": len(self.memories),
+            "memories_resident": sum(len(user_memories) for user_memories in self.memories.values()),
+            "heap_estimate_bytes": heap_bytes,
+            "pending_changes": len(self._changes) + len(self._usage),
+            "timers_pending": len(self._timers),
+            "shared_contents": CONTENTS.shared,
+            "shared_content_saved_chars": CONTENTS.saved_chars,
+        }
+        gauges["temp_dir_bytes"] = await asyncio.to_thread(self._temp_store.total_bytes)
+        return gauges
+    
+    def _ensure_metrics_task(self):
+        """配置了指标文件时确保定期写出任务正在运行"""
+        if self._metrics is None or not self.metrics_dump_path:
+            return
+        if self._metrics_task is None or self._metrics_task.done():
+            self._metrics_task = asyncio.get_running_loop().create_task(self._metrics_dump_loop())
+    
+    async def _metrics_dump_loop(self):
+        """每 metrics_dump_interval 秒写出一次指标文件"""
+        while True:
+            try:
+                text = self._metrics.exposition(await self._metric_gauges())
+                await asyncio.to_thread(write_file_replace, self.metrics_dump_path, text)
+            except Exception as e:
+                logger.error(f"写出运行指标失败: {e}")
+            await asyncio.sleep(self.metrics_dump_interval)
+
+    @filter.on_llm_request()
+    async def inject_memories(self, event: AstrMessageEvent, req: ProviderRequest):
+        """调用大模型前把与消息相关的记忆加在提示词前面；群聊中同时查找群共享记忆"""
+        if not self.llm_inject_enabled or not req.prompt:
+            return
+        started = time.perf_counter()
+        outcome = "miss"
+        try:
+            query = req.prompt[-self.llm_inject_query_chars:]
+            namespaces = self._event_namespaces(event)
+            # 查找在后台继续，超时只是本次不等待，下一条消息即可用上已加载的记忆
+            await asyncio.wait_for(
+                asyncio.shield(asyncio.gather(*(self._preload_user(namespace) for namespace in namespaces))),
+                self.llm_inject_timeout
+            )
+            header = "以下是用户保存的相关记忆，回答时可参考："
+            lines = []
+            budget = self.llm_inject_max_chars - len(header)
+            outcomes = set()
+            for namespace in namespaces:
+                candidates, namespace_outcome = self._memory_context(namespace, query)
+                outcomes.add(namespace_outcome)
+                for line in candidates:
+                    # 放不下的记忆跳过，后面较短的仍可放入
+                    if len(line) + 1 > budget:
+                        continue
+                    lines.append(line)
+                    budget -= len(line) + 1
+            outcome = "miss" if "miss" in outcomes else "hit" if "hit" in outcomes else "empty"
+            if lines:
+                context = "\n".join([header] + lines)
+                req.prompt = f"{context}\n\n{req.prompt}"
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+        except Exception as e:
+            outcome = "error"
+            logger.error(f"注入记忆失败: {e}")
+        finally:
+            if self._metrics is not None:
+                self._metrics.inc("llm_inject", outcome)
+                self._metrics.observe("llm_inject", time.perf_counter() - started, outcome)
+    
+    def _memory_context(self, user_id: str, query: str) -> Tuple[List[str], str]:
+        """一个命名空间中与消息相关的记忆（每条一行），以及是否命中缓存"""
+        user_memories = self.memories.get(user_id)
+        if not user_memories:
+            return [], "empty"
+        
+        # 以消息中出现在索引里的 bigram 为缓存键：措辞不同但命中相同的消息共用候选，
+        # 与任何记忆都无关的消息都落在空集上
+        index = self._get_search_index(user_id)
+        grams = index.text_grams(query)
+        version = self._user_versions.get(user_id, 0)
+        user_cache = self._context_cache.setdefault(user_id, OrderedDict())
+        cached = user_cache.get(grams)
+        if cached is not None and cached[0] == version:
+            user_cache.move_to_end(grams)
+            candidates, status = cached[1], "hit"
+        else:
+            candidates, status = index.related_candidates(grams, self.llm_inject_limit), "miss"
+            user_cache[grams] = (version, candidates)
+            while len(user_cache) > self.llm_inject_cache_size:
+                user_cache.popitem(last=False)
+        
+        prefix = "[群共享] " if is_group_namespace(user_id) else ""
+        lines = [
+            f"- {prefix}{key}: {user_memories[key].content}"
+            for key in index.rank_related(query, candidates, self.llm_inject_limit)
+        ]
+        return lines, status
+
+    async def _stop_writer_task(self, task: Optional[asyncio.Task]):
+        """停止会调用 _write_pending 的后台任务
+
+        持有写锁时取消，取消只会落在两次写入之间，不会打断线程池中正在进行的提交
+        （否则线程继续写、这批变更既不重试也没人等待，关闭时的保存还可能被它覆盖）。
+        """
+        if task is None:
+            return
+        async with self._write_lock:
+            task.cancel()
+        done, _ = await asyncio.wait({task}, timeout=self.stop_timeout)
+        if not done:
+            logger.warning(f"后台任务 {self.stop_timeout} 秒内未停止，不再等待")
+        elif not task.cancelled() and task.exception() is not None:
+            logger.error(f"后台任务异常退出: {task.exception()}")
+    
     async def terminate(self):
         """插件卸载时保存数据并清理临时文件"""
-        self._save_memories()
+        # 加载未完成时保存会用不完整的内存数据覆盖存储
+        await self._wait_ready()
+        self._stopping = True
+        if self._timer_event is not None:
+            self._timer_event.set()
+        await self._stop_writer_task(self._flush_task)
+        self._flush_task = None
+        await self._stop_writer_task(self._timer_task)
+        self._timer_task = None
+        if self._usage_task is not None:
+            self._usage_task.cancel()
+            self._usage_task = None
+        if self._metrics_task is not None:
+            self._metrics_task.cancel()
+            self._metrics_task = None
+        self._flush_usage()
+        await self._write_pending()
+        if self._store is not None and hasattr(self._store, 'close'):
+            self._store.close()
+        
+        self._render_pool.shutdown()
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+            self._sweep_task = None
         
         # 清理临时文件
-        temp_dir = os.path.join(self.data_dir, "temp")
-        if os.path.exists(temp_dir):
+        if os.path.exists(self.temp_dir):
             try:
                 import shutil
-                shutil.rmtree(temp_dir)
+                shutil.rmtree(self.temp_dir)
                 logger.info("个人记忆插件临时文件已清理")
             except Exception as e:
                 logger.error(f"清理临时文件失败: {e}")
         
         logger.info("个人记忆插件已卸载，数据已保存")
     
-    def _create_memory_card(self, title: str, content: str, tags: List[str] = None, 
-                          action: str = "记住", user_name: str = "用户") -> str:
-        """创建记忆卡片图片"""
+    async def _render_image(self, kind: str, func, *args, owner: str = None):
+        """在渲染执行器中生成卡片（card）或列表（list）图片，返回图片路径或字节；
+        队列已满、超时或失败时返回 None
+
+        图片以渲染输入的哈希命名，命中缓存时不再渲染；
+        相同输入的并发请求共用同一次渲染。
+        """
         if not HAS_PILLOW:
-            return f"{action}成功！\n{title}: {content}"
+            return None
+        if self._render_pool.saturated:
+            if self._metrics is not None:
+                self._metrics.inc("render_degraded", "text")
+            return None
+        self._ensure_sweep_task()
+        prefix = f"memory_{kind}"
+        encoding = choose_encoding(self.image_encode_budget, kind)
+        args = (encoding,) + args
+        key = render_key(prefix, *args)
+        cached = self._render_cache.get(prefix, key, encoding.extension)
+        if cached is not None:
+            if self._metrics is not None:
+                self._metrics.inc("render_cache", "hit")
+            return cached
+        
+        inflight = self._render_inflight.get(key)
+        if inflight is not None:
+            if self._metrics is not None:
+                self._metrics.inc("render_cache", "coalesced")
+            return await asyncio.shield(inflight)
+        if self._render_pool.pending >= self.render_degrade_pending > 0:
+            if self._metrics is not None:
+                self._metrics.inc("render_degraded", "cached")
+            return None
+        if self._metrics is not None:
+            self._metrics.inc("render_cache", "miss")
         
+        future = asyncio.get_running_loop().create_future()
+        self._render_inflight[key] = future
+        img_path = None
         try:
-            # 计算图片高度
-            lines = len(content) // 30 + 2
-            height = max(200, min(400, 150 + lines * 20))
-            
-            # 创建图片
-            img = Image.new('RGB', (self.card_width, height), self.bg_color)
-            draw = ImageDraw.Draw(img)
-            
-            # 使用默认字体
-            try:
-                title_font = ImageFont.truetype("arial.ttf", 24)
-                content_font = ImageFont.truetype("arial.ttf", 16)
-                tag_font = ImageFont.truetype("arial.ttf", 12)
-            except:
-                title_font = ImageFont.load_default()
-                content_font = ImageFont.load_default()
-                tag_font = ImageFont.load_default()
-            
-            # 绘制标题背景
-            draw.rectangle([(0, 0), (self.card_width, 60)], fill=self.primary_color)
-            
-            # 绘制标题
-            title_text = f"🧠 {action}成功"
-            draw.text((20, 15), title_text, fill='white', font=title_font)
-            
-            # 绘制关键词
-            draw.text((20, 80), f"关键词：{title}", fill=self.text_color, font=content_font)
-            
-            # 绘制内容
-            content_lines = [content[i:i+40] for i in range(0, len(content), 40)]
-            y_pos = 110
-            for line in content_lines[:3]:  # 最多3行
-                draw.text((20, y_pos), line, fill=self.text_color, font=content_font)
-                y_pos += 25
-            
-            # 绘制标签
-            if tags:
-                tag_text = "标签：" + " ".join([f"#{tag}" for tag in tags])
-                draw.text((20, y_pos + 10), tag_text, fill=self.muted_color, font=tag_font)
-            
-            # 绘制时间
-            time_text = datetime.now().strftime("%Y-%m-%d %H:%M")
-            draw.text((self.card_width - 150, height - 30), time_text, fill=self.muted_color, font=tag_font)
-            
-            # 保存为临时文件
-            temp_dir = os.path.join(self.data_dir, "temp")
-            if not os.path.exists(temp_dir):
-                os.makedirs(temp_dir)
-            
-            temp_path = os.path.join(temp_dir, f"memory_card_{int(time.time() * 1000)}.png")
-            img.save(temp_path, format='PNG', quality=85, optimize=True)
-            
-            return temp_path
-            
+            if self.image_delivery == "base64":
+                output_path = None
+            else:
+                output_path = self._render_cache.path_for(prefix, key, encoding.extension)
+            img_path = await self._render_image_uncached(func, output_path, *args)
+            if img_path is not None:
+                self._render_cache.put(key, img_path, owner)
+        finally:
+            del self._render_inflight[key]
+            future.set_result(img_path)
+        return img_path
+    
+    async def _render_image_uncached(self, func, output_path: Optional[str], *args):
+        started = time.perf_counter()
+        try:
+            image, info = await self._render_pool.run(func, output_path, *args)
+            self._record_encode(info)
+            if self._metrics is not None:
+                self._metrics.observe("render", time.perf_counter() - started, func.__name__)
+            return image
+        except RenderSaturated:
+            logger.warning("图片渲染队列已满，改用文本回复")
+            fallback = "saturated"
+        except asyncio.TimeoutError:
+            logger.warning("图片渲染超时，改用文本回复")
+            fallback = "timeout"
         except Exception as e:
             logger.error(f"创建图片失败: {e}")
-            return f"{action}成功！\n{title}: {content}"
+            fallback = "error"
+        if self._metrics is not None:
+            self._metrics.inc("render_fallbacks", fallback)
+        return None
     
-    def _create_memory_list_image(self, memories: List[Tuple[str, Dict]], user_name: str = "用户") -> str:
-        """创建记忆列表图片"""
-        if not HAS_PILLOW:
-            response = f"📚 {user_name}的记忆列表：\n"
-            for key, memory in memories:
-                response += f"- {key}: {memory['content'][:50]}...\n"
-            return response
-        
-        try:
-            # 计算高度
-            item_height = 80
-            height = 120 + len(memories) * item_height
-            height = min(800, height)
-            
-            img = Image.new('RGB', (self.card_width, height), self.bg_color)
-            draw = ImageDraw.Draw(img)
-            
+    async def _card_result(self, event: AstrMessageEvent, text: str, title: str, content: str,
+                           tags: Tuple[str, ...] = (), action: str = "记住", user_name: str = "用户"):
+        """生成记忆卡片回复，无法出图时使用 text 文本回复"""
+        # 时间精确到分钟并作为渲染输入，同一分钟内的相同卡片可以命中缓存
+        time_text = datetime.now().strftime("%Y-%m-%d %H:%M")
+        img_path = await self._render_image(
+            "card", render_memory_card, self._render_theme(), title, content, tuple(tags),
+            action, user_name, time_text
+        )
+        if img_path:
+            return self._image_reply(event, img_path)
+        return event.plain_result(text)
+    
+    async def _list_result(self, event: AstrMessageEvent, text: str, memories: List[Tuple[str, MemoryRecord]],
+                           user_name: str = "用户", total: int = None, user_id: str = None,
+                           page: int = 1, page_count: int = 1):
+        """生成一页记忆列表回复，无法出图时使用 text 文本回复；user_id 的记忆变化时缓存的列表图片失效"""
+        items = [(key, memory.content, memory.usage_count) for key, memory in memories[:self.page_size]]
+        total = len(memories) if total is None else total
+        img_path = await self._render_image(
+            "list", render_memory_list, self._render_theme(), items, user_name, total, page, page_count,
+            owner=user_id
+        )
+        if img_path:
+            return self._image_reply(event, img_path)
+        return event.plain_result(text)
+    
+    def _record_encode(self, info: EncodeInfo):
+        """按编码方式记录编码耗时和输出字节数"""
+        if self._metrics is not None:
+            self._metrics.observe("encode", info.encode_ms / 1000, info.label)
+            self._metrics.inc("encode_bytes", info.label, info.size)
+        logger.debug(f"图片编码 {info.label}: {info.encode_ms:.1f}ms, {info.size} 字节")
+    
+    def _image_reply(self, event: AstrMessageEvent, image):
+        """图片字节以 base64 消息段发送，图片路径以文件发送"""
+        if isinstance(image, bytes):
+            return event.chain_result([Comp.Image.fromBase64(base64.b64encode(image).decode())])
+        return event.image_result(image)
+    
+    def _ensure_sweep_task(self):
+        """确保临时图片清理任务正在运行"""
+        if self._sweep_task is None or self._sweep_task.done():
+            self._sweep_task = asyncio.get_running_loop().create_task(self._sweep_loop())
+    
+    async def _sweep_loop(self):
+        """定期清理临时图片目录；启动时先清理一次其他进程残留的目录"""
+        while True:
             try:
-                title_font = ImageFont.truetype("arial.ttf", 20)
-                content_font = ImageFont.truetype("arial.ttf", 14)
-                count_font = ImageFont.truetype("arial.ttf", 12)
-            except:
-                title_font = content_font = count_font = ImageFont.load_default()
-            
-            # 标题背景
-            draw.rectangle([(0, 0), (self.card_width, 60)], fill=self.primary_color)
-            draw.text((20, 15), f"📚 {user_name}的记忆列表", fill='white', font=title_font)
-            draw.text((20, 40), f"共{len(memories)}条记忆", fill='white', font=count_font)
-            
-            # 绘制每条记忆
-            y_pos = 80
-            for key, memory in memories[:10]:  # 最多10条
-                # 记忆卡片背景
-                draw.rectangle([(10, y_pos), (self.card_width-10, y_pos+70)], 
-                             fill='white', outline=self.muted_color)
-                
-                # 关键词
-                draw.text((20, y_pos+5), key, fill=self.text_color, font=content_font)
-                
-                # 内容预览
-                preview = memory['content'][:50] + "..." if len(memory['content']) > 50 else memory['content']
-                draw.text((20, y_pos+25), preview, fill=self.muted_color, font=count_font)
-                
-                # 使用次数
-                count_text = f"使用{memory.get('usage_count', 0)}次"
-                draw.text((self.card_width-100, y_pos+5), count_text, fill=self.muted_color, font=count_font)
-                
-                y_pos += 75
-            
-            # 保存为临时文件
-            temp_dir = os.path.join(self.data_dir, "temp")
-            if not os.path.exists(temp_dir):
-                os.makedirs(temp_dir)
-            
-            temp_path = os.path.join(temp_dir, f"memory_list_{int(time.time() * 1000)}.png")
-            img.save(temp_path, format='PNG', quality=85, optimize=True)
-            
-            return temp_path
-            
-        except Exception as e:
-            logger.error(f"创建列表图片失败: {e}")
-            response = f"📚 {user_name}的记忆列表：\n"
-            for key, memory in memories:
-                response += f"- {key}: {memory['content'][:50]}...\n"
-            return response
\ No newline at end of file
+                removed_files, removed_bytes = await asyncio.to_thread(self._temp_store.sweep)
+                if removed_files:
+                    logger.debug(f"已清理 {removed_files} 个临时图片或残留目录，共 {removed_bytes} 字节")
+            except Exception as e:
+                logger.error(f"清理临时图片失败: {e}")
+            await asyncio.sleep(self.temp_sweep_interval)
+    
+    def _render_theme(self) -> RenderTheme:
+        return RenderTheme(self.card_width, self.card_height, self.bg_color,
+                           self.primary_color, self.text_color, self.muted_color, self.font_path)
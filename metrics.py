@@ -0,0 +1,147 @@
+"""
+运行指标
+
+计数器、直方图（固定桶，单位秒）和由插件在查询时提供的瞬时值。
+插件关闭指标时不创建 Metrics 对象，各埋点只做一次 None 判断。
+文本输出使用 Prometheus exposition 格式，可直接交给 node_exporter 的 textfile collector。
+"""
+
+import bisect
+import functools
+import time
+from typing import Dict, List, Tuple
+
+PREFIX = "astrbot_memory"
+
+# 直方图桶上限（秒），覆盖 0.1ms 到 10s
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """固定桶直方图，最后一个计数为超过最大桶的观测"""
+
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """按桶内线性插值估算分位数"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, bucket_count in enumerate(self.counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return BUCKETS[-1]
+
+
+class Metrics:
+    """按 (指标名, 标签) 记录计数器和直方图"""
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, str], int] = {}
+        self.histograms: Dict[Tuple[str, str], Histogram] = {}
+
+    def inc(self, name: str, label: str = "", amount: int = 1):
+        key = (name, label)
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, seconds: float, label: str = ""):
+        key = (name, label)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    def summary(self, gauges: Dict[str, float]) -> List[str]:
+        """给管理员看的摘要，每项一行"""
+        lines = [f"{name}: {value:g}" for name, value in gauges.items()]
+        for (name, label), value in sorted(self.counters.items()):
+            lines.append(f"{_display(name, label)}: {value}")
+        for (name, label), histogram in sorted(self.histograms.items()):
+            lines.append(
+                f"{_display(name, label)}: {histogram.count}次 "
+                f"p50 {histogram.quantile(0.5) * 1000:.2f}ms "
+                f"p95 {histogram.quantile(0.95) * 1000:.2f}ms "
+                f"p99 {histogram.quantile(0.99) * 1000:.2f}ms"
+            )
+        return lines
+
+    def exposition(self, gauges: Dict[str, float]) -> str:
+        """Prometheus 文本格式"""
+        lines = []
+        for name, value in gauges.items():
+            lines.append(f"# TYPE {PREFIX}_{name} gauge")
+            lines.append(f"{PREFIX}_{name} {value:g}")
+
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+            for (counter_name, label), value in sorted(self.counters.items()):
+                if counter_name == name:
+                    lines.append(f"{PREFIX}_{name}_total{_labels(label)} {value}")
+
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f"# TYPE {PREFIX}_{name}_seconds histogram")
+            for (histogram_name, label), histogram in sorted(self.histograms.items()):
+                if histogram_name != name:
+                    continue
+                cumulative = 0
+                for bound, bucket_count in zip(BUCKETS + (float('inf'),), histogram.counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == float('inf') else f"{bound:g}"
+                    lines.append(f"{PREFIX}_{name}_seconds_bucket{_labels(label, le)} {cumulative}")
+                lines.append(f"{PREFIX}_{name}_seconds_sum{_labels(label)} {histogram.total:.6f}")
+                lines.append(f"{PREFIX}_{name}_seconds_count{_labels(label)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+
+def instrument_handler(label: str):
+    """记录指令处理耗时和次数，指标取自所属对象的 _metrics 属性，为 None 时直接透传"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, event, *args, **kwargs):
+            metrics = self._metrics
+            if metrics is None:
+                async for result in func(self, event, *args, **kwargs):
+                    yield result
+                return
+            # 只计处理函数自身的耗时，不含调用方在两次 yield 之间发送消息的时间
+            elapsed = 0.0
+            started = time.perf_counter()
+            try:
+                async for result in func(self, event, *args, **kwargs):
+                    elapsed += time.perf_counter() - started
+                    yield result
+                    started = time.perf_counter()
+                elapsed += time.perf_counter() - started
+            finally:
+                metrics.observe("command", elapsed, label)
+        return wrapper
+    return decorator
+
+
+def _display(name: str, label: str) -> str:
+    return f"{name}[{label}]" if label else name
+
+
+def _labels(label: str, le: str = None) -> str:
+    parts = []
+    if label:
+        escaped = label.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'kind="{escaped}"')
+    if le is not None:
+        parts.append(f'le="{le}"')
+    return '{' + ','.join(parts) + '}' if parts else ''
@@ -0,0 +1,45 @@
+"""
+记忆命名空间
+
+存储和各级缓存都以命名空间 id 作为“用户”，因此三种命名空间共用同一套加载、保存和淘汰逻辑：
+- personal：个人记忆，id 为发送者 id，私聊和群聊共用（与原先的数据相同）
+- member：群内个人记忆，只在该群可见，id 为 "发送者id@群号"
+- group：群共享记忆，群内成员共同读写，id 为 "group:群号"
+群聊中的指令默认使用 personal 还是 member 由插件配置决定，参数以 @群 开头时使用群共享记忆。
+"""
+
+from typing import Tuple
+
+SCOPE_PERSONAL = "personal"
+SCOPE_MEMBER = "member"
+SCOPE_GROUP = "group"
+
+# 指令参数中表示群共享记忆的标记
+GROUP_MARKER = "@群"
+GROUP_PREFIX = "group:"
+
+
+def namespace_id(scope: str, user_id: str, group_id: str = "") -> str:
+    """命名空间 id；不在群聊中时 member 退化为 personal"""
+    if scope == SCOPE_GROUP:
+        return f"{GROUP_PREFIX}{group_id}"
+    if scope == SCOPE_MEMBER and group_id:
+        return f"{user_id}@{group_id}"
+    return str(user_id)
+
+
+def is_group_namespace(namespace: str) -> bool:
+    return namespace.startswith(GROUP_PREFIX)
+
+
+def memory_limit(namespace: str, max_per_user: int, max_per_group: int) -> int:
+    """命名空间的记忆条数上限：群共享记忆使用群上限，其余使用个人上限"""
+    return max_per_group if is_group_namespace(namespace) else max_per_user
+
+
+def split_scope(args: str) -> Tuple[bool, str]:
+    """去掉参数开头的 @群 标记，返回是否指定了群共享记忆以及其余参数"""
+    parts = args.split(None, 1)
+    if parts and parts[0] == GROUP_MARKER:
+        return True, parts[1] if len(parts) > 1 else ""
+    return False, args
@@ -0,0 +1,231 @@
+"""
+记忆的内存表示
+
+每条记忆原先是一个四个字符串键的字典，created 为 ISO 字符串、tags 为新建的列表，
+在大量用户时这部分开销占了插件堆内存的大头。这里改用 __slots__ 记录：
+标签为驻留字符串组成的元组，创建时间为整数分钟时间戳。
+序列化时仍输出与原 memories.json 相同的字典格式。
+
+内容较长的记忆通过 CONTENTS 按内容去重：多个用户或群保存了相同内容时，
+常驻缓存中只保留一份字符串，由插件在记忆进出缓存时维护引用计数。
+
+过期时间和提醒只在设置了时才写入字典（expires、remind 字段），未设置的记忆格式不变。
+"""
+
+import sys
+import time
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from .eviction import EvictionQueue
+
+EMPTY_TAGS: Tuple[str, ...] = ()
+
+
+def now_minutes() -> int:
+    """当前时间的分钟时间戳"""
+    return int(time.time() // 60)
+
+
+def parse_minutes(created) -> int:
+    """把 ISO 时间字符串或分钟时间戳转换为分钟时间戳，无法解析时使用当前时间"""
+    if isinstance(created, int) and not isinstance(created, bool):
+        return created
+    try:
+        return int(datetime.fromisoformat(str(created)).timestamp() // 60)
+    except ValueError:
+        return now_minutes()
+
+
+def optional_minutes(value) -> Optional[int]:
+    """可选的时间字段：空值或无法解析时返回 None"""
+    if not value:
+        return None
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    try:
+        return int(datetime.fromisoformat(str(value)).timestamp() // 60)
+    except ValueError:
+        return None
+
+
+def format_minutes(minutes: int) -> str:
+    """分钟时间戳转换为原格式的本地时间字符串，如 2024-01-01T08:30"""
+    return datetime.fromtimestamp(minutes * 60).isoformat()[:16]
+
+
+def split_tags(text: str) -> Tuple[str, List[str]]:
+    """取出文本末尾连续的 #标签，返回去掉标签后的文本和标签列表
+
+    只认末尾的标签，内容中间的 # 词（如 #301、#ff0000）原样保留；
+    第一个词始终作为内容，整段文本都是 # 词时不会被取空。
+    """
+    words = text.split()
+    count = 0
+    while count < len(words) - 1 and len(words[-1 - count]) > 1 and words[-1 - count].startswith('#'):
+        count += 1
+    if not count:
+        return text, []
+    return text.rsplit(None, count)[0].strip(), [word[1:] for word in words[-count:]]
+
+
+def intern_tags(tags: Iterable) -> Tuple[str, ...]:
+    """标签转换为驻留字符串元组，相同标签在所有记忆间共享同一个对象"""
+    if not tags:
+        return EMPTY_TAGS
+    return tuple(sys.intern(str(tag)) for tag in tags)
+
+
+# 内容至少这么长才参与去重，更短的内容省下的内存抵不过登记的开销
+SHARED_CONTENT_MIN_LENGTH = 16
+
+
+class ContentPool:
+    """按内容哈希登记的引用计数表
+
+    插件在记忆进入常驻缓存时 acquire() 取得共享的字符串，在记忆被删除、覆盖、淘汰、
+    卸载或被重新加载替换时 release()，引用归零即移除，不会留住已不再使用的内容。
+    哈希相同但内容不同的（极少见）不参与共享；release() 只认 acquire() 返回的那个对象，
+    未登记的字符串释放时什么也不做。只在事件循环中调用，不需要加锁。
+    """
+
+    def __init__(self, min_length: int = SHARED_CONTENT_MIN_LENGTH):
+        self.min_length = min_length
+        # hash(内容) -> [共享的字符串, 引用数]
+        self._entries: Dict[int, list] = {}
+        # 当前被多条记忆共享的内容数，以及因共享省下的字符数
+        self.shared = 0
+        self.saved_chars = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def acquire(self, content: str) -> str:
+        if len(content) < self.min_length:
+            return content
+        digest = hash(content)
+        entry = self._entries.get(digest)
+        if entry is None:
+            self._entries[digest] = [content, 1]
+            return content
+        if entry[0] != content:
+            return content
+        entry[1] += 1
+        if entry[1] == 2:
+            self.shared += 1
+        self.saved_chars += len(content)
+        return entry[0]
+
+    def release(self, content: str):
+        if len(content) < self.min_length:
+            return
+        digest = hash(content)
+        entry = self._entries.get(digest)
+        if entry is None or entry[0] is not content:
+            return
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._entries[digest]
+            return
+        if entry[1] == 1:
+            self.shared -= 1
+        self.saved_chars -= len(content)
+
+
+CONTENTS = ContentPool()
+
+
+class MemoryRecord:
+    """单条记忆"""
+
+    __slots__ = ('content', 'tags', 'created', 'usage_count', 'expires', 'remind')
+
+    def __init__(self, content: str, tags: Iterable = EMPTY_TAGS, created: int = None, usage_count: int = 0,
+                 expires: int = None, remind: Tuple[int, str] = None):
+        self.content = content
+        self.tags = intern_tags(tags)
+        self.created = now_minutes() if created is None else created
+        self.usage_count = usage_count
+        # 过期时间（分钟时间戳），到期后删除
+        self.expires = expires
+        # 提醒：(分钟时间戳, 推送的会话)，发送后清除
+        self.remind = remind
+
+    @property
+    def created_iso(self) -> str:
+        return format_minutes(self.created)
+
+    @classmethod
+    def from_dict(cls, data: Dict, max_content_length: int = None) -> 'MemoryRecord':
+        """从 JSON 字典创建记录，字段校验规则与加载时一致"""
+        content = str(data.get('content', ''))
+        if max_content_length is not None:
+            content = content[:max_content_length]
+        tags = data.get('tags', [])
+        if not isinstance(tags, (list, tuple)):
+            tags = []
+        usage_count = data.get('usage_count', 0)
+        if not isinstance(usage_count, int) or isinstance(usage_count, bool):
+            usage_count = 0
+        remind = data.get('remind')
+        if isinstance(remind, dict) and optional_minutes(remind.get('at')) is not None and remind.get('to'):
+            remind = (optional_minutes(remind['at']), str(remind['to']))
+        else:
+            remind = None
+        return cls(content, tags, parse_minutes(data.get('created', '')), usage_count,
+                   optional_minutes(data.get('expires')), remind)
+
+    def to_dict(self) -> Dict:
+        data = {
+            'content': self.content,
+            'tags': list(self.tags),
+            'created': self.created_iso,
+            'usage_count': self.usage_count
+        }
+        if self.expires is not None:
+            data['expires'] = format_minutes(self.expires)
+        if self.remind is not None:
+            data['remind'] = {'at': format_minutes(self.remind[0]), 'to': self.remind[1]}
+        return data
+
+    def __repr__(self):
+        return f"MemoryRecord({self.to_dict()!r})"
+
+
+def encode_record(obj):
+    """json.dumps 的 default 钩子"""
+    if isinstance(obj, MemoryRecord):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def oldest_first(memory: MemoryRecord):
+    """默认淘汰优先级：创建越早越先淘汰"""
+    return (memory.created,)
+
+
+def clean_user_memories(user_memories, max_content_length: int, max_count: int,
+                        priority: Callable[[MemoryRecord], tuple] = oldest_first) -> Dict[str, MemoryRecord]:
+    """校验并清洗单个用户的原始记忆数据
+
+    非字典的记忆被丢弃，内容截断到 max_content_length；
+    条数超过 max_count 时按 priority 从小到大淘汰。
+    """
+    if not isinstance(user_memories, dict):
+        return {}
+
+    cleaned_memories = {}
+    for key, memory in user_memories.items():
+        if isinstance(memory, dict):
+            cleaned_memories[key] = MemoryRecord.from_dict(memory, max_content_length)
+    return trim_memories(cleaned_memories, max_count, priority)
+
+
+def trim_memories(memories: Dict[str, MemoryRecord], max_count: int,
+                  priority: Callable[[MemoryRecord], tuple] = oldest_first) -> Dict[str, MemoryRecord]:
+    """条数超过 max_count 时按 priority 从小到大原地淘汰，返回 memories"""
+    if len(memories) > max_count:
+        queue = EvictionQueue((key, priority(memory)) for key, memory in memories.items())
+        while len(queue) > max_count:
+            del memories[queue.pop()]
+    return memories
@@ -0,0 +1,480 @@
+"""
+记忆卡片图片渲染
+
+绘图函数都是模块级函数，参数只包含字符串、数字和元组，
+既可以在线程池中执行，也可以交给进程池执行。
+渲染失败时直接抛出异常，由插件记录日志并退回文本回复。
+
+导入本模块时只检查 Pillow 是否安装，首次渲染时才真正导入；
+设置环境变量 MEMORY_NO_IMAGE=1 时完全不使用 Pillow。
+"""
+
+import asyncio
+import concurrent.futures
+import concurrent.futures.process
+import functools
+import hashlib
+import importlib.util
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+NO_IMAGE = os.environ.get("MEMORY_NO_IMAGE", "").strip().lower() not in ("", "0", "false", "no")
+HAS_PILLOW = not NO_IMAGE and importlib.util.find_spec("PIL") is not None
+
+# 由 load_pillow() 在首次渲染时填充
+Image = ImageDraw = ImageFont = None
+
+# Image.Quantize.FASTOCTREE 的取值；Pillow 9.1 之前没有 Image.Quantize 枚举，quantize 直接接受整数
+FAST_OCTREE = 2
+
+
+def load_pillow():
+    """导入 Pillow；进程池的工作进程在各自的首次渲染时导入一次"""
+    global Image, ImageDraw, ImageFont
+    if Image is None:
+        from PIL import Image as pil_image, ImageDraw as pil_draw, ImageFont as pil_font
+        ImageDraw, ImageFont = pil_draw, pil_font
+        Image = pil_image
+
+
+class RenderTheme(NamedTuple):
+    """图片尺寸与配色"""
+    card_width: int = 800
+    card_height: int = 400
+    bg_color: Tuple[int, int, int] = (248, 250, 252)
+    primary_color: Tuple[int, int, int] = (59, 130, 246)
+    text_color: Tuple[int, int, int] = (30, 41, 59)
+    muted_color: Tuple[int, int, int] = (100, 116, 139)
+    # 优先使用的字体文件，多个路径用 os.pathsep 分隔，为空时只搜索系统字体
+    font_path: str = ""
+
+
+# 系统中常见的中文字体，按优先级排列
+SYSTEM_FONT_PATHS = (
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/google-noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-microhei.ttc",
+    "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc",
+    "/usr/share/fonts/wqy-microhei/wqy-microhei.ttc",
+    "/System/Library/Fonts/PingFang.ttc",
+    "/System/Library/Fonts/STHeiti Medium.ttc",
+    "C:/Windows/Fonts/msyh.ttc",
+    "C:/Windows/Fonts/simhei.ttf",
+    "arial.ttf",
+)
+
+
+class FontRegistry:
+    """字体注册表：字体文件只查找一次，字体对象按 (路径, 字号) 缓存
+
+    每个进程各有一份，进程池中的工作进程首次渲染时各自查找；
+    FreeType 字体对象不保证线程安全，因此按线程分别缓存。
+    """
+
+    def __init__(self, system_paths: Tuple[str, ...] = SYSTEM_FONT_PATHS):
+        self.system_paths = system_paths
+        self._resolved: Dict[str, Optional[str]] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def resolve(self, configured: str = "") -> Optional[str]:
+        """返回第一个可用的字体文件，都不可用时返回 None"""
+        if configured in self._resolved:
+            return self._resolved[configured]
+
+        load_pillow()
+        candidates = [path for path in configured.split(os.pathsep) if path] + list(self.system_paths)
+        resolved = None
+        for path in candidates:
+            # 不带目录的字体名交给 FreeType 在系统字体目录中查找
+            if os.path.dirname(path) and not os.path.exists(path):
+                continue
+            try:
+                ImageFont.truetype(path, 12)
+            except Exception:
+                continue
+            resolved = path
+            break
+
+        self._resolved[configured] = resolved
+        return resolved
+
+    def get(self, size: int, configured: str = ""):
+        """获取指定字号的字体，没有可用字体文件时使用 Pillow 默认字体"""
+        with self._lock:
+            path = self.resolve(configured)
+
+        cache = getattr(self._local, 'fonts', None)
+        if cache is None:
+            cache = self._local.fonts = {}
+        font = cache.get((path, size))
+        if font is None:
+            font = ImageFont.truetype(path, size) if path else ImageFont.load_default()
+            cache[(path, size)] = font
+        return font
+
+
+fonts = FontRegistry()
+
+
+@functools.lru_cache(maxsize=64)
+def card_template(theme: RenderTheme, height: int):
+    """卡片的静态图层：背景和标题栏，按高度缓存"""
+    load_pillow()
+    img = Image.new('RGB', (theme.card_width, height), theme.bg_color)
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([(0, 0), (theme.card_width, 60)], fill=theme.primary_color)
+    return img
+
+
+@functools.lru_cache(maxsize=64)
+def list_template(theme: RenderTheme, height: int, item_count: int):
+    """列表的静态图层：背景、标题栏和每条记忆的底框，按高度和条数缓存"""
+    img = card_template(theme, height).copy()
+    draw = ImageDraw.Draw(img)
+    y_pos = 80
+    for _ in range(item_count):
+        draw.rectangle([(10, y_pos), (theme.card_width-10, y_pos+70)],
+                       fill='white', outline=theme.muted_color)
+        y_pos += 75
+    return img
+
+
+# 列表图片中的一条记忆：关键词、内容、使用次数
+ListItem = Tuple[str, str, int]
+
+
+class ImageEncoding(NamedTuple):
+    """图片编码参数；colors 非 0 时先量化为调色板图片"""
+    format: str = 'PNG'
+    colors: int = 256
+    quality: int = 80
+    compress_level: int = 6
+
+    @property
+    def extension(self) -> str:
+        return 'jpg' if self.format == 'JPEG' else self.format.lower()
+
+    @property
+    def label(self) -> str:
+        if self.format == 'PNG':
+            return f"png{self.colors or ''}-z{self.compress_level}"
+        return f"{self.format.lower()}-q{self.quality}"
+
+
+class EncodeInfo(NamedTuple):
+    """一次编码的结果统计"""
+    label: str
+    encode_ms: float
+    size: int
+
+
+# 编码预算预设。卡片和列表都是纯色背景加文字，实测 800x800 列表图：
+# optimize=True 的 PNG 约 33ms/14KB，256 色调色板 PNG（压缩级别 6）约 10ms/6KB，
+# JPEG 约 1.5ms 但文字边缘的噪点使体积达到 48KB，WebP 约 9ms/16KB。
+ENCODE_PRESETS: Dict[str, Dict[str, ImageEncoding]] = {
+    # 优先 CPU：卡片用低压缩级别调色板 PNG，列表直接 JPEG
+    'speed': {
+        'card': ImageEncoding('PNG', 256, compress_level=1),
+        'list': ImageEncoding('JPEG', 0, quality=75),
+    },
+    'balanced': {
+        'card': ImageEncoding('PNG', 256, compress_level=6),
+        'list': ImageEncoding('PNG', 256, compress_level=6),
+    },
+    # 优先体积
+    'size': {
+        'card': ImageEncoding('PNG', 256, compress_level=9),
+        'list': ImageEncoding('PNG', 256, compress_level=9),
+    },
+}
+
+
+def choose_encoding(budget: str, kind: str) -> ImageEncoding:
+    """按编码预算选择卡片（card）或列表（list）的编码参数，未知预算按 balanced 处理"""
+    preset = ENCODE_PRESETS.get(budget, ENCODE_PRESETS['balanced'])
+    return preset[kind]
+
+
+def encode_image(img, encoding: ImageEncoding) -> Tuple[bytes, EncodeInfo]:
+    """按编码参数编码图片，返回图片字节和编码统计"""
+    load_pillow()
+    started = time.perf_counter()
+    buffer = io.BytesIO()
+    if encoding.format == 'PNG':
+        if encoding.colors:
+            img = img.quantize(encoding.colors, method=FAST_OCTREE)
+        img.save(buffer, format='PNG', compress_level=encoding.compress_level)
+    else:
+        img.save(buffer, format=encoding.format, quality=encoding.quality)
+    data = buffer.getvalue()
+    return data, EncodeInfo(encoding.label, (time.perf_counter() - started) * 1000, len(data))
+
+
+def save_image(img, output_path: Optional[str], encoding: ImageEncoding):
+    """编码图片并返回 (图片路径, 编码统计)；output_path 为 None 时返回图片字节而不写文件
+
+    写文件时先写临时文件再改名，其他请求不会读到写了一半的图片。
+    """
+    data, info = encode_image(img, encoding)
+    if output_path is None:
+        return data, info
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    tmp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, output_path)
+    return output_path, info
+
+
+def render_memory_card(output_path: Optional[str], encoding: ImageEncoding, theme: RenderTheme, title: str, content: str,
+                       tags: Tuple[str, ...] = (), action: str = "记住", user_name: str = "用户",
+                       time_text: str = None):
+    """创建记忆卡片图片，返回 save_image() 的结果；time_text 为右下角显示的时间，默认当前时间"""
+    load_pillow()
+    # 计算图片高度
+    lines = len(content) // 30 + 2
+    height = max(200, min(400, 150 + lines * 20))
+
+    # 从缓存的背景和标题栏开始绘制
+    img = card_template(theme, height).copy()
+    draw = ImageDraw.Draw(img)
+
+    title_font = fonts.get(24, theme.font_path)
+    content_font = fonts.get(16, theme.font_path)
+    tag_font = fonts.get(12, theme.font_path)
+
+    # 绘制标题
+    title_text = f"🧠 {action}成功"
+    draw.text((20, 15), title_text, fill='white', font=title_font)
+
+    # 绘制关键词
+    draw.text((20, 80), f"关键词：{title}", fill=theme.text_color, font=content_font)
+
+    # 绘制内容
+    content_lines = [content[i:i+40] for i in range(0, len(content), 40)]
+    y_pos = 110
+    for line in content_lines[:3]:  # 最多3行
+        draw.text((20, y_pos), line, fill=theme.text_color, font=content_font)
+        y_pos += 25
+
+    # 绘制标签
+    if tags:
+        tag_text = "标签：" + " ".join([f"#{tag}" for tag in tags])
+        draw.text((20, y_pos + 10), tag_text, fill=theme.muted_color, font=tag_font)
+
+    # 绘制时间
+    if time_text is None:
+        time_text = datetime.now().strftime("%Y-%m-%d %H:%M")
+    draw.text((theme.card_width - 150, height - 30), time_text, fill=theme.muted_color, font=tag_font)
+
+    return save_image(img, output_path, encoding)
+
+
+def render_memory_list(output_path: Optional[str], encoding: ImageEncoding, theme: RenderTheme, items: List[ListItem],
+                       user_name: str = "用户", total: int = None, page: int = 1, page_count: int = 1):
+    """创建记忆列表图片，返回 save_image() 的结果；total 为结果总数（只传入一页时使用）"""
+    load_pillow()
+    # 计算高度
+    item_height = 80
+    height = 120 + len(items) * item_height
+    height = min(800, height)
+
+    # 从缓存的背景、标题栏和记忆底框开始绘制
+    visible_items = items[:10]  # 最多10条
+    img = list_template(theme, height, len(visible_items)).copy()
+    draw = ImageDraw.Draw(img)
+
+    title_font = fonts.get(20, theme.font_path)
+    content_font = fonts.get(14, theme.font_path)
+    count_font = fonts.get(12, theme.font_path)
+
+    draw.text((20, 15), f"📚 {user_name}的记忆列表", fill='white', font=title_font)
+    count_text = f"共{len(items) if total is None else total}条记忆"
+    if page_count > 1:
+        count_text += f" · 第{page}/{page_count}页"
+    draw.text((20, 40), count_text, fill='white', font=count_font)
+
+    # 绘制每条记忆
+    y_pos = 80
+    for key, content, usage_count in visible_items:
+        # 关键词
+        draw.text((20, y_pos+5), key, fill=theme.text_color, font=content_font)
+
+        # 内容预览
+        preview = content[:50] + "..." if len(content) > 50 else content
+        draw.text((20, y_pos+25), preview, fill=theme.muted_color, font=count_font)
+
+        # 使用次数
+        count_text = f"使用{usage_count}次"
+        draw.text((theme.card_width-100, y_pos+5), count_text, fill=theme.muted_color, font=count_font)
+
+        y_pos += 75
+
+    return save_image(img, output_path, encoding)
+
+
+def render_key(*inputs) -> str:
+    """根据渲染输入计算内容地址"""
+    return hashlib.sha1(repr(inputs).encode('utf-8')).hexdigest()
+
+
+class RenderCache:
+    """已渲染图片的缓存
+
+    内存层是按条数限制的 LRU，记录渲染键到图片路径（或图片字节）的映射，
+    命中时刷新文件修改时间，避免被临时目录清理删除；
+    设置 disk_dir 后图片写入该目录并以渲染键命名，重启后仍可命中，
+    目录内文件数超过 disk_max_entries 时删除最旧的文件。
+    列表图片登记所属用户，用户记忆变化时通过 invalidate() 一并失效。
+    """
+
+    def __init__(self, output_dir: str, max_entries: int = 256, disk_dir: str = None,
+                 disk_max_entries: int = 2048):
+        self.output_dir = output_dir
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.disk_max_entries = disk_max_entries
+        # 渲染键 -> (图片路径, 所属用户)
+        self._entries: 'OrderedDict[str, Tuple[str, Optional[str]]]' = OrderedDict()
+        self._puts_since_prune = 0
+
+    def path_for(self, prefix: str, key: str, extension: str = 'png') -> str:
+        return os.path.join(self.disk_dir or self.output_dir, f"{prefix}_{key[:20]}.{extension}")
+
+    def get(self, prefix: str, key: str, extension: str = 'png'):
+        entry = self._entries.get(key)
+        if entry is not None:
+            image = entry[0]
+            self._entries.move_to_end(key)
+            if isinstance(image, bytes):
+                return image
+        elif self.disk_dir:
+            image = self.path_for(prefix, key, extension)
+        else:
+            return None
+        try:
+            os.utime(image)
+        except OSError:
+            # 文件已被清理
+            self._entries.pop(key, None)
+            return None
+        return image
+
+    def put(self, key: str, image, owner: str = None):
+        self._entries[key] = (image, owner)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+        if self.disk_dir:
+            self._puts_since_prune += 1
+            if self._puts_since_prune >= 64:
+                self._puts_since_prune = 0
+                self._prune_disk()
+
+    def invalidate(self, owner: str):
+        """丢弃某个用户的列表图片缓存条目
+
+        图片文件不在这里删除，可能仍有回复在发送它；
+        渲染键包含列表内容，记忆变化后也不会再命中旧文件。
+        """
+        stale = [key for key, (_, entry_owner) in self._entries.items() if entry_owner == owner]
+        for key in stale:
+            del self._entries[key]
+
+    def _prune_disk(self):
+        try:
+            entries = [entry for entry in os.scandir(self.disk_dir) if not entry.name.endswith('.tmp')]
+        except OSError:
+            return
+        if len(entries) <= self.disk_max_entries:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - self.disk_max_entries]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+class RenderSaturated(Exception):
+    """渲染队列已满"""
+
+
+class RenderPool:
+    """有界的渲染执行器
+
+    mode 为 thread 时使用线程池，为 process 时使用进程池（Pillow 绘图不再与事件循环争抢 GIL）。
+    排队加执行中的任务数超过 max_pending 时直接拒绝，单次渲染超过 timeout 秒视为失败。
+    """
+
+    def __init__(self, mode: str = "thread", workers: int = 2, max_pending: int = 8, timeout: float = 5.0):
+        self.mode = mode
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+        self._executor = None
+
+    def _get_executor(self) -> concurrent.futures.Executor:
+        if self._executor is None:
+            if self.mode == "process":
+                self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="memory_render"
+                )
+        return self._executor
+
+    @property
+    def saturated(self) -> bool:
+        return self.pending >= self.max_pending
+
+    async def run(self, func, *args):
+        """在执行器中运行渲染函数并等待结果
+
+        队列已满时抛出 RenderSaturated，超时抛出 asyncio.TimeoutError，
+        渲染函数自身的异常原样抛出。
+        """
+        if self.saturated:
+            raise RenderSaturated()
+
+        loop = asyncio.get_running_loop()
+        try:
+            future = self._get_executor().submit(func, *args)
+        except concurrent.futures.process.BrokenProcessPool:
+            self._executor = None
+            raise
+        # 超时只是不再等待，已开始的渲染仍占用工作线程（进程），
+        # 因此在渲染真正结束时才减少 pending，is_full 和降级档位才不会低估负载
+        self.pending += 1
+        future.add_done_callback(lambda _: self._release(loop))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except concurrent.futures.process.BrokenProcessPool:
+            # 工作进程异常退出后进程池不可再用，下次渲染时重建
+            self._executor = None
+            raise
+
+    def _release(self, loop: asyncio.AbstractEventLoop):
+        """渲染结束（可能在工作线程中回调），回到事件循环减少 pending"""
+        try:
+            loop.call_soon_threadsafe(self._decrement)
+        except RuntimeError:
+            # 事件循环已关闭
+            pass
+
+    def _decrement(self):
+        self.pending -= 1
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,263 @@
+"""
+记忆搜索索引
+
+按字符 bigram 建立的倒排索引，中文不需要分词即可使用。
+查询时先对关键词的所有 bigram 求倒排表交集得到候选，再只在候选上做子串校验，
+因此结果与逐条子串匹配完全一致。
+
+排序搜索把关键词的每个 bigram 当作一个词项，在命中结果上综合 BM25 风格的
+字段加权词频、使用次数和新近程度打分，
+并对 key 做有界编辑距离的模糊匹配，用大小为 k 的堆选出前 k 条。
+"""
+
+import heapq
+import math
+import time
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from .records import MemoryRecord
+
+
+# 字段权重，顺序与 memory_fields 一致：key、内容、标签
+FIELD_WEIGHTS = (3.0, 1.0, 2.0)
+BM25_K1 = 1.2
+BM25_B = 0.75
+USAGE_WEIGHT = 0.1
+RECENCY_WEIGHT = 0.1
+RECENCY_HALF_LIFE = 30 * 86400
+# 模糊命中相对精确命中的折扣
+FUZZY_PENALTY = 0.5
+
+
+def memory_fields(key: str, memory: MemoryRecord) -> tuple:
+    """返回参与搜索的小写字段：key、内容、以空格连接的标签"""
+    return (
+        key.lower(),
+        memory.content.lower(),
+        ' '.join(memory.tags).lower(),
+    )
+
+
+def fuzzy_bound(keyword: str) -> int:
+    """允许的最大编辑距离：短关键词只容忍一处错误"""
+    if len(keyword) < 2:
+        return 0
+    return 1 if len(keyword) <= 4 else 2
+
+
+def bounded_edit_distance(a: str, b: str, bound: int) -> Optional[int]:
+    """计算编辑距离，超过 bound 时提前返回 None"""
+    if abs(len(a) - len(b)) > bound:
+        return None
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > bound:
+            return None
+        previous = current
+    return previous[-1] if previous[-1] <= bound else None
+
+
+def text_grams(text: str) -> Set[str]:
+    """单字和相邻双字，单字用于只有一个字符的查询"""
+    grams = set(text)
+    grams.update(text[i:i + 2] for i in range(len(text) - 1))
+    return grams
+
+
+class MemorySearchIndex:
+    """单个用户的 bigram 倒排索引，随记忆增删增量维护"""
+
+    def __init__(self, memories: Dict = None):
+        self._postings: Dict[str, Set[str]] = {}
+        self._fields: Dict[str, tuple] = {}
+        # 记录 key 首次加入的顺序，保证结果与字典遍历顺序一致
+        self._order: Dict[str, int] = {}
+        self._next_order = 0
+        self._total_length = 0
+        for key, memory in (memories or {}).items():
+            self.add(key, memory)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def add(self, key: str, memory: MemoryRecord):
+        """加入或更新一条记忆"""
+        if key in self._fields:
+            self._unlink(key)
+        else:
+            self._order[key] = self._next_order
+            self._next_order += 1
+
+        fields = memory_fields(key, memory)
+        self._fields[key] = fields
+        self._total_length += sum(len(field) for field in fields)
+        for gram in set().union(*(text_grams(field) for field in fields)):
+            self._postings.setdefault(gram, set()).add(key)
+
+    def remove(self, key: str):
+        """移除一条记忆"""
+        if key not in self._fields:
+            return
+        self._unlink(key)
+        del self._fields[key]
+        del self._order[key]
+
+    def _unlink(self, key: str):
+        self._total_length -= sum(len(field) for field in self._fields[key])
+        for gram in set().union(*(text_grams(field) for field in self._fields[key])):
+            postings = self._postings.get(gram)
+            if postings is not None:
+                postings.discard(key)
+                if not postings:
+                    del self._postings[gram]
+
+    def _candidates(self, keyword: str) -> Iterable[str]:
+        if not keyword:
+            return self._fields.keys()
+        if len(keyword) == 1:
+            return self._postings.get(keyword, ())
+
+        grams = {keyword[i:i + 2] for i in range(len(keyword) - 1)}
+        postings = []
+        for gram in grams:
+            gram_postings = self._postings.get(gram)
+            if not gram_postings:
+                return ()
+            postings.append(gram_postings)
+        postings.sort(key=len)
+        return set.intersection(*postings)
+
+    def search(self, keyword: str) -> List[str]:
+        """返回 key、内容或标签包含关键词（不区分大小写）的记忆 key，按加入顺序排列"""
+        keyword = str(keyword).lower()
+        matches = [
+            key for key in self._candidates(keyword)
+            if any(keyword in field for field in self._fields[key])
+        ]
+        matches.sort(key=self._order.__getitem__)
+        return matches
+
+    def _fuzzy_matches(self, keyword: str, exclude: Set[str]) -> Iterable[Tuple[str, int]]:
+        """与关键词编辑距离不超过上限的 key，候选只取含有关键词任一字符的记忆"""
+        bound = fuzzy_bound(keyword)
+        if not bound:
+            return
+        candidates = set()
+        for char in set(keyword):
+            candidates.update(self._postings.get(char, ()))
+        for key in candidates - exclude:
+            distance = bounded_edit_distance(keyword, self._fields[key][0], bound)
+            if distance is not None:
+                yield key, distance
+
+    def _idf(self, term: str) -> float:
+        total_docs = len(self._fields)
+        doc_freq = len(self._postings.get(term, ()))
+        return math.log(1 + (total_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+
+    def _bm25(self, weighted_tf: float, doc_length: int, idf: float) -> float:
+        avg_length = self._total_length / len(self._fields) if self._fields else 1
+        norm = 1 - BM25_B + BM25_B * doc_length / max(avg_length, 1)
+        return idf * weighted_tf * (BM25_K1 + 1) / (weighted_tf + BM25_K1 * norm)
+
+    def rank(self, keyword: str, memories: Dict, limit: int,
+             hits: Iterable[str] = None, fuzzy: bool = True) -> Tuple[List[str], int]:
+        """排序搜索，返回得分最高的 limit 个 key 以及命中总数
+
+        hits 为外部索引给出的子串命中结果，不传时使用本索引搜索。
+        """
+        keyword = str(keyword).lower()
+        hits = set(self.search(keyword) if hits is None else hits) & self._fields.keys()
+        fuzzy_hits = dict(self._fuzzy_matches(keyword, hits)) if fuzzy else {}
+
+        if len(keyword) > 1:
+            terms = {keyword[i:i + 2] for i in range(len(keyword) - 1)}
+        else:
+            terms = {keyword}
+        term_idf = {term: self._idf(term) for term in terms}
+        now = time.time()
+
+        def score(key: str) -> float:
+            fields = self._fields[key]
+            doc_length = sum(len(field) for field in fields)
+            if key in fuzzy_hits:
+                closeness = 1 - fuzzy_hits[key] / (fuzzy_bound(keyword) + 1)
+                relevance = self._bm25(FIELD_WEIGHTS[0] * closeness, doc_length,
+                                       max(term_idf.values())) * FUZZY_PENALTY
+            else:
+                relevance = 0.0
+                for term, idf in term_idf.items():
+                    weighted_tf = sum(
+                        weight * field.count(term) if term else weight
+                        for weight, field in zip(FIELD_WEIGHTS, fields)
+                    )
+                    relevance += self._bm25(weighted_tf, doc_length, idf)
+            memory = memories[key]
+            age = max(now - memory.created * 60, 0)
+            return (relevance
+                    + USAGE_WEIGHT * math.log1p(memory.usage_count)
+                    + RECENCY_WEIGHT * 0.5 ** (age / RECENCY_HALF_LIFE))
+
+        candidates = list(hits) + list(fuzzy_hits)
+        # 同分时按加入顺序，保证结果稳定
+        top = heapq.nlargest(limit, candidates, key=lambda key: (score(key), -self._order[key]))
+        return top, len(candidates)
+
+    def related(self, text: str, limit: int, min_coverage: float = 0.5) -> List[str]:
+        """与一段文本（如一条聊天消息）相关的记忆 key
+
+        key 的 bigram 至少有 min_coverage 出现在文本中才算相关；完整出现 key 的排在前面，
+        其余按覆盖率、再按命中 bigram（任一字段）的 IDF 之和排序。只查文本中出现的 bigram 的倒排表。
+        """
+        candidates = self.related_candidates(self.text_grams(text), limit, min_coverage)
+        return self.rank_related(text, candidates, limit)
+
+    def text_grams(self, text: str) -> FrozenSet[str]:
+        """文本中出现在索引里的 bigram；related 的候选和打分只取决于它，可作为缓存键"""
+        text = str(text).lower()
+        return frozenset(
+            gram for gram in {text[i:i + 2] for i in range(len(text) - 1)} if gram in self._postings
+        )
+
+    def related_candidates(self, grams: FrozenSet[str], limit: int,
+                           min_coverage: float = 0.5) -> List[Tuple[float, float, int, str]]:
+        """按命中的 bigram 打分的相关候选 (覆盖率, IDF 之和, -序号, key)
+
+        是否完整出现在文本中要看原文，留给 rank_related 判断。完整出现的 key 覆盖率必为 1，
+        因此保留全部覆盖率为 1 的候选，其余只保留前 limit 条。
+        """
+        # key -> [命中的 key bigram 数, 命中 bigram 的 IDF 之和]
+        matched: Dict[str, list] = {}
+        for gram in grams:
+            postings = self._postings.get(gram)
+            if not postings:
+                continue
+            idf = self._idf(gram)
+            for key in postings:
+                entry = matched.get(key)
+                if entry is None:
+                    entry = matched[key] = [0, 0.0]
+                if gram in self._fields[key][0]:
+                    entry[0] += 1
+                entry[1] += idf
+
+        full = []
+        partial = []
+        for key, (key_hits, relevance) in matched.items():
+            field = self._fields[key][0]
+            coverage = key_hits / max(len({field[i:i + 2] for i in range(len(field) - 1)}), 1)
+            if coverage >= 1:
+                full.append((coverage, relevance, -self._order[key], key))
+            elif coverage >= min_coverage:
+                partial.append((coverage, relevance, -self._order[key], key))
+        return full + heapq.nlargest(limit, partial)
+
+    def rank_related(self, text: str, candidates: List[Tuple[float, float, int, str]], limit: int) -> List[str]:
+        """在候选中选出前 limit 条：完整出现在文本中的 key 优先"""
+        text = str(text).lower()
+        scored = [(coverage >= 1 and self._fields[key][0] in text, coverage, relevance, order, key)
+                  for coverage, relevance, order, key in candidates if key in self._fields]
+        return [key for *_, key in heapq.nlargest(limit, scored)]
@@ -0,0 +1,174 @@
+"""
+相似度搜索（需要 NumPy，未安装时插件退回 ranked 模式）
+
+把 key、内容和标签切成字符 1~3-gram，用哈希映射到固定的 DIMENSIONS 维，
+按字段加权的对数词频存成一行。每个用户的所有行放在一块连续的 float32 矩阵里，
+新增、修改、删除只改动一行，同时增量维护每一维的文档频率。
+查询时用当前文档频率算出 IDF，一次矩阵乘法得到全部记忆与关键词（及其同义词）的余弦相似度，
+再用 argpartition 选出前 k 条。完全离线，不需要下载模型。
+
+字符 n-gram 只能匹配字面上有重叠的文本，常见的中英文同义词（如“邮箱”和“email”）
+在查询时按 SYNONYMS 扩展。
+"""
+
+import zlib
+from typing import Dict, List, Tuple
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    np = None
+    HAS_NUMPY = False
+
+from .records import MemoryRecord
+from .search_index import FIELD_WEIGHTS, memory_fields
+
+# 哈希空间维度；每个用户的矩阵占用 行数 x DIMENSIONS x 4 字节
+DIMENSIONS = 1024
+NGRAM_SIZES = (1, 2, 3)
+# 低于该相似度的记忆不算命中
+MIN_SIMILARITY = 0.15
+# 同义词扩展出的 n-gram 相对原关键词的权重
+SYNONYM_WEIGHT = 0.8
+
+# 查询扩展用的同义词组，组内任一词出现在关键词中时加入其余各词
+SYNONYMS = (
+    ("邮箱", "邮件", "email", "mail"),
+    ("电话", "手机", "手机号", "phone", "tel"),
+    ("生日", "birthday"),
+    ("地址", "住址", "address"),
+    ("密码", "口令", "password", "pwd"),
+    ("账号", "帐号", "账户", "account"),
+    ("微信", "wechat"),
+    ("名字", "姓名", "name"),
+    ("网址", "链接", "网站", "url", "link"),
+)
+
+
+def gram_counts(fields: Tuple[str, ...], weights: Tuple[float, ...],
+                sizes: Tuple[int, ...] = NGRAM_SIZES) -> Dict[int, float]:
+    """各字段 n-gram 的哈希维度及加权出现次数
+
+    用 crc32 而不是内置 hash()，哈希冲突不随进程的随机种子变化，同样的数据每次得到同样的结果。
+    """
+    counts: Dict[int, float] = {}
+    for field, weight in zip(fields, weights):
+        for size in sizes:
+            for i in range(len(field) - size + 1):
+                dim = zlib.crc32(field[i:i + size].encode('utf-8')) % DIMENSIONS
+                counts[dim] = counts.get(dim, 0.0) + weight
+    return counts
+
+
+def expand_query(keyword: str) -> List[Tuple[str, float]]:
+    """关键词及其同义词，附带各自的权重
+
+    同义词各自作为一条查询，只取 2-gram 和 3-gram（见 rank），单个字母或汉字太常见，会让无关记忆得分。
+    """
+    terms = [(keyword, 1.0)]
+    for group in SYNONYMS:
+        if any(word in keyword for word in group):
+            terms.extend((word, SYNONYM_WEIGHT) for word in group if word not in keyword)
+    return terms
+
+
+class MemoryVectorIndex:
+    """单个用户的哈希 n-gram TF-IDF 向量索引，随记忆增删增量维护"""
+
+    def __init__(self, memories: Dict = None):
+        memories = memories or {}
+        self._matrix = np.zeros((max(8, len(memories)), DIMENSIONS), dtype=np.float32)
+        self._doc_freq = np.zeros(DIMENSIONS, dtype=np.int32)
+        self._keys: List[str] = []
+        self._rows: Dict[str, int] = {}
+        # 记录 key 首次加入的顺序，同分时按加入顺序排列
+        self._order: Dict[str, int] = {}
+        self._next_order = 0
+        # 各维 IDF 平方和各行范数依赖全部记忆，缓存到下一次增删为止
+        self._weights = None
+        self._norms = None
+        for key, memory in memories.items():
+            self.add(key, memory)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key: str, memory: MemoryRecord):
+        """加入或更新一条记忆"""
+        self._weights = self._norms = None
+        row = self._rows.get(key)
+        if row is None:
+            row = len(self._keys)
+            if row == len(self._matrix):
+                # 容量翻倍，保持整块连续
+                grown = np.zeros((row * 2, DIMENSIONS), dtype=np.float32)
+                grown[:row] = self._matrix
+                self._matrix = grown
+            self._keys.append(key)
+            self._rows[key] = row
+            self._order[key] = self._next_order
+            self._next_order += 1
+        else:
+            self._doc_freq[self._matrix[row] > 0] -= 1
+
+        counts = gram_counts(memory_fields(key, memory), FIELD_WEIGHTS)
+        vector = self._matrix[row]
+        vector[:] = 0
+        if counts:
+            dims = np.fromiter(counts.keys(), dtype=np.intp, count=len(counts))
+            vector[dims] = np.log1p(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+            self._doc_freq[dims] += 1
+
+    def remove(self, key: str):
+        """移除一条记忆，最后一行移到空出的位置"""
+        row = self._rows.pop(key, None)
+        if row is None:
+            return
+        del self._order[key]
+        self._weights = self._norms = None
+        self._doc_freq[self._matrix[row] > 0] -= 1
+        last = len(self._keys) - 1
+        if row != last:
+            last_key = self._keys[last]
+            self._matrix[row] = self._matrix[last]
+            self._keys[row] = last_key
+            self._rows[last_key] = row
+        self._matrix[last] = 0
+        self._keys.pop()
+
+    def rank(self, keyword: str, limit: int) -> Tuple[List[str], int]:
+        """相似度最高的 limit 个 key，以及相似度不低于 MIN_SIMILARITY 的记忆总数"""
+        count = len(self._keys)
+        keyword = str(keyword).lower()
+        if not count or not keyword or limit <= 0:
+            return [], 0
+
+        # 关键词和每个同义词各一行查询向量，取各行相似度（乘以权重）的最大值
+        terms = expand_query(keyword)
+        queries = np.zeros((len(terms), DIMENSIONS), dtype=np.float32)
+        for i, (term, _) in enumerate(terms):
+            sizes = NGRAM_SIZES if i == 0 else NGRAM_SIZES[1:]
+            counts = gram_counts((term,), (1.0,), sizes)
+            dims = np.fromiter(counts.keys(), dtype=np.intp, count=len(counts))
+            queries[i, dims] = np.log1p(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+
+        matrix = self._matrix[:count]
+        if self._norms is None:
+            idf = np.log((1 + count) / (1 + self._doc_freq)).astype(np.float32) + 1
+            self._weights = idf * idf
+            self._norms = np.sqrt((matrix * matrix) @ self._weights)
+        weights = self._weights
+        query_norms = np.sqrt((queries * queries) @ weights)
+        cosines = (matrix @ (queries * weights).T) / np.maximum(np.outer(self._norms, query_norms), 1e-12)
+        term_weights = np.fromiter((weight for _, weight in terms), dtype=np.float32, count=len(terms))
+        scores = (cosines * term_weights).max(axis=1)
+
+        total = int(np.count_nonzero(scores >= MIN_SIMILARITY))
+        k = min(limit, total)
+        if not k:
+            return [], total
+        top = np.argpartition(-scores, k - 1)[:k]
+        # 同分时按加入顺序，保证结果稳定
+        ordered = sorted(top.tolist(), key=lambda row: (-scores[row], self._order[self._keys[row]]))
+        return [self._keys[row] for row in ordered], total
@@ -0,0 +1,814 @@
+"""
+记忆持久化后端
+
+每个后端把一次保存拆成两步：
+- prepare(): 在事件循环内执行，读取内存中的记忆并生成待写入的数据
+- commit(): 只做文件 IO，可以放到线程池中执行
+
+多个进程共享同一数据目录时，提交持有 StoreLock 独占锁；锁文件中记录存储的修改代号，
+后端发现代号与自己上次同步时不同（其他进程写过），就以存储中的最新数据为基础
+应用本次的变更记录再写入，而不是用内存中的旧数据覆盖。
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，锁只在进程内有效
+    fcntl = None
+
+from .records import SHARED_CONTENT_MIN_LENGTH, MemoryRecord, encode_record, format_minutes
+from .search_index import memory_fields
+
+
+# 变更类型：put 为新增/覆盖，use 为仅使用次数变化，del 为删除
+CHANGE_PUT = "put"
+CHANGE_USE = "use"
+CHANGE_DEL = "del"
+
+Changes = Dict[Tuple[str, str], str]
+
+
+def dump_json(data) -> str:
+    """与原有 memories.json 保持一致的紧凑 JSON 格式，MemoryRecord 按原字典格式输出"""
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False, default=encode_record)
+
+
+def write_file_replace(path: str, data: str):
+    """先写临时文件并 fsync 再替换，写入中途崩溃或断电都不会留下半个文件"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_dir(os.path.dirname(path))
+
+
+def fsync_dir(directory: str):
+    """同步目录项，使 rename 本身落盘；不支持打开目录的平台（Windows）跳过"""
+    try:
+        fd = os.open(directory or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def build_records(memories: Dict, changes: Changes) -> List[str]:
+    """把变更集合转换为日志行，同一条记忆的多次修改只保留最终状态"""
+    lines = []
+    for (user_id, key), kind in changes.items():
+        memory = memories.get(user_id, {}).get(key)
+        if memory is None:
+            record = {'op': CHANGE_DEL, 'u': user_id, 'k': key}
+        elif kind == CHANGE_USE:
+            record = {'op': CHANGE_USE, 'u': user_id, 'k': key, 'n': memory.usage_count}
+        else:
+            record = {'op': CHANGE_PUT, 'u': user_id, 'k': key, 'm': memory}
+        lines.append(dump_json(record) + '\n')
+    return lines
+
+
+def apply_record(data: Dict, record: Dict) -> bool:
+    """把一条日志记录应用到原始记忆数据上，记录无效时返回 False"""
+    if not isinstance(record, dict):
+        return False
+    op = record.get('op')
+    user_id = str(record.get('u', ''))
+    key = str(record.get('k', ''))
+    if not user_id or not key:
+        return False
+
+    if op == CHANGE_PUT and isinstance(record.get('m'), dict):
+        data.setdefault(user_id, {})[key] = record['m']
+    elif op == CHANGE_USE:
+        memory = data.get(user_id, {}).get(key)
+        if isinstance(memory, dict):
+            memory['usage_count'] = record.get('n', 0)
+    elif op == CHANGE_DEL:
+        data.get(user_id, {}).pop(key, None)
+    else:
+        return False
+    return True
+
+
+class LockState:
+    """持有锁期间锁文件中的修改代号；独占锁释放前会换成新代号"""
+
+    __slots__ = ('generation',)
+
+    def __init__(self, generation: str):
+        self.generation = generation
+
+
+class StoreLock:
+    """数据目录的进程间读写锁（fcntl.flock 咨询锁）
+
+    锁文件的内容是存储的修改代号，每次独占提交后换成新值，
+    其他进程只需比较代号即可知道存储是否被别人改过。每次加锁都重新打开文件，
+    因此同一进程的不同线程之间也能互斥。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @contextlib.contextmanager
+    def acquire(self, exclusive: bool = False) -> Iterator[LockState]:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'r+', encoding='utf-8') as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            state = LockState(f.read())
+            try:
+                yield state
+            finally:
+                if exclusive:
+                    # 提交失败也换代号：文件可能已经部分写入，让其他进程重新读取
+                    state.generation = f"{os.getpid()}-{time.time_ns()}"
+                    f.seek(0)
+                    f.truncate()
+                    f.write(state.generation)
+                    f.flush()
+
+
+class LockedStore:
+    """存储后端的公共部分：进程间锁，以及内存中的数据对应的修改代号"""
+
+    def __init__(self, lock: Optional[StoreLock] = None):
+        self.lock = lock
+        # 本进程上次与存储同步时的代号；None 表示尚未同步，下次提交按合并处理
+        self.generation: Optional[str] = None
+
+    def current_generation(self) -> Optional[str]:
+        """存储当前的修改代号，与 generation 不同说明其他进程写过"""
+        if self.lock is None:
+            return self.generation
+        with self.lock.acquire() as state:
+            return state.generation
+
+    @contextlib.contextmanager
+    def _reading(self):
+        """持有共享锁读取全部数据，读到的数据即对应当前代号"""
+        if self.lock is None:
+            yield
+            return
+        with self.lock.acquire() as state:
+            yield
+            self.generation = state.generation
+
+    @contextlib.contextmanager
+    def _writing(self) -> Iterator[bool]:
+        """持有独占锁提交，给出是否需要合并其他进程的修改"""
+        if self.lock is None:
+            yield False
+            return
+        with self.lock.acquire(exclusive=True) as state:
+            foreign = state.generation != self.generation
+            yield foreign
+        # 合并写入后内存中仍缺少其他进程的修改，保持旧代号，等插件重新加载
+        if not foreign:
+            self.generation = state.generation
+
+
+class JsonMemoryStore(LockedStore):
+    """单文件 JSON 存储，每次保存整体重写 memories.json"""
+
+    # 是否按用户懒加载；为 False 时启动即加载全部用户
+    lazy = False
+    # 是否提供 search()，为 False 时由插件在内存中搜索
+    searchable = False
+
+    def __init__(self, memories_file: str, lock: Optional[StoreLock] = None):
+        super().__init__(lock)
+        self.memories_file = memories_file
+        # 内存中只加载了部分用户时为 True，整体写入改为以存储中的数据为基础合并变更，不丢弃未加载的用户
+        self.partial = False
+
+    def load(self) -> Dict:
+        """读取原始记忆数据，文件不存在时返回空字典"""
+        with self._reading():
+            return self._read()
+
+    def _read(self) -> Dict:
+        if not os.path.exists(self.memories_file):
+            return {}
+        with open(self.memories_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _merge(self, lines: List[str]) -> str:
+        """以存储中的最新数据为基础应用本次的变更记录，返回新快照（须持有独占锁）"""
+        data = self._read()
+        if not isinstance(data, dict):
+            data = {}
+        for line in lines:
+            apply_record(data, json.loads(line))
+        return dump_json(data)
+
+    def prepare(self, memories: Dict, changes: Changes):
+        return dump_json(memories), build_records(memories, changes)
+
+    def commit(self, payload):
+        snapshot, lines = payload
+        with self._writing() as foreign:
+            if foreign or self.partial:
+                snapshot = self._merge(lines)
+            write_file_replace(self.memories_file, snapshot)
+
+
+class JournalMemoryStore(JsonMemoryStore):
+    """快照 + 追加日志存储
+
+    每次保存只把变更追加到日志文件，日志记录数超过 compact_threshold 后
+    把当前记忆整体写成新快照并清空日志，从而限制启动时的回放时间。
+    """
+
+    def __init__(self, memories_file: str, journal_file: str, compact_threshold: int = 1000,
+                 lock: Optional[StoreLock] = None):
+        super().__init__(memories_file, lock)
+        self.journal_file = journal_file
+        self.compact_threshold = compact_threshold
+        self.journal_records = 0
+        self._force_snapshot = False
+
+    def _read(self) -> Dict:
+        """读取快照并回放日志"""
+        data = super()._read()
+        if not isinstance(data, dict):
+            data = {}
+        self.journal_records = self.replay(data)
+        return data
+
+    def replay(self, data: Dict) -> int:
+        """把日志记录依次应用到 data 上，返回回放的记录数"""
+        if not os.path.exists(self.journal_file):
+            return 0
+
+        count = 0
+        with open(self.journal_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 崩溃时可能留下半行，跳过即可
+                    continue
+                if apply_record(data, record):
+                    count += 1
+        return count
+
+    def prepare(self, memories: Dict, changes: Changes):
+        lines = build_records(memories, changes)
+        if self._force_snapshot or self.journal_records + len(lines) >= self.compact_threshold:
+            self._force_snapshot = False
+            self.journal_records = 0
+            return ('snapshot', dump_json(memories), lines)
+
+        self.journal_records += len(lines)
+        return ('append', ''.join(lines), None)
+
+    def commit(self, payload):
+        mode, data, lines = payload
+        try:
+            with self._writing() as foreign:
+                if mode == 'snapshot':
+                    self._compact(self._merge(lines) if foreign or self.partial else data)
+                elif data:
+                    # 追加本身就能合并其他进程的修改：回放时按写入顺序应用
+                    with open(self.journal_file, 'a', encoding='utf-8') as f:
+                        f.write(data)
+                        f.flush()
+                        os.fsync(f.fileno())
+        except Exception:
+            # 这批变更已经丢失，下次保存改写完整快照
+            self._force_snapshot = True
+            raise
+
+    def _compact(self, snapshot: str):
+        """写入新快照后截断日志；两步之间崩溃时重放旧日志也是幂等的"""
+        write_file_replace(self.memories_file, snapshot)
+        with open(self.journal_file, 'w', encoding='utf-8'):
+            pass
+
+
+class ShardedMemoryStore(LockedStore):
+    """按用户分片的存储，每个用户一个文件，按需加载
+
+    文件路径为 users/<哈希前两位>/<哈希>.json，文件内同时保存原始 user_id，
+    因此任意字符的用户 ID 都可以安全落盘，目录也不会因为用户过多而过大。
+    设置了过期或提醒的记忆另外汇总在 users/timers.json（user_id -> key -> 定时字段），
+    随提交更新，启动时重建定时器只需读这一个文件。
+    """
+
+    lazy = True
+    searchable = False
+
+    def __init__(self, shard_dir: str, lock: Optional[StoreLock] = None):
+        super().__init__(lock)
+        self.shard_dir = shard_dir
+        self.timer_index_path = os.path.join(shard_dir, "timers.json")
+        # 与 generation 对应的定时索引；其他进程写过或上次提交失败时为 None，下次提交重新读取
+        self._timer_index: Optional[Dict] = None
+
+    def shard_path(self, user_id: str) -> str:
+        digest = hashlib.sha1(user_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.shard_dir, digest[:2], f"{digest}.json")
+
+    def load(self) -> Dict:
+        """分片存储启动时不加载任何用户"""
+        return {}
+
+    def load_user(self, user_id: str) -> Dict:
+        return self._read_shard(self.shard_path(user_id), user_id)
+
+    @staticmethod
+    def _read_shard(path: str, user_id: str) -> Dict:
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if not isinstance(data, dict) or data.get('user_id') != user_id:
+            return {}
+        return data.get('memories', {})
+
+    def iter_users(self) -> Iterator[Tuple[str, Dict]]:
+        """逐个读取所有分片，内存占用只与单个用户有关"""
+        if not os.path.isdir(self.shard_dir):
+            return
+        for bucket in sorted(os.listdir(self.shard_dir)):
+            bucket_dir = os.path.join(self.shard_dir, bucket)
+            if not os.path.isdir(bucket_dir):
+                continue
+            for name in sorted(os.listdir(bucket_dir)):
+                if not name.endswith('.json'):
+                    continue
+                with open(os.path.join(bucket_dir, name), 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if isinstance(data, dict) and 'user_id' in data:
+                    yield str(data['user_id']), data.get('memories', {})
+
+    def iter_timers(self) -> Iterator[Tuple[str, str, Dict]]:
+        """设置了过期时间或提醒的记忆，只含定时字段；读取 timers.json，还没有索引时（旧版数据）读一遍所有分片"""
+        index = self._read_timer_index()
+        if index is None:
+            index = self._scan_timers()
+        for user_id, entries in index.items():
+            for key, memory in entries.items():
+                yield user_id, key, memory
+
+    @staticmethod
+    def _timer_entries(user_memories: Optional[Dict]) -> Dict:
+        """用户记忆中设置了过期或提醒的条目，只保留定时字段；记忆可以是 MemoryRecord 或原始字典"""
+        entries = {}
+        for key, memory in (user_memories or {}).items():
+            if isinstance(memory, MemoryRecord):
+                if memory.expires is None and memory.remind is None:
+                    continue
+                memory = memory.to_dict()
+            elif not isinstance(memory, dict):
+                continue
+            fields = {field: memory[field] for field in ('expires', 'remind') if memory.get(field)}
+            if fields:
+                entries[key] = fields
+        return entries
+
+    def _read_timer_index(self) -> Optional[Dict]:
+        if not os.path.exists(self.timer_index_path):
+            return None
+        with open(self.timer_index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        return index if isinstance(index, dict) else {}
+
+    def _scan_timers(self) -> Dict:
+        """读一遍所有分片建立定时索引"""
+        index = {}
+        for user_id, user_memories in self.iter_users():
+            if isinstance(user_memories, dict):
+                entries = self._timer_entries(user_memories)
+                if entries:
+                    index[user_id] = entries
+        return index
+
+    def prepare(self, memories: Dict, changes: Changes):
+        """只序列化有变更的用户，记忆为空的用户删除分片文件；附带各用户的变更记录供合并时使用"""
+        user_changes = {}
+        for change_key, kind in changes.items():
+            user_changes.setdefault(change_key[0], {})[change_key] = kind
+
+        payload = {}
+        for user_id, changes_of_user in user_changes.items():
+            user_memories = memories.get(user_id)
+            data = dump_json({'user_id': user_id, 'memories': user_memories}) if user_memories else None
+            payload[self.shard_path(user_id)] = (
+                user_id, data, build_records(memories, changes_of_user), self._timer_entries(user_memories)
+            )
+        return payload
+
+    def commit(self, payload):
+        with self._writing() as foreign:
+            index = None if foreign else self._timer_index
+            self._timer_index = None
+            index_changed = False
+            if index is None:
+                index = self._read_timer_index()
+                if index is None:
+                    index = self._scan_timers()
+                    index_changed = True
+
+            writes = []
+            for path, (user_id, data, lines, timers) in payload.items():
+                if foreign:
+                    data, timers = self._merge_shard(path, user_id, lines)
+                writes.append((path, data))
+                if timers:
+                    if index.get(user_id) != timers:
+                        index[user_id] = timers
+                        index_changed = True
+                elif user_id in index:
+                    del index[user_id]
+                    index_changed = True
+
+            # 先写索引：中途失败时索引里多出的条目触发时核对不上会被丢弃，缺少的条目却要等用户加载才会重新登记
+            if index_changed:
+                os.makedirs(self.shard_dir, exist_ok=True)
+                write_file_replace(self.timer_index_path, dump_json(index))
+            for path, data in writes:
+                self._write_shard(path, data)
+            self._timer_index = index
+
+    def _merge_shard(self, path: str, user_id: str, lines: List[str]) -> Tuple[Optional[str], Dict]:
+        """以分片文件中的最新数据为基础应用该用户的变更记录，返回分片内容和定时条目"""
+        data = {user_id: self._read_shard(path, user_id)}
+        for line in lines:
+            apply_record(data, json.loads(line))
+        if not data[user_id]:
+            return None, {}
+        return dump_json({'user_id': user_id, 'memories': data[user_id]}), self._timer_entries(data[user_id])
+
+    @staticmethod
+    def _write_shard(path: str, data: Optional[str]):
+        if data is None:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_file_replace(path, data)
+
+    def migrate_from_json(self, memories_file: str) -> int:
+        """把旧的 memories.json 一次性拆分为分片，返回迁移的用户数"""
+        if not os.path.exists(memories_file):
+            return 0
+        with open(memories_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+
+        count = 0
+        for user_id, user_memories in data.items():
+            if isinstance(user_memories, dict) and user_memories:
+                changes = {(user_id, key): CHANGE_PUT for key in user_memories}
+                self.commit(self.prepare({user_id: user_memories}, changes))
+                count += 1
+
+        os.replace(memories_file, f"{memories_file}.migrated")
+        return count
+
+
+class SqliteMemoryStore(LockedStore):
+    """SQLite 存储（WAL 模式），按用户懒加载，搜索走 FTS5 索引
+
+    FTS5 使用 trigram 分词器，可以对中文做子串匹配而不需要分词；
+    不足 3 个字符的关键词无法命中 trigram 索引，改为在该用户的记录上做 LIKE 匹配。
+    两者都只查 search_text 列：写入时用 Python 的 str.lower() 转成小写的 key、内容和标签，
+    查询时关键词同样在 Python 中转小写，大小写规则与其他存储模式的内存搜索一致
+    （SQL 的 lower() 和 FTS5 的大小写折叠对非 ASCII 字符的处理都与 str.lower() 不同）。
+    16 字以上的内容存放在 contents 表，按 SHA-1 只存一份，记忆行通过 content_id 引用，
+    引用数由触发器维护；contents_fts 索引其中的小写内容。
+    所有方法都是同步的，由插件放到线程池中调用，内部用锁串行化连接访问。
+    """
+
+    lazy = True
+    searchable = True
+    # 数据库结构版本（PRAGMA user_version），低于它的数据库打开时逐行改写
+    schema_version = 1
+
+    def __init__(self, db_file: str, lock: Optional[StoreLock] = None):
+        super().__init__(lock)
+        self.db_file = db_file
+        self.has_fts = False
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        self._init_schema()
+
+    def _init_schema(self):
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS memories ("
+                " id INTEGER PRIMARY KEY,"
+                " user_id TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " content TEXT NOT NULL,"
+                " tags TEXT NOT NULL DEFAULT '[]',"
+                " search_text TEXT NOT NULL DEFAULT '',"
+                " created TEXT NOT NULL DEFAULT '',"
+                " usage_count INTEGER NOT NULL DEFAULT 0,"
+                " expires TEXT NOT NULL DEFAULT '',"
+                " remind TEXT NOT NULL DEFAULT '',"
+                " UNIQUE (user_id, key))"
+            )
+            # 旧版数据库没有过期和提醒列
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(memories)")}
+            for column in ('expires', 'remind'):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE memories ADD COLUMN {column} TEXT NOT NULL DEFAULT ''")
+            # 旧版数据库没有内容表，用 SQL lower() 搜索原文或 FTS 索引建在原文上：
+            # 补上新列后逐行改写（长内容移入 contents，重算 search_text），FTS 表和触发器删掉按新结构重建。
+            # 改写可重复执行，全部完成后才更新 user_version，中途中断的下次打开时重新改写
+            rewrite = self._conn.execute("PRAGMA user_version").fetchone()[0] < self.schema_version
+            for column, definition in (('search_text', "TEXT NOT NULL DEFAULT ''"), ('content_id', "INTEGER")):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE memories ADD COLUMN {column} {definition}")
+            if rewrite:
+                self._conn.executescript(
+                    "DROP TRIGGER IF EXISTS memories_ai;"
+                    "DROP TRIGGER IF EXISTS memories_ad;"
+                    "DROP TRIGGER IF EXISTS memories_au;"
+                    "DROP TRIGGER IF EXISTS contents_ai;"
+                    "DROP TRIGGER IF EXISTS contents_ad;"
+                    "DROP TABLE IF EXISTS memories_fts;"
+                    "DROP TABLE IF EXISTS contents_fts;"
+                )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS memories_timers ON memories (user_id)"
+                " WHERE expires != '' OR remind != ''"
+            )
+
+            # 内容表：长内容按哈希只存一份，refs 为引用它的记忆数，由触发器维护，归零时删除
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS contents ("
+                " id INTEGER PRIMARY KEY,"
+                " hash BLOB NOT NULL UNIQUE,"
+                " content TEXT NOT NULL,"
+                " search_text TEXT NOT NULL DEFAULT '',"
+                " refs INTEGER NOT NULL DEFAULT 0)"
+            )
+            self._conn.executescript(
+                "CREATE TRIGGER IF NOT EXISTS memories_refs_ai AFTER INSERT ON memories"
+                " WHEN new.content_id IS NOT NULL BEGIN"
+                "  UPDATE contents SET refs = refs + 1 WHERE id = new.content_id;"
+                " END;"
+                "CREATE TRIGGER IF NOT EXISTS memories_refs_ad AFTER DELETE ON memories"
+                " WHEN old.content_id IS NOT NULL BEGIN"
+                "  UPDATE contents SET refs = refs - 1 WHERE id = old.content_id;"
+                "  DELETE FROM contents WHERE id = old.content_id AND refs <= 0;"
+                " END;"
+                "CREATE TRIGGER IF NOT EXISTS memories_refs_au AFTER UPDATE OF content_id ON memories"
+                " WHEN old.content_id IS NOT new.content_id BEGIN"
+                "  UPDATE contents SET refs = refs + 1 WHERE id = new.content_id;"
+                "  UPDATE contents SET refs = refs - 1 WHERE id = old.content_id;"
+                "  DELETE FROM contents WHERE id = old.content_id AND refs <= 0;"
+                " END;"
+            )
+            if rewrite:
+                rows = self._conn.execute(
+                    "SELECT m.id, m.key, COALESCE(c.content, m.content), m.tags"
+                    " FROM memories m LEFT JOIN contents c ON c.id = m.content_id"
+                ).fetchall()
+                updates = []
+                for row_id, key, content, tags in rows:
+                    content_row, put_row = self._put_rows('', key, MemoryRecord(content, self._load_tags(tags)))
+                    if content_row is not None:
+                        self._insert_content(content_row)
+                    updates.append((put_row[2], put_row[3], put_row[5], row_id))
+                self._conn.executemany(
+                    "UPDATE memories SET content = ?, content_id = (SELECT id FROM contents WHERE hash = ?),"
+                    " search_text = ? WHERE id = ?",
+                    updates
+                )
+
+            # FTS 表新建时（新数据库、刚改写过、或 SQLite 升级后才支持 trigram）从表中数据重建索引
+            fts_exists = self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'memories_fts'"
+            ).fetchone() is not None
+            try:
+                # search_text 已是小写，分词器不再做大小写折叠；
+                # 记忆行的 search_text 不含已移入内容表的内容，内容另有 contents_fts 索引
+                self._conn.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS memories_fts USING fts5("
+                    " search_text,"
+                    " content='memories', content_rowid='id', tokenize='trigram case_sensitive 1')"
+                )
+                self._conn.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS contents_fts USING fts5("
+                    " search_text,"
+                    " content='contents', content_rowid='id', tokenize='trigram case_sensitive 1')"
+                )
+                self._conn.executescript(
+                    "CREATE TRIGGER IF NOT EXISTS memories_ai AFTER INSERT ON memories BEGIN"
+                    "  INSERT INTO memories_fts(rowid, search_text) VALUES (new.id, new.search_text);"
+                    " END;"
+                    "CREATE TRIGGER IF NOT EXISTS memories_ad AFTER DELETE ON memories BEGIN"
+                    "  INSERT INTO memories_fts(memories_fts, rowid, search_text)"
+                    "  VALUES ('delete', old.id, old.search_text);"
+                    " END;"
+                    "CREATE TRIGGER IF NOT EXISTS memories_au AFTER UPDATE OF search_text ON memories BEGIN"
+                    "  INSERT INTO memories_fts(memories_fts, rowid, search_text)"
+                    "  VALUES ('delete', old.id, old.search_text);"
+                    "  INSERT INTO memories_fts(rowid, search_text) VALUES (new.id, new.search_text);"
+                    " END;"
+                    "CREATE TRIGGER IF NOT EXISTS contents_ai AFTER INSERT ON contents BEGIN"
+                    "  INSERT INTO contents_fts(rowid, search_text) VALUES (new.id, new.search_text);"
+                    " END;"
+                    "CREATE TRIGGER IF NOT EXISTS contents_ad AFTER DELETE ON contents BEGIN"
+                    "  INSERT INTO contents_fts(contents_fts, rowid, search_text)"
+                    "  VALUES ('delete', old.id, old.search_text);"
+                    " END;"
+                )
+                if not fts_exists:
+                    self._conn.execute("INSERT INTO memories_fts(memories_fts) VALUES ('rebuild')")
+                    self._conn.execute("INSERT INTO contents_fts(contents_fts) VALUES ('rebuild')")
+                self.has_fts = True
+            except sqlite3.OperationalError:
+                # 旧版 SQLite 不支持 trigram 分词器，搜索退回 LIKE
+                self.has_fts = False
+            self._conn.execute(f"PRAGMA user_version = {self.schema_version}")
+
+    def load(self) -> Dict:
+        """SQLite 存储启动时不加载任何用户"""
+        return {}
+
+    def load_user(self, user_id: str) -> Dict:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT m.key, COALESCE(c.content, m.content), m.tags, m.created, m.usage_count, m.expires, m.remind"
+                " FROM memories m LEFT JOIN contents c ON c.id = m.content_id"
+                " WHERE m.user_id = ? ORDER BY m.id",
+                (user_id,)
+            ).fetchall()
+
+        return {row[0]: self._row_dict(*row[1:]) for row in rows}
+
+    @staticmethod
+    def _load_tags(tags: str) -> List:
+        try:
+            return json.loads(tags)
+        except ValueError:
+            return []
+
+    @classmethod
+    def _row_dict(cls, content: str, tags: str, created: str, usage_count: int, expires: str, remind: str) -> Dict:
+        memory = {'content': content, 'tags': cls._load_tags(tags), 'created': created, 'usage_count': usage_count}
+        if expires:
+            memory['expires'] = expires
+        if remind:
+            try:
+                memory['remind'] = json.loads(remind)
+            except ValueError:
+                pass
+        return memory
+
+    def iter_users(self) -> Iterator[Tuple[str, Dict]]:
+        with self._lock:
+            user_ids = [row[0] for row in self._conn.execute("SELECT DISTINCT user_id FROM memories ORDER BY user_id")]
+        for user_id in user_ids:
+            yield user_id, self.load_user(user_id)
+
+    def iter_timers(self) -> Iterator[Tuple[str, str, Dict]]:
+        """设置了过期时间或提醒的记忆，走 memories_timers 部分索引"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT m.user_id, m.key, COALESCE(c.content, m.content), m.tags, m.created, m.usage_count,"
+                " m.expires, m.remind"
+                " FROM memories m LEFT JOIN contents c ON c.id = m.content_id"
+                " WHERE m.expires != '' OR m.remind != ''"
+            ).fetchall()
+        for row in rows:
+            yield row[0], row[1], self._row_dict(*row[2:])
+
+    def search(self, user_id: str, keyword: str) -> List[str]:
+        """返回该用户 key、内容或标签包含关键词（不区分大小写）的记忆 key"""
+        keyword = str(keyword).lower()
+        with self._lock:
+            if self.has_fts and len(keyword) >= 3:
+                phrase = '"' + keyword.replace('"', '""') + '"'
+                rows = self._conn.execute(
+                    "SELECT key FROM memories WHERE user_id = :user_id AND ("
+                    " id IN (SELECT rowid FROM memories_fts WHERE memories_fts MATCH :phrase)"
+                    " OR content_id IN (SELECT rowid FROM contents_fts WHERE contents_fts MATCH :phrase))"
+                    " ORDER BY id",
+                    {'user_id': user_id, 'phrase': phrase}
+                ).fetchall()
+            else:
+                pattern = '%' + keyword.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+                rows = self._conn.execute(
+                    "SELECT m.key FROM memories m LEFT JOIN contents c ON c.id = m.content_id"
+                    " WHERE m.user_id = :user_id AND (m.search_text LIKE :pattern ESCAPE '\\'"
+                    " OR c.search_text LIKE :pattern ESCAPE '\\')"
+                    " ORDER BY m.id",
+                    {'user_id': user_id, 'pattern': pattern}
+                ).fetchall()
+        return [row[0] for row in rows]
+
+    @staticmethod
+    def _put_rows(user_id: str, key: str, memory: MemoryRecord) -> Tuple[Optional[Tuple], Tuple]:
+        """内容较长时 contents 表的一行（否则为 None），以及 memories 表的一行
+
+        search_text 为小写的 key、内容和标签，用 \\x1f 分隔，关键词不会跨字段命中；
+        内容移入 contents 表时，小写的内容随内容一起存放，记忆行中的内容和该字段留空。
+        """
+        key_text, content_text, tags_text = memory_fields(key, memory)
+        content, digest, content_row = memory.content, None, None
+        if len(content) >= SHARED_CONTENT_MIN_LENGTH:
+            digest = hashlib.sha1(content.encode('utf-8')).digest()
+            content_row = (digest, content, content_text)
+            content, content_text = '', ''
+        expires = format_minutes(memory.expires) if memory.expires is not None else ''
+        remind = (dump_json({'at': format_minutes(memory.remind[0]), 'to': memory.remind[1]})
+                  if memory.remind is not None else '')
+        search_text = '\x1f'.join((key_text, content_text, tags_text))
+        return content_row, (user_id, key, content, digest, dump_json(memory.tags), search_text,
+                             memory.created_iso, memory.usage_count, expires, remind)
+
+    def _insert_content(self, content_row: Tuple):
+        self._conn.execute(
+            "INSERT INTO contents (hash, content, search_text) VALUES (?, ?, ?) ON CONFLICT (hash) DO NOTHING",
+            content_row
+        )
+
+    def prepare(self, memories: Dict, changes: Changes):
+        contents, puts, uses, deletes = {}, [], [], []
+        for (user_id, key), kind in changes.items():
+            memory = memories.get(user_id, {}).get(key)
+            if memory is None:
+                deletes.append((user_id, key))
+            elif kind == CHANGE_USE:
+                uses.append((memory.usage_count, user_id, key))
+            else:
+                content_row, put_row = self._put_rows(user_id, key, memory)
+                if content_row is not None:
+                    contents[content_row[0]] = content_row
+                puts.append(put_row)
+        return list(contents.values()), puts, uses, deletes
+
+    def commit(self, payload):
+        """按行更新，本身就不会覆盖其他进程对其他记忆的修改
+
+        先删除再登记内容：删除可能让某份内容的引用归零而被移除，随后写入的同内容记忆会重新登记它。
+        """
+        contents, puts, uses, deletes = payload
+        with self._writing(), self._lock, self._conn:
+            if deletes:
+                self._conn.executemany("DELETE FROM memories WHERE user_id = ? AND key = ?", deletes)
+            for content_row in contents:
+                self._insert_content(content_row)
+            if puts:
+                self._conn.executemany(
+                    "INSERT INTO memories (user_id, key, content, content_id, tags, search_text, created,"
+                    " usage_count, expires, remind)"
+                    " VALUES (?, ?, ?, (SELECT id FROM contents WHERE hash = ?), ?, ?, ?, ?, ?, ?)"
+                    " ON CONFLICT (user_id, key) DO UPDATE SET"
+                    " content = excluded.content, content_id = excluded.content_id, tags = excluded.tags,"
+                    " search_text = excluded.search_text, created = excluded.created,"
+                    " usage_count = excluded.usage_count, expires = excluded.expires, remind = excluded.remind",
+                    puts
+                )
+            if uses:
+                self._conn.executemany("UPDATE memories SET usage_count = ? WHERE user_id = ? AND key = ?", uses)
+
+    def migrate_from_json(self, memories_file: str) -> int:
+        """把旧的 memories.json 一次性导入数据库，返回迁移的用户数"""
+        if not os.path.exists(memories_file):
+            return 0
+        with open(memories_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+
+        memories = {}
+        changes = {}
+        for user_id, user_memories in data.items():
+            if not isinstance(user_memories, dict):
+                continue
+            user_id = str(user_id)
+            memories[user_id] = {
+                str(key): MemoryRecord.from_dict(memory)
+                for key, memory in user_memories.items() if isinstance(memory, dict)
+            }
+            changes.update({(user_id, key): CHANGE_PUT for key in memories[user_id]})
+        self.commit(self.prepare(memories, changes))
+        count = len(memories)
+
+        os.replace(memories_file, f"{memories_file}.migrated")
+        return count
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
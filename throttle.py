@@ -0,0 +1,122 @@
+"""
+指令准入控制
+
+每个用户、每个群各一个令牌桶：桶按 rate 每秒补充令牌，最多存 burst 个，
+每条指令消耗一个，取不到令牌的指令直接拒绝，不再渲染图片或保存。
+同一用户发送的相同指令在上一条仍在处理时合并为一条，重复的请求不回复。
+被限流时只在本轮第一次拒绝时回复提示，之后静默丢弃，避免刷屏换来同样多的提示。
+"""
+
+import functools
+import time
+from collections import OrderedDict
+from typing import Optional, Set, Tuple
+
+# 准入结果
+ADMIT = "admit"
+THROTTLED_USER = "user"
+THROTTLED_GROUP = "group"
+DUPLICATE = "duplicate"
+
+
+class RateLimiter:
+    """按 key 的令牌桶；只保留最近使用的 max_keys 个桶，被丢弃的桶下次从满桶开始"""
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 4096):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> [令牌数, 上次补充时间]
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def available(self, key: str, now: float) -> bool:
+        """补充令牌并判断是否还有令牌，不消耗"""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(self.burst), now]
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(float(self.burst), bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket[0] >= 1
+
+    def take(self, key: str):
+        """消耗一个令牌，须先调用 available()"""
+        self._buckets[key][0] -= 1
+
+
+class Admission:
+    """用户和群的令牌桶、正在处理的请求，以及已提示过限流的用户"""
+
+    def __init__(self, user_rate: float = 0.5, user_burst: int = 5,
+                 group_rate: float = 2.0, group_burst: int = 20):
+        self.users = RateLimiter(user_rate, user_burst)
+        self.groups = RateLimiter(group_rate, group_burst)
+        self._inflight: Set[Tuple[str, str]] = set()
+        self._notified: Set[str] = set()
+
+    def admit(self, user_id: str, group_id: str, request: str) -> str:
+        """判断是否受理一条指令；受理后须在处理结束时调用 release()"""
+        if (user_id, request) in self._inflight:
+            return DUPLICATE
+
+        now = time.monotonic()
+        if self.users.enabled and not self.users.available(user_id, now):
+            return THROTTLED_USER
+        if group_id and self.groups.enabled and not self.groups.available(group_id, now):
+            return THROTTLED_GROUP
+        if self.users.enabled:
+            self.users.take(user_id)
+        if group_id and self.groups.enabled:
+            self.groups.take(group_id)
+
+        self._inflight.add((user_id, request))
+        self._notified.discard(user_id)
+        return ADMIT
+
+    def release(self, user_id: str, request: str):
+        self._inflight.discard((user_id, request))
+
+    def should_notify(self, user_id: str) -> bool:
+        """本轮被限流后是否是第一次拒绝该用户"""
+        if user_id in self._notified:
+            return False
+        self._notified.add(user_id)
+        return True
+
+
+def admission_controlled(func):
+    """指令处理前的准入检查，使用所属对象的 _admission；为 None 时直接透传
+
+    被拒绝的指令记入 _metrics 的 throttled 计数（标签为拒绝原因）。
+    """
+    @functools.wraps(func)
+    async def wrapper(self, event, *args, **kwargs):
+        admission: Optional[Admission] = self._admission
+        if admission is None:
+            async for result in func(self, event, *args, **kwargs):
+                yield result
+            return
+
+        user_id = str(event.get_sender_id())
+        request = event.message_str.strip()
+        verdict = admission.admit(user_id, str(event.get_group_id() or ""), request)
+        if verdict != ADMIT:
+            if self._metrics is not None:
+                self._metrics.inc("throttled", verdict)
+            if verdict != DUPLICATE and admission.should_notify(user_id):
+                yield event.plain_result("⏳ 操作太频繁，请稍后再试")
+            return
+
+        try:
+            async for result in func(self, event, *args, **kwargs):
+                yield result
+        finally:
+            admission.release(user_id, request)
+    return wrapper
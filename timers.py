@@ -0,0 +1,121 @@
+"""
+记忆到期和提醒
+
+记忆可以带过期时间（到期后删除）和提醒时间（到期时向保存记忆的会话推送一条消息），
+两者都是分钟时间戳。所有待触发的时间点放在一个最小堆里，后台任务只看堆顶，
+每次唤醒的开销只与到期的定时器数量有关，与记忆总数无关。
+
+堆里的条目不随记忆修改或删除而移除：触发时再核对记忆当前的时间是否仍与条目一致，
+不一致（已删除、已改期、提醒已发送）的条目直接丢弃。
+"""
+
+import heapq
+import re
+from datetime import datetime, timedelta
+from typing import List, Optional, Set, Tuple
+
+# 定时器类型
+TIMER_EXPIRE = "expire"
+TIMER_REMIND = "remind"
+
+# 时长单位对应的分钟数
+DURATION_UNITS = {'m': 1, 'h': 60, 'd': 1440, 'w': 10080}
+_DURATION_PATTERN = re.compile(r'(\d+)([mhdw])')
+_CLOCK_PATTERN = re.compile(r'(\d{1,2}):(\d{2})')
+
+Timer = Tuple[int, str, str, str]
+
+
+def parse_duration(text: str) -> Optional[int]:
+    """解析 30m、2h、1d、1w 或组合形式（如 1d12h）为分钟数，格式不对时返回 None"""
+    text = text.strip().lower()
+    if not text or _DURATION_PATTERN.sub('', text):
+        return None
+    minutes = sum(int(value) * DURATION_UNITS[unit] for value, unit in _DURATION_PATTERN.findall(text))
+    return minutes or None
+
+
+def parse_when(text: str, now: datetime) -> Optional[int]:
+    """解析提醒时间，返回分钟时间戳
+
+    支持时长（相对当前时间，如 2h）、当天时刻（如 15:00，已过则为次日）
+    和本地时间（如 2026-10-18T15:00 或 2026-10-18 15:00）。
+    """
+    minutes = parse_duration(text)
+    if minutes is not None:
+        return int(now.timestamp() // 60) + minutes
+
+    clock = _CLOCK_PATTERN.fullmatch(text.strip())
+    if clock:
+        hour, minute = int(clock.group(1)), int(clock.group(2))
+        if hour > 23 or minute > 59:
+            return None
+        when = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if when <= now:
+            when += timedelta(days=1)
+        return int(when.timestamp() // 60)
+
+    try:
+        when = datetime.fromisoformat(text.strip())
+    except ValueError:
+        return None
+    return int(when.timestamp() // 60)
+
+
+def split_timer_tags(tags: List[str], now: datetime) -> Tuple[List[str], Optional[int], Optional[int]]:
+    """从标签中取出 ttl=时长 和 remind=时间，返回其余标签、过期时间和提醒时间
+
+    格式不对时抛出 ValueError，消息可直接回复给用户。
+    """
+    rest, expires, remind_at = [], None, None
+    for tag in tags:
+        name, sep, value = tag.partition('=')
+        name = name.lower()
+        if sep and name == 'ttl':
+            minutes = parse_duration(value)
+            if minutes is None:
+                raise ValueError(f"无法识别的过期时长: {value}（示例: #ttl=30m、#ttl=1d）")
+            expires = int(now.timestamp() // 60) + minutes
+        elif sep and name == 'remind':
+            remind_at = parse_when(value, now)
+            if remind_at is None:
+                raise ValueError(f"无法识别的提醒时间: {value}（示例: #remind=2h、#remind=15:00）")
+        else:
+            rest.append(tag)
+    return rest, expires, remind_at
+
+
+class TimerQueue:
+    """按到期时间排序的最小堆；同一 (到期时间, 类型, 用户, key) 只登记一次"""
+
+    def __init__(self):
+        self._heap: List[Timer] = []
+        self._entries: Set[Timer] = set()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, due: int, kind: str, user_id: str, key: str) -> bool:
+        """登记定时器，返回它是否成为最早到期的一个"""
+        timer = (due, kind, user_id, key)
+        if timer in self._entries:
+            return False
+        self._entries.add(timer)
+        heapq.heappush(self._heap, timer)
+        return self._heap[0] is timer
+
+    def next_due(self) -> Optional[int]:
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: int) -> List[Timer]:
+        """取出所有不晚于 now 到期的定时器"""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            timer = heapq.heappop(self._heap)
+            self._entries.discard(timer)
+            due.append(timer)
+        return due
+
+    def clear(self):
+        self._heap.clear()
+        self._entries.clear()
@@ -0,0 +1,205 @@
+"""
+记忆批量导入导出
+
+导出文件为 NDJSON，每行一个用户：{"user_id": ..., "memories": {key: 记忆}}，
+记忆字段与 memories.json 相同。读写都逐行进行，内存占用只与单个用户（或一批用户）有关。
+
+插件内通过管理员指令 /导出记忆、/导入记忆 使用；也可以在插件停止时直接运行：
+
+    python -m astrbot_plugin_memory.transfer export <数据目录> <文件> [--mode json|journal|sharded|sqlite]
+    python -m astrbot_plugin_memory.transfer import <数据目录> <文件> [--mode ...] [--batch 50]
+"""
+
+import argparse
+import json
+import os
+import sys
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from .namespaces import memory_limit
+from .records import MemoryRecord, clean_user_memories, trim_memories
+from .storage import (CHANGE_PUT, JournalMemoryStore, JsonMemoryStore, ShardedMemoryStore,
+                      SqliteMemoryStore, StoreLock, dump_json)
+
+# 与插件默认配置一致的校验规则
+MAX_KEY_LENGTH = 50
+MAX_CONTENT_LENGTH = 500
+MAX_MEMORY_PER_USER = 100
+MAX_MEMORY_PER_GROUP = 200
+
+
+class ImportStats:
+    """导入统计：用户数、记忆条数、被跳过的无效行数"""
+
+    def __init__(self):
+        self.users = 0
+        self.memories = 0
+        self.skipped_lines = 0
+
+    def __str__(self):
+        return f"{self.users} 个用户，{self.memories} 条记忆，跳过 {self.skipped_lines} 行"
+
+
+def user_line(user_id: str, memories: Dict) -> str:
+    return dump_json({'user_id': user_id, 'memories': memories}) + '\n'
+
+
+def write_ndjson(users: Iterable[Tuple[str, Dict]], path: str) -> int:
+    """逐个用户写出 NDJSON，先写临时文件再改名，返回导出的用户数"""
+    tmp_path = f"{path}.tmp"
+    count = 0
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for user_id, memories in users:
+            if memories:
+                f.write(user_line(user_id, memories))
+                count += 1
+    os.replace(tmp_path, path)
+    return count
+
+
+def read_ndjson(path: str, stats: ImportStats) -> Iterator[Tuple[str, Dict]]:
+    """逐行读取 NDJSON，返回 (user_id, 原始记忆字典)；格式不对的行计入 stats.skipped_lines"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+            except ValueError:
+                stats.skipped_lines += 1
+                continue
+            if (not isinstance(data, dict) or not data.get('user_id')
+                    or not isinstance(data.get('memories'), dict)):
+                stats.skipped_lines += 1
+                continue
+            yield str(data['user_id']), data['memories']
+
+
+def read_batch(reader: Iterator[Tuple[str, Dict]], size: int) -> List[Tuple[str, Dict]]:
+    """从 read_ndjson() 中取出最多 size 个用户，读完时返回空列表"""
+    batch = []
+    for item in reader:
+        batch.append(item)
+        if len(batch) >= size:
+            break
+    return batch
+
+
+def clean_import(user_memories: Dict, max_key_length: int = MAX_KEY_LENGTH,
+                 max_content_length: int = MAX_CONTENT_LENGTH) -> Dict[str, MemoryRecord]:
+    """按加载时的规则清洗一个用户的导入数据，并截断过长的 key、丢弃空 key 或空内容
+
+    条数上限在与已有记忆合并之后再检查。
+    """
+    if not isinstance(user_memories, dict):
+        return {}
+    result = {}
+    for key, memory in user_memories.items():
+        if not isinstance(memory, dict):
+            continue
+        key = str(key)[:max_key_length]
+        record = MemoryRecord.from_dict(memory, max_content_length)
+        if key and record.content:
+            result[key] = record
+    return result
+
+
+def open_store(data_dir: str, mode: str):
+    """按插件的数据目录布局打开存储后端"""
+    memories_file = os.path.join(data_dir, "memories.json")
+    # 与插件使用同一把进程间锁，插件运行中也可以安全导入
+    lock = StoreLock(os.path.join(data_dir, "memories.lock"))
+    if mode == "journal":
+        return JournalMemoryStore(memories_file, os.path.join(data_dir, "memories.journal"), lock=lock)
+    if mode == "sharded":
+        return ShardedMemoryStore(os.path.join(data_dir, "users"), lock=lock)
+    if mode == "sqlite":
+        return SqliteMemoryStore(os.path.join(data_dir, "memories.db"), lock=lock)
+    return JsonMemoryStore(memories_file, lock=lock)
+
+
+def export_store(store, path: str) -> int:
+    """导出存储中的全部用户；懒加载存储逐个用户读取"""
+    if store.lazy:
+        return write_ndjson(store.iter_users(), path)
+    return write_ndjson(store.load().items(), path)
+
+
+def import_into_store(store, path: str, batch_size: int = 50) -> ImportStats:
+    """把 NDJSON 合并进存储，同名 key 被覆盖；每批用户提交一次
+
+    懒加载存储逐批读取、合并、写回；json 和 journal 存储本身就是整体文件，
+    只能全部读入后在最后提交一次。
+    """
+    stats = ImportStats()
+    reader = read_ndjson(path, stats)
+    if store.lazy:
+        while True:
+            batch = read_batch(reader, batch_size)
+            if not batch:
+                break
+            memories, changes = {}, {}
+            for user_id, raw_memories in batch:
+                if user_id not in memories:
+                    memories[user_id] = clean_user_memories(store.load_user(user_id), MAX_CONTENT_LENGTH,
+                                                            _limit(user_id))
+                _merge_user(memories, changes, user_id, clean_import(raw_memories), stats)
+            if changes:
+                store.commit(store.prepare(memories, changes))
+        return stats
+
+    memories = {
+        str(user_id): clean_user_memories(raw_memories, MAX_CONTENT_LENGTH, _limit(str(user_id)))
+        for user_id, raw_memories in store.load().items()
+    }
+    changes = {}
+    for user_id, raw_memories in reader:
+        memories.setdefault(user_id, {})
+        _merge_user(memories, changes, user_id, clean_import(raw_memories), stats)
+    if changes:
+        store.commit(store.prepare(memories, changes))
+    return stats
+
+
+def _limit(user_id: str) -> int:
+    return memory_limit(user_id, MAX_MEMORY_PER_USER, MAX_MEMORY_PER_GROUP)
+
+
+def _merge_user(memories: Dict, changes: Dict, user_id: str, imported: Dict[str, MemoryRecord],
+                stats: ImportStats):
+    """把一个用户的导入记忆合并进 memories 并按上限淘汰，变更（含被淘汰的 key）记入 changes"""
+    if not imported:
+        return
+    user_memories = memories[user_id]
+    touched = set(user_memories) | set(imported)
+    user_memories.update(imported)
+    trim_memories(user_memories, _limit(user_id))
+    changes.update(((user_id, key), CHANGE_PUT) for key in touched)
+    stats.users += 1
+    stats.memories += len(imported)
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="个人记忆插件数据导入导出（NDJSON）")
+    parser.add_argument('action', choices=('export', 'import'))
+    parser.add_argument('data_dir', help="插件数据目录，通常为插件目录下的 data")
+    parser.add_argument('path', help="NDJSON 文件路径")
+    parser.add_argument('--mode', default='json', choices=('json', 'journal', 'sharded', 'sqlite'),
+                        help="插件使用的存储模式")
+    parser.add_argument('--batch', type=int, default=50, help="导入时每批提交的用户数")
+    args = parser.parse_args(argv)
+
+    store = open_store(args.data_dir, args.mode)
+    try:
+        if args.action == 'export':
+            print(f"已导出 {export_store(store, args.path)} 个用户")
+        else:
+            print(f"已导入 {import_into_store(store, args.path, args.batch)}")
+    finally:
+        if hasattr(store, 'close'):
+            store.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,41 @@
+"""
+记忆使用次数计数
+
+回忆记忆时只在内存中累加使用次数并记到这里，不触发保存；
+插件按 usage_flush_interval 定期把累计的变化一次性转成保存请求，
+读多写少的负载因此不会变成每次回忆都写一次文件。
+"""
+
+from typing import Dict, Set, Tuple
+
+
+class UsageCounter:
+    """待持久化的使用次数变化"""
+
+    def __init__(self):
+        self._pending: Dict[Tuple[str, str], int] = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def hit(self, user_id: str, key: str):
+        """记录一次回忆"""
+        item = (user_id, key)
+        self._pending[item] = self._pending.get(item, 0) + 1
+
+    def drain(self) -> Dict[Tuple[str, str], int]:
+        """取出并清空待持久化的变化：(user_id, key) -> 本周期内的回忆次数"""
+        pending, self._pending = self._pending, {}
+        return pending
+
+    def peek(self) -> Dict[Tuple[str, str], int]:
+        """不清空地查看待持久化的变化"""
+        return self._pending
+
+    def users(self) -> Set[str]:
+        """有待持久化变化的用户"""
+        return {user_id for user_id, _ in self._pending}
+
+    def discard(self, user_id: str, key: str):
+        """记忆被删除时丢弃它的计数"""
+        self._pending.pop((user_id, key), None)